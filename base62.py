@@ -0,0 +1,144 @@
+'''Base 62 encoding of puush IDs
+
+The lookup tables for both alphabets are built once at import time.
+'''
+
+# Be careful! Some implementations have the ordering of upper and lower case
+# differently
+ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+ALPHABET_PUUSH = '0123456789abcdefghijklmnopqrstuvwxyz' \
+    'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+assert ALPHABET != ALPHABET_PUUSH
+assert len(ALPHABET) == 62
+assert len(ALPHABET_PUUSH) == 62
+
+BASE = 62
+PAIR_BASE = BASE * BASE
+
+
+class _Tables(object):
+    '''Lookup tables for one alphabet'''
+    def __init__(self, alphabet):
+        self.decode = dict((char, index) for index, char
+            in enumerate(alphabet))
+        # Every two digit string, zero padded
+        self.pairs = [a + b for a in alphabet for b in alphabet]
+        # The encodings of 0 to PAIR_BASE - 1, without padding
+        self.short = list(alphabet) + self.pairs[BASE:]
+
+
+_TABLES = {
+    ALPHABET: _Tables(ALPHABET),
+    ALPHABET_PUUSH: _Tables(ALPHABET_PUUSH),
+}
+
+
+def _get_tables(alphabet):
+    tables = _TABLES.get(alphabet)
+
+    if not tables:
+        tables = _TABLES[alphabet] = _Tables(alphabet)
+
+    return tables
+
+
+def base62_encode(num, alphabet=ALPHABET):
+    """Encode a number in Base X
+
+    `num`: The number to encode
+    `alphabet`: The alphabet to use for encoding
+    """
+    tables = _TABLES.get(alphabet) or _get_tables(alphabet)
+
+    if num < PAIR_BASE:
+        return tables.short[num]
+
+    pairs = tables.pairs
+    low = pairs[num % PAIR_BASE]
+    num //= PAIR_BASE
+
+    if num < PAIR_BASE:
+        # IDs of up to four digits need no loop
+        return tables.short[num] + low
+
+    arr = [low]
+
+    while num >= PAIR_BASE:
+        num, rem = divmod(num, PAIR_BASE)
+        arr.append(pairs[rem])
+
+    arr.append(tables.short[num])
+    arr.reverse()
+    return ''.join(arr)
+
+
+def base62_decode(string, alphabet=ALPHABET):
+    """Decode a Base X encoded string into the number
+
+    Arguments:
+    - `string`: The encoded string
+    - `alphabet`: The alphabet to use for encoding
+    """
+    table = (_TABLES.get(alphabet) or _get_tables(alphabet)).decode
+    num = 0
+
+    for char in string:
+        num = num * BASE + table[char]
+
+    return num
+
+
+def encode_range(start, end, alphabet=ALPHABET):
+    '''Yield the encodings of `start` to `end` inclusive.
+
+    Only the digits above the last two are encoded with division, once every
+    3844 numbers; the last two digits come from a table.
+    '''
+    tables = _get_tables(alphabet)
+    num = start
+
+    while num <= end:
+        high, low = divmod(num, PAIR_BASE)
+        block_end = min(end, num - low + PAIR_BASE - 1)
+        low_end = low + block_end - num + 1
+
+        if high:
+            prefix = base62_encode(high, alphabet)
+
+            for pair in tables.pairs[low:low_end]:
+                yield prefix + pair
+        else:
+            for string in tables.short[low:low_end]:
+                yield string
+
+        num = block_end + 1
+
+
+def format_range(start, end, alphabet=ALPHABET_PUUSH):
+    '''Return ``FIRST:LAST`` for a range of IDs, or the single ID'''
+    if start == end:
+        return base62_encode(start, alphabet)
+    else:
+        return '{}:{}'.format(base62_encode(start, alphabet),
+            base62_encode(end, alphabet))
+
+
+def parse_item_name(item_name):
+    '''Return ``(start_num, end_num, alphabet)`` of a tracker item name.
+
+    Ranges separated with a comma use the legacy alphabet and those
+    separated with a colon use the puush alphabet.
+    '''
+    if ',' in item_name:
+        start_name, end_name = item_name.split(',', 1)
+        alphabet = ALPHABET
+    elif ':' in item_name:
+        start_name, end_name = item_name.split(':', 1)
+        alphabet = ALPHABET_PUUSH
+    else:
+        start_name = item_name
+        end_name = item_name
+        alphabet = ALPHABET_PUUSH
+
+    return (base62_decode(start_name, alphabet),
+        base62_decode(end_name, alphabet), alphabet)
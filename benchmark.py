@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+'''Micro-benchmarks for the pipeline helpers'''
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import time
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    sub_parsers = arg_parser.add_subparsers(title='Command',
+        dest='command')
+
+    popen_arg_parser = sub_parsers.add_parser('popen',
+        help='Compare polling and the ChildWatcher for process exits')
+    popen_arg_parser.add_argument('--count', type=int, default=40,
+        help='Number of short processes to run one after another')
+    popen_arg_parser.add_argument('--idle-processes', type=int, default=20,
+        help='Number of long processes to wait on at once')
+    popen_arg_parser.add_argument('--idle-seconds', type=float, default=5.0,
+        help='How long the long processes run')
+    popen_arg_parser.set_defaults(func=popen_command)
+
+    base62_arg_parser = sub_parsers.add_parser('base62',
+        help='Compare the base62 module with the original functions')
+    base62_arg_parser.add_argument('--count', type=int, default=1000000,
+        help='Number of IDs to encode and decode')
+    base62_arg_parser.add_argument('--start', type=int, default=62 ** 4,
+        help='The first ID')
+    base62_arg_parser.set_defaults(func=base62_command)
+
+    args = arg_parser.parse_args()
+    args.func(args)
+
+
+def popen_command(args):
+    from tornado.ioloop import IOLoop, PeriodicCallback
+    from child_watcher import ChildWatcher
+
+    io_loop = IOLoop.instance()
+
+    def watch_by_polling(popen, callback):
+        def check():
+            if popen.poll() is not None:
+                wait_callback.stop()
+                callback(popen.returncode)
+
+        wait_callback = PeriodicCallback(check, 250)
+        wait_callback.start()
+
+    def watch_by_signal(popen, callback):
+        ChildWatcher.instance().watch(popen, callback)
+
+    def run_sequential(watch):
+        latencies = []
+
+        def start():
+            if len(latencies) == args.count:
+                io_loop.stop()
+                return
+
+            start_time = time.time()
+            popen = subprocess.Popen(['true'])
+            watch(popen, lambda returncode: on_end(start_time))
+
+        def on_end(start_time):
+            latencies.append(time.time() - start_time)
+            start()
+
+        io_loop.add_callback(start)
+        io_loop.start()
+
+        return sum(latencies) / len(latencies)
+
+    def run_idle(watch):
+        remaining = [args.idle_processes]
+
+        def on_end(returncode):
+            remaining[0] -= 1
+
+            if not remaining[0]:
+                io_loop.stop()
+
+        def start():
+            for dummy in xrange(args.idle_processes):
+                popen = subprocess.Popen(['sleep', str(args.idle_seconds)])
+                watch(popen, on_end)
+
+        start_times = os.times()
+        io_loop.add_callback(start)
+        io_loop.start()
+        end_times = os.times()
+
+        return (end_times[0] - start_times[0]) + \
+            (end_times[1] - start_times[1])
+
+    print('{0:<10} {1:>22} {2:>22}'.format('', 'per process latency',
+        'CPU while idle'))
+
+    for name, watch in (('polling', watch_by_polling),
+    ('signal', watch_by_signal)):
+        latency = run_sequential(watch)
+        cpu_seconds = run_idle(watch)
+        print('{0:<10} {1:>19.1f} ms {2:>19.1f} ms'.format(name,
+            latency * 1000, cpu_seconds * 1000))
+
+
+# The functions that were copied into pipeline.py and
+# decentralized_puush_grab.py before the base62 module
+def original_base62_encode(num, alphabet):
+    if (num == 0):
+        return alphabet[0]
+    arr = []
+    base = len(alphabet)
+    while num:
+        rem = num % base
+        num = num // base
+        arr.append(alphabet[rem])
+    arr.reverse()
+    return ''.join(arr)
+
+
+def original_base62_decode(string, alphabet):
+    base = len(alphabet)
+    strlen = len(string)
+    num = 0
+
+    idx = 0
+    for char in string:
+        power = (strlen - (idx + 1))
+        num += alphabet.index(char) * (base ** power)
+        idx += 1
+
+    return num
+
+
+def base62_command(args):
+    import base62
+
+    alphabet = base62.ALPHABET_PUUSH
+    start = args.start
+    end = args.start + args.count - 1
+
+    def timed(function):
+        start_time = time.time()
+        result = function()
+        return time.time() - start_time, result
+
+    original_time, original_names = timed(lambda: [
+        original_base62_encode(num, alphabet)
+        for num in xrange(start, end + 1)])
+    encode_time, names = timed(lambda: [
+        base62.base62_encode(num, alphabet)
+        for num in xrange(start, end + 1)])
+    range_time, range_names = timed(lambda: list(
+        base62.encode_range(start, end, alphabet)))
+
+    assert names == original_names
+    assert range_names == original_names
+
+    original_decode_time, original_nums = timed(lambda: [
+        original_base62_decode(name, alphabet) for name in names])
+    decode_time, nums = timed(lambda: [
+        base62.base62_decode(name, alphabet) for name in names])
+
+    assert nums == original_nums
+
+    print('{0:<24} {1:>12} {2:>14}'.format('', 'seconds', 'IDs per second'))
+
+    for name, seconds in (
+    ('original encode', original_time),
+    ('base62_encode', encode_time),
+    ('encode_range', range_time),
+    ('original decode', original_decode_time),
+    ('base62_decode', decode_time)):
+        print('{0:<24} {1:>12.3f} {2:>14.0f}'.format(name, seconds,
+            args.count / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+'''Notices child process exits on the Tornado IOLoop without polling'''
+import errno
+import fcntl
+import os
+import signal
+
+from tornado.ioloop import IOLoop
+
+
+class ChildWatcher(object):
+    '''Calls a callback with the return code when a child process exits.
+
+    A SIGCHLD handler writes to a pipe that the IOLoop listens on, so an
+    exit is handled on the next loop iteration instead of at the next
+    poll. Use :meth:`instance` to get the one watcher of the process.
+    '''
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if not cls._instance:
+            cls._instance = cls(IOLoop.instance())
+
+        return cls._instance
+
+    def __init__(self, io_loop):
+        self.io_loop = io_loop
+        self.watched = {}
+        self.read_fd, self.write_fd = os.pipe()
+
+        for fd in (self.read_fd, self.write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+        self.io_loop.add_handler(self.read_fd, self._on_wakeup,
+            self.io_loop.READ)
+
+        signal.signal(signal.SIGCHLD, self._on_signal)
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    def watch(self, popen, callback):
+        '''Call ``callback(returncode)`` once the Popen process has exited'''
+        self.watched[popen.pid] = (popen, callback)
+
+        # the child may have exited before it was watched
+        self.io_loop.add_callback(self._check_children)
+
+    def _on_signal(self, signum, frame):
+        try:
+            os.write(self.write_fd, 'x')
+        except OSError as error:
+            # a full pipe already means a wakeup is pending
+            if error.errno != errno.EAGAIN:
+                raise
+
+    def _on_wakeup(self, fd, events):
+        try:
+            while os.read(fd, 4096):
+                pass
+        except OSError as error:
+            if error.errno != errno.EAGAIN:
+                raise
+
+        self._check_children()
+
+    def _check_children(self):
+        for pid, (popen, callback) in list(self.watched.items()):
+            # Popen.poll reaps only its own child so other users of
+            # subprocess are not disturbed
+            if popen.poll() is not None:
+                del self.watched[pid]
+                callback(popen.returncode)
@@ -2,8 +2,18 @@
 '''Export data out of the redis database'''
 from __future__ import print_function
 
+import Queue
 import argparse
+import contextlib
+import functools
+import gzip
+import io
+import itertools
 import json
+import multiprocessing
+import os
+import sys
+import threading
 try:
     import redis
 except ImportError:
@@ -11,8 +21,27 @@ except ImportError:
     warnings.warn('The optional redis module was not found.')
 
 
-from decentralized_puush_grab import (base62_decode, base62_encode, ALPHABET,
-    ALPHABET_PUUSH)
+from base62 import (base62_decode, encode_range, format_range,
+    parse_item_name, ALPHABET_PUUSH)
+from intervals import (intervals_from_numbers, merge_intervals,
+    split_interval, subtract_intervals)
+from item_name_gen import generate_item_names
+import id_state
+import outcome_index
+import tracker_log
+
+
+# Number of lines written to stdout at once
+OUTPUT_BATCH_SIZE = 10000
+
+# Number of intervals collected before they are merged
+MERGE_BATCH_SIZE = 100000
+
+# Number of log entries fetched at once
+LOG_FETCH_SIZE = 10000
+
+# Size of the pieces of an archived log handed to each worker process
+LOG_RANGE_SIZE = 8 * 1024 * 1024
 
 
 def main():
@@ -28,7 +57,17 @@ def main():
         default=0, type=int)
 
     done_arg_parser = sub_parsers.add_parser('done',
-        help='Dump out done items')
+        help='Dump out done items. The IDs are read with SSCAN, which can '
+        'return an item more than once, so an ID may be printed more than '
+        'once; use --ranges or --state-file for each ID once')
+    done_arg_parser.add_argument('--state-file',
+        help='Record the done items in this ID state file instead of '
+        'printing them')
+    done_arg_parser.add_argument('--ranges', action='store_true',
+        help='Print sorted runs of IDs as FIRST:LAST lines (Puush '
+        'alphabet) instead of one ID per line')
+    done_arg_parser.add_argument('--batch-size', type=int, default=1000,
+        help='Number of items to ask the server for at once')
     done_arg_parser.add_argument('project', help='Name of the project')
     done_arg_parser.set_defaults(func=done_command)
 
@@ -36,7 +75,11 @@ def main():
         help='Dump out log with privacy')
     log_arg_parser.add_argument('--scrub-username', action='store_true',
         help='Scrub out the usernames as well')
+    log_arg_parser.add_argument('--state-file',
+        help='Also record the wget exit status of each ID in this ID state '
+        'file')
     log_arg_parser.add_argument('project', help='Name of the project')
+    add_log_output_arguments(log_arg_parser)
     log_arg_parser.set_defaults(func=log_command)
 
     archived_log_arg_parser = sub_parsers.add_parser('archivedlog',
@@ -46,80 +89,394 @@ def main():
         help='Scrub out the usernames as well')
     archived_log_arg_parser.add_argument('log_file',
         help='Path of log file')
+    add_log_output_arguments(archived_log_arg_parser)
     archived_log_arg_parser.set_defaults(func=archived_log_command)
 
+    gaps_arg_parser = sub_parsers.add_parser('gaps',
+        help='Print item names for the IDs of a range that are not done')
+    gaps_arg_parser.add_argument('--range', type=int, default=1,
+        help='Number of IDs in each item name')
+    gaps_arg_parser.add_argument('--batch-size', type=int, default=1000,
+        help='Number of items to ask the server for at once')
+    gaps_arg_parser.add_argument('project', help='Name of the project')
+    gaps_arg_parser.add_argument('start', help='First ID name of the range '
+        '(Puush alphabet)')
+    gaps_arg_parser.add_argument('end', help='Last ID name of the range '
+        '(Puush alphabet)')
+    gaps_arg_parser.set_defaults(func=gaps_command)
+
+    index_arg_parser = sub_parsers.add_parser('index',
+        help='Build an outcome index from exported logs')
+    index_arg_parser.add_argument('index_dir',
+        help='Path of the index directory to write')
+    index_arg_parser.add_argument('log_file', nargs='+',
+        help='Path of a log written by the log or archivedlog command '
+        '(optionally gzipped)')
+    index_arg_parser.set_defaults(func=index_command)
+
+    query_arg_parser = sub_parsers.add_parser('query',
+        help='Query an outcome index')
+    query_arg_parser.add_argument('index_dir',
+        help='Path of the index directory')
+    query_arg_parser.add_argument('--start', default='0',
+        help='First ID name (Puush alphabet)')
+    query_arg_parser.add_argument('--end',
+        help='Last ID name (Puush alphabet)')
+    query_arg_parser.add_argument('--status', type=int, action='append',
+        help='Only results with this wget exit status. Can be given more '
+        'than once')
+    query_arg_parser.add_argument('--since',
+        help='Only results logged at or after this UTC time '
+        '(YYYY-MM-DD[THH:MM:SS])')
+    query_arg_parser.add_argument('--until',
+        help='Only results logged before this UTC time')
+    query_arg_parser.add_argument('--summary', action='store_true',
+        help='Print the number of results by status and the bytes instead '
+        'of the results')
+    query_arg_parser.add_argument('--ranges', action='store_true',
+        help='Print the matching IDs as FIRST:LAST runs instead of the '
+        'results')
+    query_arg_parser.set_defaults(func=query_command)
+
     args = arg_parser.parse_args()
     args.func(args)
 
 
+def add_log_output_arguments(arg_parser):
+    arg_parser.add_argument('--jobs', type=int, default=1,
+        help='Number of worker processes that scrub the entries')
+    arg_parser.add_argument('--output',
+        help='Write to this file instead of stdout. It is gzip compressed '
+        'if the name ends with .gz')
+    arg_parser.add_argument('--gzip', action='store_true',
+        help='Compress the output with gzip')
+
+
 def get_redis_connection(args):
     return redis.StrictRedis(host=args.host, port=args.port, db=args.db)
 
 
 def get_expanded_item_name(item_name):
-    if ',' in item_name:
-        alphabet = ALPHABET
-        start_item, end_item = item_name.split(',', 1)
-    elif ':' in item_name:
-        alphabet = ALPHABET_PUUSH
-        start_item, end_item = item_name.split(':', 1)
-    else:
-        start_item = item_name
-        end_item = item_name
-        alphabet = ALPHABET_PUUSH
+    start_num, end_num, alphabet = parse_item_name(item_name)
+
+    return encode_range(start_num, end_num, alphabet)
+
+
+def iter_set_members(r, key, batch_size=1000):
+    '''Yield the members of a set with SSCAN.
+
+    The next batch is fetched in a thread while the current one is being
+    processed. SSCAN may return a member more than once, and so may this.
+    '''
+    batches = Queue.Queue(maxsize=2)
+
+    def fetch():
+        try:
+            cursor = 0
+
+            while True:
+                cursor, members = r.sscan(key, cursor, count=batch_size)
+                batches.put(members)
+
+                if not int(cursor):
+                    break
+        except Exception as error:
+            batches.put(error)
+        else:
+            batches.put(None)
+
+    thread = threading.Thread(target=fetch)
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        batch = batches.get()
+
+        if batch is None:
+            break
+        elif isinstance(batch, Exception):
+            raise batch
+
+        for member in batch:
+            yield member
+
+
+def get_item_intervals(item_name):
+    '''Return the intervals of the IDs of an item, numbered with the Puush
+    alphabet'''
+    start_num, end_num, alphabet = parse_item_name(item_name)
+
+    if alphabet == ALPHABET_PUUSH:
+        return [(start_num, end_num)]
 
-    start_num = base62_decode(start_item, alphabet)
-    end_num = base62_decode(end_item, alphabet)
+    return intervals_from_numbers(sorted(
+        base62_decode(name, ALPHABET_PUUSH)
+        for name in encode_range(start_num, end_num, alphabet)))
+
+
+def write_lines(lines):
+    while True:
+        batch = list(itertools.islice(lines, OUTPUT_BATCH_SIZE))
+
+        if not batch:
+            break
 
-    for num in xrange(start_num, end_num + 1):
-        yield base62_encode(num, alphabet)
+        sys.stdout.write('\n'.join(batch))
+        sys.stdout.write('\n')
 
 
 def done_command(args):
     r = get_redis_connection(args)
+    # Remembering the items to drop the repeats of SSCAN would take memory
+    # for the whole set, so the plain output may repeat IDs
+    items = iter_set_members(r, '%s:done' % args.project, args.batch_size)
+
+    if args.state_file:
+        with id_state.IDStateMap(args.state_file) as state_map:
+            for item in items:
+                # Keep the more specific states recorded from the log
+                state_map.record_item_name(item, id_state.DONE,
+                    overwrite=False)
+
+        return
+
+    if args.ranges:
+        intervals = get_done_intervals(items)
+        write_lines(format_range(start, end) for start, end in intervals)
+    else:
+        write_lines(itertools.chain.from_iterable(
+            get_expanded_item_name(item) for item in items))
+
+
+def get_done_intervals(items):
+    '''Return the merged intervals of the IDs of item names'''
+    intervals = []
+    merge_size = MERGE_BATCH_SIZE
+
+    for item in items:
+        intervals.extend(get_item_intervals(item))
+
+        if len(intervals) >= merge_size:
+            intervals = merge_intervals(intervals)
+            merge_size = max(MERGE_BATCH_SIZE, len(intervals) * 2)
+
+    return merge_intervals(intervals)
+
+
+def gaps_command(args):
+    if not 1 <= args.range <= 100:
+        raise Exception("Range should be positive and not too large")
+
+    r = get_redis_connection(args)
+    done_intervals = get_done_intervals(
+        iter_set_members(r, '%s:done' % args.project, args.batch_size))
+    target = (base62_decode(args.start, ALPHABET_PUUSH),
+        base62_decode(args.end, ALPHABET_PUUSH))
 
-    for item in r.smembers('%s:done' % args.project):
-        for expanded_item_name in get_expanded_item_name(item):
-            print(expanded_item_name)
+    if args.range == 1:
+        split = None
+    else:
+        split = functools.partial(split_interval, size=args.range)
+
+    write_lines(generate_item_names(
+        subtract_intervals([target], done_intervals),
+        split, ALPHABET_PUUSH, ':'))
+
+
+def use_gzip(args):
+    return bool(args.gzip or (args.output and args.output.endswith('.gz')))
+
+
+@contextlib.contextmanager
+def open_output(args):
+    '''Yield the output file.
+
+    Compressed output is written as one gzip member per chunk, which the
+    workers compress themselves; the members together are a valid gzip
+    file.
+    '''
+    if args.output:
+        with open(args.output, 'wb') as f:
+            yield f
+    else:
+        yield sys.stdout
+
+
+def compress_text(text):
+    '''Return the text as a gzip member'''
+    buffer = io.BytesIO()
+
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as gzip_file:
+        gzip_file.write(text)
+
+    return buffer.getvalue()
+
+
+@contextlib.contextmanager
+def worker_map(jobs):
+    '''Yield a function like itertools.imap that uses `jobs` processes'''
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+
+        try:
+            yield pool.imap
+        finally:
+            pool.terminate()
+    else:
+        yield itertools.imap
+
+
+def scrub_entry(line, scrub_username):
+    doc = json.loads(line)
+    doc['ip'] = '<scrubbed>'
+    id_doc = json.loads(doc['id'])
+    doc['id'] = id_doc
+
+    if scrub_username:
+        doc['by'] = '<scrubbed>'
+
+    return doc
+
+
+def scrub_entries(task):
+    '''Return the scrubbed text and the wget exit statuses of log
+    entries'''
+    lines, scrub_username, compress = task
+    texts = []
+    statuses = []
+
+    for line in lines:
+        doc = scrub_entry(line, scrub_username)
+        texts.append(json.dumps(doc))
+        statuses.append(tracker_log.exit_statuses(doc))
+
+    texts.append('')
+    text = '\n'.join(texts)
+
+    if compress:
+        text = compress_text(text)
+
+    return text, statuses
+
+
+def scrub_file_range(task):
+    '''Return the scrubbed text of the lines that start between two
+    offsets of a file'''
+    path, start, end, scrub_username, compress = task
+    texts = []
+
+    with open(path, 'rb') as f:
+        if start:
+            # Skip the line that started in the previous range
+            f.seek(start - 1)
+            f.readline()
+
+        while f.tell() < end:
+            line = f.readline()
+
+            if not line:
+                break
+
+            texts.append(json.dumps(scrub_entry(line, scrub_username)))
+
+    texts.append('')
+    text = '\n'.join(texts)
+
+    if compress:
+        text = compress_text(text)
+
+    return text
 
 
 def log_command(args):
     r = get_redis_connection(args)
-    fetch_size = 10000
-    i = 0
 
-    while True:
-        l = r.lrange('%s:log' % args.project, i, i + fetch_size - 1)
+    if args.state_file:
+        state_map = id_state.IDStateMap(args.state_file)
+    else:
+        state_map = None
 
-        if not l:
-            break
+    def iter_pages():
+        i = 0
 
-        for item in l:
-            doc = json.loads(item)
-            doc['ip'] = '<scrubbed>'
-            id_doc = json.loads(doc['id'])
-            doc['id'] = id_doc
+        while True:
+            l = r.lrange('%s:log' % args.project, i, i + LOG_FETCH_SIZE - 1)
 
-            if args.scrub_username:
-                doc['by'] = '<scrubbed>'
+            if not l:
+                break
 
-            print(json.dumps(doc))
+            yield l, args.scrub_username, use_gzip(args)
+            i += LOG_FETCH_SIZE
 
-        i += fetch_size
+    with open_output(args) as f, worker_map(args.jobs) as imap:
+        for text, statuses in imap(scrub_entries, iter_pages()):
+            f.write(text)
 
+            if state_map:
+                for exit_statuses in statuses:
+                    state_map.record_exit_statuses(exit_statuses)
 
-def archived_log_command(args):
-    with open(args.log_file, 'rt') as f:
-        for item in f:
-            doc = json.loads(item)
-            doc['ip'] = '<scrubbed>'
-            id_doc = json.loads(doc['id'])
-            doc['id'] = id_doc
+    if state_map:
+        state_map.close()
 
-            if args.scrub_username:
-                doc['by'] = '<scrubbed>'
 
-            print(json.dumps(doc))
+def archived_log_command(args):
+    file_size = os.path.getsize(args.log_file)
+    tasks = ((args.log_file, start, min(file_size, start + LOG_RANGE_SIZE),
+        args.scrub_username, use_gzip(args))
+        for start in xrange(0, file_size, LOG_RANGE_SIZE))
+
+    with open_output(args) as f, worker_map(args.jobs) as imap:
+        for text in imap(scrub_file_range, tasks):
+            f.write(text)
+
+
+def index_command(args):
+    outcome_index.build_index(args.log_file, args.index_dir)
+
+
+def query_command(args):
+    start_id = base62_decode(args.start, ALPHABET_PUUSH)
+    end_id = base62_decode(args.end, ALPHABET_PUUSH) if args.end \
+        else 2 ** 63
+    since = outcome_index.parse_time(args.since) if args.since else None
+    until = outcome_index.parse_time(args.until) if args.until else None
+
+    with outcome_index.OutcomeIndex(args.index_dir) as index:
+        if args.summary and not (args.status or since or until):
+            summary = index.summary(start_id, end_id)
+            print(json.dumps(summary, sort_keys=True))
+            return
+
+        rows = index.iter_rows(start_id, end_id, statuses=args.status,
+            since=since, until=until)
+
+        if args.summary:
+            summary = {'rows': 0, 'statuses': {}, 'bytes': 0.0}
+
+            for row in rows:
+                status = outcome_index.status_class(row['status'])
+                summary['rows'] += 1
+                summary['statuses'][status] = \
+                    summary['statuses'].get(status, 0) + 1
+                summary['bytes'] += row['bytes']
+
+            print(json.dumps(summary, sort_keys=True))
+        elif args.ranges:
+            intervals = intervals_from_numbers(row['id'] for row in rows)
+            write_lines(format_range(start, end) for start, end in intervals)
+        else:
+            write_lines(
+                '\t'.join((
+                    format_range(row['id'], row['id']),
+                    str(row['status']),
+                    '%d' % row['bytes'],
+                    row['downloader'],
+                    outcome_index.format_time(row['time']),
+                    row['item'],
+                ))
+                for row in rows
+            )
 
 
 if __name__ == '__main__':
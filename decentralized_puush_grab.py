@@ -8,6 +8,11 @@ import os
 import random
 import shutil
 import logging
+import threading
+
+from base62 import base62_decode, base62_encode
+from report_store import ReportStore
+from sampler import PermutationSampler
 
 
 _logger = logging.getLogger(__name__)
@@ -25,67 +30,26 @@ USER_RESULT_MSG = {
     EXIT_STATUS_OTHER_ERROR: 'Other error',
 }
 
-# Be careful! Some implementations have the ordering of upper and lower case
-# differently
-ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
-ALPHABET_PUUSH = '0123456789abcdefghijklmnopqrstuvwxyz' \
-    'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-assert ALPHABET != ALPHABET_PUUSH
-assert len(ALPHABET) == 62
-assert len(ALPHABET_PUUSH) == 62
-
-
-# http://stackoverflow.com/a/1119769/1524507
-def base62_encode(num, alphabet=ALPHABET):
-    """Encode a number in Base X
-
-    `num`: The number to encode
-    `alphabet`: The alphabet to use for encoding
-    """
-    if (num == 0):
-        return alphabet[0]
-    arr = []
-    base = len(alphabet)
-    while num:
-        rem = num % base
-        num = num // base
-        arr.append(alphabet[rem])
-    arr.reverse()
-    return ''.join(arr)
-
-
-def base62_decode(string, alphabet=ALPHABET):
-    """Decode a Base X encoded string into the number
-
-    Arguments:
-    - `string`: The encoded string
-    - `alphabet`: The alphabet to use for encoding
-    """
-    base = len(alphabet)
-    strlen = len(string)
-    num = 0
-
-    idx = 0
-    for char in string:
-        power = (strlen - (idx + 1))
-        num += alphabet.index(char) * (base ** power)
-        idx += 1
-
-    return num
-
-
 class Grabber(object):
-    def __init__(self, min_delay, single_id=None):
+    def __init__(self, min_delay, single_id=None, workers=1, seed=None,
+    checkpoint_path='sampler-checkpoint.json', node_index=0, node_count=1,
+    segment_size=64 * 1024 * 1024):
         self._max_int = base62_decode('40000')
         self._single_id = single_id
+        self._sampler = PermutationSampler(self._max_int + 1, seed=seed,
+            node_index=node_index, node_count=node_count,
+            checkpoint_path=checkpoint_path)
         self._min_delay = min_delay
+        self._workers = workers
         self._seconds_throttle = 1.0
         self._start_time = time.time()
         self._data_dir = os.path.abspath('data')
-        self._report_dir = os.path.abspath('report')
-        self._wget_dir = os.path.abspath('wget-temp-{}'.format(os.getpid()))
+        self._report_store = ReportStore(os.path.abspath('report'),
+            segment_size)
         self._next_time = 0
         self._running = True
+        # Guards the throttle state shared by the workers
+        self._lock = threading.Lock()
 
         self._run()
 
@@ -93,127 +57,183 @@ class Grabber(object):
         _logger.debug('Running with delay at {} seconds'.format(
             self._min_delay))
 
+        if self._workers > 1 and not self._single_id:
+            threads = [
+                threading.Thread(target=self._work, args=(worker_index,))
+                for worker_index in range(self._workers)
+            ]
+
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(1)
+        else:
+            self._work(0)
+
+        _logger.debug('Stopping')
+
+    def _work(self, worker_index):
+        if self._workers > 1:
+            wget_dir = os.path.abspath('wget-temp-{}-{}'.format(os.getpid(),
+                worker_index))
+        else:
+            wget_dir = os.path.abspath('wget-temp-{}'.format(os.getpid()))
+
         while self._running:
-            self._do_job()
+            if not self._single_id and not self._wait_for_turn():
+                break
+
+            self._do_job(wget_dir)
 
             if self._single_id:
                 break
 
-            while time.time() < self._next_time:
-                if os.path.exists('STOP') \
-                and os.path.getmtime('STOP') > self._start_time:
-                    self._running = False
-                    break
+    def _wait_for_turn(self):
+        '''Wait until the next download may start.
 
-                time.sleep(2)
+        Each download takes the next start time for itself and moves it on
+        by the current delay, so the downloads of all workers together start
+        no more often than the delay allows. Returns False when stopping.
+        '''
+        with self._lock:
+            start_time = max(time.time(), self._next_time)
+            self._next_time = start_time + self._get_delay()
 
-        _logger.debug('Stopping')
+        while True:
+            # time.sleep rejects a negative time, so the time left is read
+            # once and checked before sleeping
+            time_left = start_time - time.time()
+
+            if time_left <= 0:
+                break
+
+            if os.path.exists('STOP') \
+            and os.path.getmtime('STOP') > self._start_time:
+                self._running = False
+
+            if not self._running:
+                return False
+
+            time.sleep(min(2, time_left))
+
+        return self._running
 
-    def _do_job(self):
+    def _do_job(self, wget_dir):
         if self._single_id:
             item_num = self._single_id
         else:
-            item_num = random.randint(0, self._max_int)
+            with self._lock:
+                try:
+                    item_num = self._sampler.next()
+                except StopIteration:
+                    _logger.info('Every item was tried')
+                    self._running = False
+                    return
         item_name = base62_encode(item_num)
 
         _logger.info('Starting fetch for item {} ({})'.format(item_name,
             item_num))
 
-        if not os.path.exists(self._wget_dir):
-            _logger.debug('Creating dir in {}'.format(self._wget_dir))
-            os.makedirs(self._wget_dir)
+        if not os.path.exists(wget_dir):
+            _logger.debug('Creating dir in {}'.format(wget_dir))
+            os.makedirs(wget_dir)
 
-        return_code = self._run_wget(item_name)
+        return_code, warc_name = self._run_wget(item_name, wget_dir)
 
         _logger.debug('wget return code {}'.format(return_code))
 
-        if not os.path.exists(self._data_dir):
-            os.makedirs(self._data_dir)
-
-        if not os.path.exists(self._report_dir):
-            os.makedirs(self._report_dir)
+        with self._lock:
+            if not os.path.exists(self._data_dir):
+                os.makedirs(self._data_dir)
 
-        self._save_report(item_name)
+        self._save_report(item_name, wget_dir)
 
         if return_code not in [0]:
             _logger.info('Failed ({}: {})'.format(return_code,
                 USER_RESULT_MSG.get(return_code)))
             self._throttle(True)
         else:
-            self._move_files(item_name)
+            self._move_files(wget_dir, warc_name)
             _logger.info('OK')
             self._throttle(False)
 
-        shutil.rmtree(self._wget_dir)
+        shutil.rmtree(wget_dir)
 
-    def _run_wget(self, item_name):
+    def _run_wget(self, item_name, wget_dir):
         env = os.environ.copy()
         if 'PATH' not in env:
             env['PATH'] = ''
 
         env['PATH'] += ':.:../:'
-        self._warc_name = 'puush-{}-{}'.format(item_name, int(time.time()))
+        warc_name = 'puush-{}-{}'.format(item_name, int(time.time()))
 
-        _logger.debug('Running wget with warc name {}'.format(self._warc_name))
+        _logger.debug('Running wget with warc name {}'.format(warc_name))
 
         command_args = ['wget-lua',
             "-U", USER_AGENT,
             "-nv",
-            "-o", '{}/wget.log'.format(self._wget_dir),
+            "-o", '{}/wget.log'.format(wget_dir),
             "--lua-script", "puush.lua",
             "--no-check-certificate",
-            "--output-document", '{}/wget.tmp'.format(self._wget_dir),
+            "--output-document", '{}/wget.tmp'.format(wget_dir),
             "--truncate-output",
             "-e", "robots=off",
             "--rotate-dns",
             "--timeout", "60",
             "--tries", "20",
             "--waitretry", "5",
-            "--warc-file", "{}/{}".format(self._wget_dir, self._warc_name),
+            "--warc-file", "{}/{}".format(wget_dir, warc_name),
             "--warc-header", "operator: Archive Team",
             "--warc-header",
                 "decentralized-puush-dld-script-version: {}".format(VERSION),
             "http://puu.sh/{}".format(item_name)
         ]
 
-        return subprocess.call(command_args, env=env)
+        return subprocess.call(command_args, env=env), warc_name
 
-    def _move_files(self, item_name):
+    def _move_files(self, wget_dir, warc_name):
         _logger.debug('Move files')
 
-        source = "{}/{}.warc.gz".format(self._wget_dir, self._warc_name)
-        dest = "{}/{}.warc.gz".format(self._data_dir, self._warc_name)
+        source = "{}/{}.warc.gz".format(wget_dir, warc_name)
+        dest = "{}/{}.warc.gz".format(self._data_dir, warc_name)
 
         if os.path.exists(source):
             os.rename(source, dest)
         else:
             _logger.debug('Warc does not exist')
 
-    def _save_report(self, item_name):
+    def _save_report(self, item_name, wget_dir):
         _logger.debug('Saving report')
 
-        source = "{}/wget.log".format(self._wget_dir)
-        dest = "{}/wget-{}-{}.log".format(self._report_dir, int(time.time()),
-            item_name)
+        source = "{}/wget.log".format(wget_dir)
 
         if os.path.exists(source):
-            os.rename(source, dest)
+            with open(source, 'rb') as f:
+                self._report_store.add(item_name, time.time(), f.read())
         else:
             _logger.debug('Log does not exist')
 
+    def _get_delay(self):
+        delay_time = self._min_delay + self._seconds_throttle
+        return delay_time * random.uniform(0.8, 1.2)
+
     def _throttle(self, is_bad):
-        if is_bad:
-            self._seconds_throttle *= 2.0
-            self._seconds_throttle = min(3600.0, self._seconds_throttle)
-        else:
-            self._seconds_throttle = 1.0
+        with self._lock:
+            if is_bad:
+                self._seconds_throttle *= 2.0
+                self._seconds_throttle = min(3600.0, self._seconds_throttle)
+            else:
+                self._seconds_throttle = 1.0
 
-        delay_time = self._min_delay + self._seconds_throttle
-        delay_time *= random.uniform(0.8, 1.2)
+            delay_time = self._get_delay()
 
-        _logger.info('Next download in {:.1f} seconds'.format(delay_time))
+            _logger.info('Next download in {:.1f} seconds'.format(
+                delay_time))
 
-        self._next_time = time.time() + delay_time
+            self._next_time = max(self._next_time, time.time() + delay_time)
 
 
 if __name__ == '__main__':
@@ -223,5 +243,24 @@ if __name__ == '__main__':
         help=u'Minimum time in seconds between requests')
     arg_parser.add_argument(u'--single', type=int,
         help=u'Base 10 id. Instead of grabbing random items, use given number')
+    arg_parser.add_argument(u'--workers', type=int, default=1,
+        help=u'Number of downloads to run at the same time. Their starts '
+        'are still spaced by the delay')
+    arg_parser.add_argument(u'--seed',
+        help=u'Key of the random order of the items. Defaults to the one '
+        'in the checkpoint file, or a random one')
+    arg_parser.add_argument(u'--checkpoint', default='sampler-checkpoint.json',
+        help=u'File that keeps the position in the random order of the '
+        'items, so that a restart does not repeat them')
+    arg_parser.add_argument(u'--node-index', type=int, default=0,
+        help=u'Which part of the items to grab, from 0 to NODE_COUNT - 1')
+    arg_parser.add_argument(u'--node-count', type=int, default=1,
+        help=u'Number of people splitting the items with the same seed')
+    arg_parser.add_argument(u'--segment-size', type=int,
+        default=64 * 1024 * 1024,
+        help=u'Size in bytes at which a new report segment file is started')
     args = arg_parser.parse_args()
-    Grabber(args.delay, single_id=args.single)
+    Grabber(args.delay, single_id=args.single, workers=args.workers,
+        seed=args.seed, checkpoint_path=args.checkpoint,
+        node_index=args.node_index, node_count=args.node_count,
+        segment_size=args.segment_size)
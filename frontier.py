@@ -0,0 +1,152 @@
+'''Finds the newest puush ID by probing the site'''
+import httplib
+import logging
+import threading
+import time
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+from base62 import base62_encode, ALPHABET_PUUSH
+
+
+_logger = logging.getLogger(__name__)
+
+# Permission denied still means that the ID was given out
+EXISTING_STATUSES = (200, 403)
+
+# Rate limiting; like server errors, the ID is checked again later
+RATE_LIMIT_STATUSES = (420, 429)
+
+
+class ProbeError(Exception):
+    '''An ID could not be checked'''
+
+
+class FrontierProber(object):
+    '''Finds the highest ID in use with HEAD requests.
+
+    IDs are deleted or never given out, so a position counts as in use if
+    any of the `width` IDs starting at it exists. The search first doubles
+    its step from a known ID until it finds a position not in use and then
+    narrows the gap with a binary search. The IDs of a position are checked
+    at the same time over `concurrency` kept alive connections.
+
+    Connection errors, server errors and rate limiting are not taken as
+    a missing ID. The ID is checked up to `tries` times, waiting twice as
+    long each time starting from `retry_delay` seconds, and ProbeError is
+    raised if it still has no answer.
+    '''
+    def __init__(self, base_url='http://puu.sh', width=20, concurrency=10,
+    timeout=30, initial_step=64, tries=5, retry_delay=1.0):
+        url_info = urlparse.urlparse(base_url)
+        self.scheme = url_info.scheme
+        self.netloc = url_info.netloc
+        self.path = url_info.path.rstrip('/')
+        self.width = width
+        self.timeout = timeout
+        self.initial_step = initial_step
+        self.tries = tries
+        self.retry_delay = retry_delay
+        self.pool = ThreadPool(concurrency)
+        self.local = threading.local()
+        self.connections = []
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+        for connection in self.connections:
+            connection.close()
+
+    def _get_connection(self):
+        if not getattr(self.local, 'connection', None):
+            if self.scheme == 'https':
+                connection_class = httplib.HTTPSConnection
+            else:
+                connection_class = httplib.HTTPConnection
+
+            self.local.connection = connection_class(self.netloc,
+                timeout=self.timeout)
+            self.connections.append(self.local.connection)
+
+        return self.local.connection
+
+    def get_status(self, num):
+        '''Return the HTTP status of an ID'''
+        id_name = base62_encode(num, ALPHABET_PUUSH)
+
+        for try_num in xrange(self.tries):
+            if try_num:
+                time.sleep(self.retry_delay * 2 ** (try_num - 1))
+
+            connection = self._get_connection()
+
+            try:
+                connection.request('HEAD', '%s/%s' % (self.path, id_name))
+                response = connection.getresponse()
+                response.read()
+            except (httplib.HTTPException, IOError):
+                # The kept alive connection may have been closed by the
+                # server; try again with a new one
+                _logger.debug('HEAD %s failed', id_name, exc_info=True)
+                connection.close()
+                self.local.connection = None
+                continue
+
+            _logger.debug('HEAD %s: %d', id_name, response.status)
+
+            if response.status >= 500 \
+            or response.status in RATE_LIMIT_STATUSES:
+                continue
+
+            return response.status
+
+        raise ProbeError('Could not check %s' % id_name)
+
+    def exists(self, num):
+        return self.get_status(num) in EXISTING_STATUSES
+
+    def find_in_window(self, num):
+        '''Return the existing IDs of the window starting at `num`'''
+        nums = range(num, num + self.width)
+        found = self.pool.map(self.exists, nums)
+
+        return [window_num for window_num, exists in zip(nums, found)
+            if exists]
+
+    def find_max(self, start):
+        '''Return the highest existing ID found searching up from `start`.
+
+        `start` should be an ID known to be in use, such as the highest ID
+        queued before.
+        '''
+        good = start
+        good_found = self.find_in_window(start) or [start]
+        step = self.initial_step
+
+        # Exponential search for a window without any existing ID
+        while True:
+            found = self.find_in_window(good + step)
+
+            if not found:
+                bad = good + step
+                break
+
+            good += step
+            good_found = found
+            step *= 2
+
+        _logger.debug('Frontier is between %d and %d', good, bad)
+
+        # Binary search between the last window in use and the empty one
+        while bad - good > 1:
+            middle = (good + bad) // 2
+            found = self.find_in_window(middle)
+
+            if found:
+                good = middle
+                good_found = found
+            else:
+                bad = middle
+
+        return max(good_found)
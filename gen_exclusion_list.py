@@ -2,21 +2,174 @@
 '''Generates a list of item names based from directory of warc files'''
 from __future__ import print_function
 import argparse
-import glob
-import os.path
+import itertools
+import multiprocessing
+import os
+import sys
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from base62 import base62_decode, encode_range, format_range, ALPHABET_PUUSH
+from intervals import intervals_from_numbers, merge_intervals
+import id_state
+
+
+# Number of lines written to stdout at once
+OUTPUT_BATCH_SIZE = 10000
+
+# Number of IDs collected before they are merged into intervals
+MERGE_BATCH_SIZE = 100000
 
 
 def main():
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('directory', help='The path of the directory',
         nargs='+')
+    arg_parser.add_argument('--recursive', action='store_true',
+        help='Also scan the subdirectories')
+    arg_parser.add_argument('--jobs', type=int, default=1,
+        help='Number of directories to scan at the same time in separate '
+        'processes')
+    arg_parser.add_argument('--ranges', action='store_true',
+        help='Print runs of consecutive item names as FIRST:LAST lines '
+        'instead of one item name per line')
+    arg_parser.add_argument('--state-file',
+        help='Also record the item names as done in this ID state file')
 
     args = arg_parser.parse_args()
 
-    for dir_path in args.directory:
-        for file_path in glob.glob(dir_path + '*.*'):
-            item_name = os.path.basename(file_path).split('-')[1]
-            print(item_name)
+    intervals = merge_intervals(scan_directories(args.directory,
+        args.recursive, args.jobs))
+
+    if args.state_file:
+        with id_state.IDStateMap(args.state_file) as state_map:
+            for start, end in intervals:
+                end = min(end, state_map.size - 1)
+
+                if start <= end:
+                    state_map.set_range(start, end, id_state.DONE)
+
+    if args.ranges:
+        lines = (format_range(start, end) for start, end in intervals)
+    else:
+        lines = itertools.chain.from_iterable(
+            encode_range(start, end, ALPHABET_PUUSH)
+            for start, end in intervals)
+
+    while True:
+        batch = list(itertools.islice(lines, OUTPUT_BATCH_SIZE))
+
+        if not batch:
+            break
+
+        sys.stdout.write('\n'.join(batch))
+        sys.stdout.write('\n')
+
+
+def scan_directories(dir_paths, recursive=False, jobs=1):
+    '''Return the intervals of the IDs found in the directories.
+
+    Each directory is scanned by one worker process. Subdirectories found
+    along the way are handed out to the workers as well.
+    '''
+    intervals = []
+
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        pending = [pool.apply_async(scan_directory, (dir_path, recursive))
+            for dir_path in dir_paths]
+
+        while pending:
+            dir_intervals, subdir_paths = pending.pop(0).get()
+            intervals.extend(dir_intervals)
+            pending.extend(
+                pool.apply_async(scan_directory, (subdir_path, recursive))
+                for subdir_path in subdir_paths)
+
+        pool.close()
+        pool.join()
+    else:
+        pending = list(dir_paths)
+
+        while pending:
+            dir_intervals, subdir_paths = scan_directory(pending.pop(0),
+                recursive)
+            intervals.extend(dir_intervals)
+            pending.extend(subdir_paths)
+
+    return intervals
+
+
+def scan_directory(dir_path, recursive=False):
+    '''Return the intervals of the IDs of the files in a directory and the
+    subdirectories to scan next.
+
+    Files are named ``PREFIX-ID-TIMESTAMP.warc.gz``. Files of consolidated
+    items are named ``PREFIX-FIRST_LAST-TIMESTAMP`` and their ``.idx`` file
+    lists every ID.
+    '''
+    intervals = []
+    nums = []
+    subdir_paths = []
+
+    for name, path, is_dir in iter_directory(dir_path):
+        if is_dir:
+            if recursive:
+                subdir_paths.append(path)
+
+            continue
+
+        if name.startswith('.') or '.' not in name or '-' not in name:
+            continue
+
+        item_name = name.split('-')[1]
+
+        if name.endswith('.idx'):
+            nums.extend(read_index_ids(path))
+        else:
+            nums.extend(decode_ids(item_name.split('_')))
+
+        if len(nums) >= MERGE_BATCH_SIZE:
+            intervals = merge_intervals(intervals
+                + intervals_from_numbers(sorted(nums)))
+            nums = []
+
+    intervals = merge_intervals(intervals
+        + intervals_from_numbers(sorted(nums)))
+
+    return intervals, subdir_paths
+
+
+def iter_directory(dir_path):
+    '''Yield ``(name, path, is_dir)`` for each entry of a directory'''
+    if scandir:
+        for entry in scandir(dir_path):
+            yield entry.name, entry.path, entry.is_dir()
+    else:
+        for name in os.listdir(dir_path):
+            path = os.path.join(dir_path, name)
+            yield name, path, os.path.isdir(path)
+
+
+def read_index_ids(path):
+    id_names = set()
+
+    with open(path, 'rt') as f:
+        for line in f:
+            id_names.add(line.split(' ', 1)[0])
+
+    return decode_ids(id_names)
+
+
+def decode_ids(id_names):
+    return [base62_decode(id_name, ALPHABET_PUUSH) for id_name in id_names
+        if id_name and all(char in ALPHABET_PUUSH for char in id_name)]
 
 
 if __name__ == '__main__':
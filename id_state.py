@@ -0,0 +1,305 @@
+'''A memory-mapped file of what is known about each puush ID
+
+Every ID gets two bits, so the whole 5 character ID space fits in about
+220 MB. The file is created sparse and only grows on disk where IDs are
+recorded.
+'''
+import contextlib
+import fcntl
+import mmap
+import os
+import re
+import struct
+
+import base62
+
+
+UNKNOWN = 0
+DONE = 1
+NOT_FOUND = 2
+PERMISSION_DENIED = 3
+
+STATE_NAMES = {
+    UNKNOWN: 'unknown',
+    DONE: 'done',
+    NOT_FOUND: 'not-found',
+    PERMISSION_DENIED: 'permission-denied',
+}
+
+# The wget exit statuses reported in the tracker log
+EXIT_STATUS_STATES = {
+    0: DONE,
+    100: PERMISSION_DENIED,
+    101: NOT_FOUND,
+}
+
+ID_SPACE_SIZE = 62 ** 5
+
+MAGIC = 'PUUSHIDS'
+HEADER_FORMAT = '<8sQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+IDS_PER_BYTE = 4
+CHUNK_SIZE = 1024 * 1024
+
+
+def _slot_state(byte, slot):
+    return (byte >> (slot * 2)) & 3
+
+
+def _full_byte(state):
+    return chr(state * 0x55)
+
+
+def _fill_table(state):
+    '''Translation table that sets the unknown slots of a byte to `state`'''
+    table = []
+
+    for byte in xrange(256):
+        for slot in xrange(IDS_PER_BYTE):
+            if not _slot_state(byte, slot):
+                byte |= state << (slot * 2)
+
+        table.append(chr(byte))
+
+    return ''.join(table)
+
+
+FILL_TABLES = dict((state, _fill_table(state)) for state in STATE_NAMES)
+
+# The slots of each byte that have a given state
+SLOTS = dict(
+    (state, [
+        [slot for slot in xrange(IDS_PER_BYTE)
+            if _slot_state(byte, slot) == state]
+        for byte in xrange(256)
+    ])
+    for state in STATE_NAMES
+)
+
+# Matches runs of bytes that are entirely in a state, or single bytes that
+# are partly in it
+SCAN_PATTERNS = dict(
+    (state, re.compile(
+        '({0}+)|([{1}])'.format(
+            re.escape(_full_byte(state)),
+            ''.join(re.escape(chr(byte)) for byte in xrange(256)
+                if SLOTS[state][byte] and byte != ord(_full_byte(state)))
+        )
+    ))
+    for state in STATE_NAMES
+)
+
+
+class IDStateMap(object):
+    '''Two bits of state per ID in a memory-mapped file.
+
+    IDs are numbered by decoding them with the puush alphabet, whatever
+    the alphabet of the item that contained them.
+
+    Writers hold an exclusive lock on the file for the whole of
+    :meth:`update` and :meth:`set_range`, and readers of :meth:`get` and
+    :meth:`iter_ranges` a shared lock, so other processes never see a
+    bulk update half done.
+    '''
+    def __init__(self, path, size=ID_SPACE_SIZE, readonly=False):
+        self.path = path
+        self.readonly = readonly
+
+        if readonly:
+            self.fd = os.open(path, os.O_RDONLY)
+        else:
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        with self.lock(exclusive=not readonly):
+            header = os.read(self.fd, HEADER_SIZE)
+
+            if header:
+                magic, self.size = struct.unpack(HEADER_FORMAT, header)
+
+                if magic != MAGIC:
+                    raise ValueError('Not an ID state file: {0}'.format(path))
+            else:
+                self.size = size
+                os.write(self.fd, struct.pack(HEADER_FORMAT, MAGIC, size))
+
+            length = HEADER_SIZE + -(-self.size // IDS_PER_BYTE)
+
+            if not readonly and os.fstat(self.fd).st_size < length:
+                os.ftruncate(self.fd, length)
+
+        self.map = mmap.mmap(self.fd, length,
+            access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @contextlib.contextmanager
+    def lock(self, exclusive=False):
+        fcntl.flock(self.fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _check_range(self, start, end):
+        if not 0 <= start <= end < self.size:
+            raise IndexError('ID range {0}-{1} is outside of 0-{2}'.format(
+                start, end, self.size - 1))
+
+    def _get(self, num):
+        byte = ord(self.map[HEADER_SIZE + num // IDS_PER_BYTE])
+        return _slot_state(byte, num % IDS_PER_BYTE)
+
+    def _set(self, num, state, overwrite=True):
+        index = HEADER_SIZE + num // IDS_PER_BYTE
+        shift = (num % IDS_PER_BYTE) * 2
+        byte = ord(self.map[index])
+
+        if overwrite or not (byte >> shift) & 3:
+            self.map[index] = chr(byte & ~(3 << shift) | (state << shift))
+
+    def get(self, num):
+        self._check_range(num, num)
+
+        with self.lock():
+            return self._get(num)
+
+    def update(self, states, overwrite=True):
+        '''Record an iterable of ``(num, state)`` pairs in one locked step.
+
+        If `overwrite` is false, only IDs that are still unknown are
+        changed.
+        '''
+        with self.lock(exclusive=True):
+            for num, state in states:
+                self._check_range(num, num)
+                self._set(num, state, overwrite)
+
+            self.map.flush()
+
+    def set_range(self, start, end, state, overwrite=True):
+        '''Record the same state for every ID from `start` to `end`'''
+        self._check_range(start, end)
+
+        with self.lock(exclusive=True):
+            # IDs that share a byte with IDs outside the range
+            while start <= end and start % IDS_PER_BYTE:
+                self._set(start, state, overwrite)
+                start += 1
+
+            while start <= end and (end + 1) % IDS_PER_BYTE:
+                self._set(end, state, overwrite)
+                end -= 1
+
+            index = HEADER_SIZE + start // IDS_PER_BYTE
+            end_index = HEADER_SIZE + (end + 1) // IDS_PER_BYTE
+
+            while index < end_index:
+                chunk_end = min(end_index, index + CHUNK_SIZE)
+
+                if overwrite:
+                    self.map[index:chunk_end] = \
+                        _full_byte(state) * (chunk_end - index)
+                else:
+                    self.map[index:chunk_end] = \
+                        self.map[index:chunk_end].translate(
+                            FILL_TABLES[state])
+
+                index = chunk_end
+
+            self.map.flush()
+
+    def iter_ranges(self, start, end, state=UNKNOWN):
+        '''Yield ``(first, last)`` for each run of IDs in `state`.
+
+        The file is scanned a chunk at a time, so memory use does not depend
+        on the size of the range.
+        '''
+        self._check_range(start, end)
+        pattern = SCAN_PATTERNS[state]
+        slots = SLOTS[state]
+        run_start = None
+        run_end = None
+
+        with self.lock():
+            index = start // IDS_PER_BYTE
+            end_index = end // IDS_PER_BYTE + 1
+
+            while index < end_index:
+                chunk_end = min(end_index, index + CHUNK_SIZE)
+                chunk = self.map[HEADER_SIZE + index:HEADER_SIZE + chunk_end]
+
+                for match in pattern.finditer(chunk):
+                    base = (index + match.start()) * IDS_PER_BYTE
+
+                    if match.group(1):
+                        runs = ((base, base + len(match.group(1))
+                            * IDS_PER_BYTE - 1),)
+                    else:
+                        runs = ((base + slot, base + slot)
+                            for slot in slots[ord(match.group(2))])
+
+                    for first, last in runs:
+                        first = max(first, start)
+                        last = min(last, end)
+
+                        if first > last:
+                            continue
+
+                        if run_end is not None and first == run_end + 1:
+                            run_end = last
+                        else:
+                            if run_end is not None:
+                                yield run_start, run_end
+
+                            run_start = first
+                            run_end = last
+
+                index = chunk_end
+
+        if run_end is not None:
+            yield run_start, run_end
+
+    def count(self, start, end, state=UNKNOWN):
+        return sum(last - first + 1
+            for first, last in self.iter_ranges(start, end, state))
+
+    def record_item_name(self, item_name, state, overwrite=True):
+        '''Record the state for every ID of a tracker item name.
+
+        IDs past the end of the file are left out.
+        '''
+        start_num, end_num, alphabet = base62.parse_item_name(item_name)
+
+        if alphabet == base62.ALPHABET_PUUSH:
+            end_num = min(end_num, self.size - 1)
+
+            if start_num <= end_num:
+                self.set_range(start_num, end_num, state, overwrite)
+        else:
+            nums = (base62.base62_decode(name, base62.ALPHABET_PUUSH)
+                for name in base62.encode_range(start_num, end_num, alphabet))
+            self.update(((num, state) for num in nums if num < self.size),
+                overwrite)
+
+    def record_exit_statuses(self, exit_statuses):
+        '''Record the wget exit status of each ID of a tracker log entry.
+
+        Statuses other than success, not found and permission denied leave
+        the ID as it was. IDs past the end of the file are left out.
+        '''
+        states = ((base62.base62_decode(name, base62.ALPHABET_PUUSH),
+            EXIT_STATUS_STATES[exit_status])
+            for name, exit_status in exit_statuses.items()
+            if exit_status in EXIT_STATUS_STATES)
+
+        self.update((num, state) for num, state in states if num < self.size)
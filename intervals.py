@@ -0,0 +1,84 @@
+'''Helpers for sorted lists of inclusive ``(start, end)`` integer intervals'''
+
+
+def merge_intervals(intervals):
+    '''Return the intervals sorted, with overlapping and adjacent ones
+    joined'''
+    merged = []
+
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def intervals_from_numbers(numbers):
+    '''Return the merged intervals covering an iterable of integers.
+
+    Runs of consecutive numbers are joined as they are read, so sorted input
+    only takes memory for each run, not each number.
+    '''
+    return intervals_from_ranges((num, num) for num in numbers)
+
+
+def intervals_from_ranges(ranges):
+    '''Return the merged intervals covering an iterable of intervals.
+
+    Like :func:`intervals_from_numbers`, intervals that continue the
+    previous one are joined as they are read.
+    '''
+    intervals = []
+
+    for start, end in ranges:
+        if intervals and intervals[-1][0] <= start <= intervals[-1][1] + 1:
+            if end > intervals[-1][1]:
+                intervals[-1] = (intervals[-1][0], end)
+        else:
+            intervals.append((start, end))
+
+    return merge_intervals(intervals)
+
+
+def subtract_intervals(intervals, exclusions):
+    '''Yield the parts of `intervals` that are not in `exclusions`.
+
+    Both must be sorted and not overlap themselves, such as the output of
+    :func:`merge_intervals`. `intervals` may be any iterable; it is swept
+    once alongside `exclusions`.
+    '''
+    index = 0
+
+    for start, end in intervals:
+        while index < len(exclusions) and exclusions[index][1] < start:
+            index += 1
+
+        scan_index = index
+
+        while start <= end:
+            if scan_index == len(exclusions) \
+            or exclusions[scan_index][0] > end:
+                yield start, end
+                break
+
+            exclude_start, exclude_end = exclusions[scan_index]
+
+            if exclude_start > start:
+                yield start, exclude_start - 1
+
+            start = exclude_end + 1
+            scan_index += 1
+
+
+def split_interval(start, end, size):
+    '''Yield consecutive pieces of at most `size` numbers from `start`'''
+    if size < 1:
+        raise ValueError('The size of a piece should be positive')
+
+    while start <= end:
+        piece_end = min(end, start + size - 1)
+        yield start, piece_end
+        start = piece_end + 1
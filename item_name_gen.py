@@ -3,9 +3,21 @@
 from __future__ import print_function
 
 import argparse
+import functools
+import itertools
+import math
+import sys
 
-from decentralized_puush_grab import (base62_decode, base62_encode, ALPHABET,
+import id_state
+import tracker_log
+from base62 import (base62_decode, base62_encode, encode_range, ALPHABET,
     ALPHABET_PUUSH)
+from intervals import (intervals_from_ranges, merge_intervals,
+    split_interval, subtract_intervals)
+
+
+# Number of item names written to stdout at once
+OUTPUT_BATCH_SIZE = 10000
 
 
 def main():
@@ -15,16 +27,38 @@ def main():
     arg_parser.add_argument('end_int', type=int,
         help='The ending base 10 integer')
     arg_parser.add_argument('--exclusion-file',
-        help='A path to a file containing lines of base 10 integers to '
-        'exclude from the print out')
+        help='A path to a file containing lines of base 10 integers, or '
+        'START:END ranges of them, to exclude from the print out')
     arg_parser.add_argument('--exclusion-file-62',
-        help='A path to a file containing lines of base 62 integers to '
-        'exclude from the print out')
+        help='A path to a file containing lines of base 62 integers, or '
+        'FIRST:LAST ranges of them such as from gen_exclusion_list.py '
+        '--ranges, to exclude from the print out')
+    arg_parser.add_argument('--state-file',
+        help='A path to an ID state file; only IDs that are still unknown '
+        'in it are printed')
     arg_parser.add_argument('--range', type=int,
         help='Generate a list using the range notation of the given size',
         default=1)
     arg_parser.add_argument('--legacy-alphabet', action='store_true',
         help='Use an alternate alphabet (not Puush alphabet)')
+    arg_parser.add_argument('--history', action='append',
+        help='A path to a tracker log exported by db_dump.py log '
+        '(optionally gzipped). With --target-bytes or --target-seconds, '
+        'items are sized by the results recorded near their IDs. '
+        'Can be given more than once')
+    arg_parser.add_argument('--target-bytes', type=float,
+        help='Size items to download about this many bytes each')
+    arg_parser.add_argument('--target-seconds', type=float,
+        help='Size items to take about this many seconds each')
+    arg_parser.add_argument('--max-range', type=int, default=1000,
+        help='The largest item size when sizing items from the history')
+    arg_parser.add_argument('--bucket-size', type=int, default=62 ** 2,
+        help='Number of neighbouring IDs that share one estimate')
+    arg_parser.add_argument('--request-seconds', type=float, default=1.0,
+        help='Estimated seconds taken by each request for --target-seconds')
+    arg_parser.add_argument('--bytes-per-second', type=float,
+        default=1000000,
+        help='Estimated download speed for --target-seconds')
 
     args = arg_parser.parse_args()
 
@@ -35,36 +69,241 @@ def main():
         alphabet = ALPHABET_PUUSH
         separator = ':'
 
-    if args.range and not (1 <= args.range <= 100):
+    if not 1 <= args.range <= 100:
         raise Exception("Range should be positive and not too large")
 
-    exclusion_set = set()
+    if (args.target_bytes or args.target_seconds) and not args.history:
+        raise Exception("Sizing items needs at least one history file")
+
+    if args.target_bytes and args.target_seconds:
+        raise Exception("Give only one of the byte and time targets")
+
+    if args.state_file and args.legacy_alphabet:
+        # The state file numbers IDs with the Puush alphabet
+        raise Exception("The state file can't be used with the legacy "
+            "alphabet")
+
+    exclusions = []
 
     if args.exclusion_file:
         with open(args.exclusion_file, 'rt') as f:
-            for line in f:
-                exclusion_set.add(int(line.strip()))
+            exclusions.extend(read_exclusions(f, int))
 
     if args.exclusion_file_62:
         with open(args.exclusion_file_62, 'rt') as f:
-            for line in f:
-                exclusion_set.add(base62_decode(line.strip(), alphabet))
-
-    l = []
-    for i in xrange(args.start_int, args.end_int + 1):
-        if i not in exclusion_set:
-            l.append(i)
-
-        if i in exclusion_set or i == args.end_int or len(l) >= args.range:
-            if len(l) == 1:
-                print(base62_encode(l[0], alphabet))
-            elif l:
-                print('{}{}{}'.format(
-                    base62_encode(l[0], alphabet),
+            exclusions.extend(read_id_name_exclusions(f, alphabet))
+
+    exclusions = merge_intervals(exclusions)
+
+    if args.state_file:
+        state_map = id_state.IDStateMap(args.state_file, readonly=True)
+        runs = state_map.iter_ranges(args.start_int, args.end_int)
+    else:
+        runs = [(args.start_int, args.end_int)]
+
+    if args.target_bytes or args.target_seconds:
+        cost_model = CostModel(args.bucket_size)
+
+        for path in args.history:
+            with tracker_log.open_log(path) as f:
+                cost_model.add_log(f, alphabet)
+
+        if args.target_bytes:
+            split = functools.partial(cost_model.split_interval,
+                target=args.target_bytes, max_size=args.max_range)
+        else:
+            split = functools.partial(cost_model.split_interval,
+                target=args.target_seconds, max_size=args.max_range,
+                request_seconds=args.request_seconds,
+                bytes_per_second=args.bytes_per_second)
+    elif args.range == 1:
+        split = None
+    else:
+        split = functools.partial(split_interval, size=args.range)
+
+    item_names = generate_item_names(subtract_intervals(runs, exclusions),
+        split, alphabet, separator)
+
+    while True:
+        batch = list(itertools.islice(item_names, OUTPUT_BATCH_SIZE))
+
+        if not batch:
+            break
+
+        sys.stdout.write('\n'.join(batch))
+        sys.stdout.write('\n')
+
+
+def read_exclusions(fileobj, parse):
+    '''Return the merged intervals of the numbers and ranges of numbers on
+    each line'''
+    def iter_ranges():
+        for line in fileobj:
+            line = line.strip()
+
+            if ':' in line:
+                start_text, end_text = line.split(':', 1)
+                yield parse(start_text), parse(end_text)
+            else:
+                num = parse(line)
+                yield num, num
+
+    return intervals_from_ranges(iter_ranges())
+
+
+def read_id_name_exclusions(fileobj, alphabet):
+    '''Return the merged intervals of the ID names and FIRST:LAST ranges on
+    each line, numbered with `alphabet`.
+
+    Ranges are runs of IDs in Puush alphabet order, as written by
+    gen_exclusion_list.py --ranges.
+    '''
+    def iter_ranges():
+        for line in fileobj:
+            line = line.strip()
+
+            if ':' in line:
+                start_text, end_text = line.split(':', 1)
+                start = base62_decode(start_text, ALPHABET_PUUSH)
+                end = base62_decode(end_text, ALPHABET_PUUSH)
+
+                if alphabet == ALPHABET_PUUSH:
+                    yield start, end
+                else:
+                    # The run is not contiguous in the other numbering
+                    for id_name in encode_range(start, end, ALPHABET_PUUSH):
+                        num = base62_decode(id_name, alphabet)
+                        yield num, num
+            else:
+                num = base62_decode(line, alphabet)
+                yield num, num
+
+    return intervals_from_ranges(iter_ranges())
+
+
+def generate_item_names(runs, split, alphabet, separator):
+    '''Yield the item names that cover sorted runs of IDs.
+
+    ``split(start, end)`` yields the ``(start, end)`` of the items that a
+    run is cut into. If `split` is None, every ID is its own item.
+    '''
+    for run_start, run_end in runs:
+        if not split:
+            for item_name in encode_range(run_start, run_end, alphabet):
+                yield item_name
+
+            continue
+
+        for start, end in split(run_start, run_end):
+            if start == end:
+                yield base62_encode(start, alphabet)
+            else:
+                yield '{}{}{}'.format(
+                    base62_encode(start, alphabet),
                     separator,
-                    base62_encode(l[-1], alphabet)
-                ))
-            l = []
+                    base62_encode(end, alphabet)
+                )
+
+
+class CostModel(object):
+    '''Estimates the cost of IDs from the results of nearby IDs.
+
+    The ID space is divided into buckets of `bucket_size` IDs. Each bucket
+    keeps how many of its IDs were tried, how many were downloaded and how
+    many bytes they had. Buckets without history use the average of all
+    buckets.
+    '''
+    def __init__(self, bucket_size):
+        self.bucket_size = bucket_size
+        self.tried = {}
+        self.downloaded = {}
+        self.bytes = {}
+        self._average_bytes_per_id = None
+
+    def add_log(self, fileobj, alphabet):
+        for doc in tracker_log.iter_log_entries(fileobj):
+            self.add_log_entry(doc, alphabet)
+
+    def add_log_entry(self, doc, alphabet):
+        statuses = tracker_log.exit_statuses(doc)
+        downloaded_buckets = []
+        self._average_bytes_per_id = None
+
+        for id_name, exit_status in statuses.items():
+            if exit_status is None:
+                continue
+
+            bucket = base62_decode(id_name, alphabet) // self.bucket_size
+            self.tried[bucket] = self.tried.get(bucket, 0) + 1
+
+            if exit_status == 0:
+                self.downloaded[bucket] = self.downloaded.get(bucket, 0) + 1
+                downloaded_buckets.append(bucket)
+
+        # Only the total of the item is known, so it is shared evenly
+        # by the downloaded IDs
+        if downloaded_buckets:
+            share = tracker_log.byte_count(doc) / float(
+                len(downloaded_buckets))
+
+            for bucket in downloaded_buckets:
+                self.bytes[bucket] = self.bytes.get(bucket, 0) + share
+
+    def bytes_per_id(self, bucket):
+        if self.tried.get(bucket):
+            return self.bytes.get(bucket, 0) / float(self.tried[bucket])
+
+        if self._average_bytes_per_id is None:
+            total_tried = sum(self.tried.values())
+
+            if total_tried:
+                self._average_bytes_per_id = sum(self.bytes.values()) \
+                    / float(total_tried)
+            else:
+                self._average_bytes_per_id = 0.0
+
+        return self._average_bytes_per_id
+
+    def id_cost(self, bucket, request_seconds=None, bytes_per_second=None):
+        '''Return the estimated bytes of an ID, or its seconds if the
+        request time and download speed are given'''
+        if request_seconds is None:
+            return self.bytes_per_id(bucket)
+        else:
+            return request_seconds \
+                + self.bytes_per_id(bucket) / bytes_per_second
+
+    def split_interval(self, start, end, target, max_size,
+    request_seconds=None, bytes_per_second=None):
+        '''Yield consecutive pieces from `start` that each cost about
+        `target`.
+
+        IDs of a bucket cost the same, so the pieces are measured out a
+        bucket at a time rather than an ID at a time.
+        '''
+        while start <= end:
+            piece_start = start
+            piece_end_limit = min(end, piece_start + max_size - 1)
+            cost = 0.0
+
+            while start <= piece_end_limit and cost < target:
+                bucket = start // self.bucket_size
+                bucket_last = min(piece_end_limit,
+                    (bucket + 1) * self.bucket_size - 1)
+                available = bucket_last - start + 1
+                id_cost = self.id_cost(bucket, request_seconds,
+                    bytes_per_second)
+
+                if id_cost > 0:
+                    count = min(available,
+                        max(1, int(math.ceil((target - cost) / id_cost))))
+                else:
+                    count = available
+
+                cost += count * id_cost
+                start += count
+
+            yield piece_start, start - 1
 
 
 if __name__ == '__main__':
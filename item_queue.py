@@ -1,6 +1,8 @@
-'''Searches twitter for the upper puush id name and loads items into tracker
+'''Finds the upper puush id name and loads items into tracker
 
-Requires Tweepy which can be installed using `pip install tweepy`
+The upper ID is found by probing puu.sh with HEAD requests, starting from the
+minimum ID. If Tweepy is installed (`pip install tweepy`) and the config file
+has a twitter section, the newest ID seen on twitter is used as a hint.
 
 Usage python item_queue.py PATH_OF_CONFIG_FILE PATH_OF_MIN_ID_FILE.
 
@@ -14,6 +16,8 @@ The config file is an INI-like config file::
 
 The min id file contains an integer of the minimum ID to use.
 
+Items of 13 IDs are added straight to the tracker's todo set in redis.
+
 There are currently some hard coded values which may need to be adjusted to
 your needs.
 
@@ -24,24 +28,42 @@ Example crontab entry::
 from __future__ import print_function
 
 import ConfigParser
+import Queue
 import argparse
-import httplib
+import functools
+import itertools
 import logging
 import logging.handlers
 import os
 import re
 import shutil
-import subprocess
 import sys
-import tempfile
-import tweepy
-
-from decentralized_puush_grab import (base62_decode, ALPHABET_PUUSH,
+import threading
+try:
+    import redis
+except ImportError:
+    import warnings
+    warnings.warn('The optional redis module was not found.')
+try:
+    import tweepy
+except ImportError:
+    tweepy = None
+
+from base62 import (base62_decode, ALPHABET_PUUSH,
     base62_encode)
+from frontier import FrontierProber
+from intervals import split_interval
+from item_name_gen import generate_item_names
 
 
 _logger = logging.getLogger(__name__)
 
+# Number of IDs in each item
+ITEM_SIZE = 13
+
+# Number of items sent to the tracker database at once
+ENQUEUE_BATCH_SIZE = 10000
+
 # logging.basicConfig(level=logging.DEBUG)
 
 
@@ -58,6 +80,22 @@ class Queuer(object):
         arg_parser = argparse.ArgumentParser()
         arg_parser.add_argument('config')
         arg_parser.add_argument('min_id_path')
+        arg_parser.add_argument('--base-url', default='http://puu.sh',
+            help='URL that the IDs are probed under')
+        arg_parser.add_argument('--probe-width', type=int, default=20,
+            help='Number of consecutive IDs checked at each probe position; '
+            'gaps of deleted IDs shorter than this are skipped over')
+        arg_parser.add_argument('--probe-concurrency', type=int, default=10,
+            help='Number of HEAD requests made at the same time')
+        arg_parser.add_argument('--redis-host', default='localhost',
+            help='Hostname of the tracker database server')
+        arg_parser.add_argument('--redis-port', type=int, default=6379,
+            help='Port number of the tracker database server')
+        arg_parser.add_argument('--redis-db', type=int, default=0,
+            help='Database number of the tracker')
+        arg_parser.add_argument('--todo-key',
+            help='Name of the set that items are added to. Defaults to '
+            'TRACKER_ID:todo')
         self.args = args = arg_parser.parse_args()
 
         config = ConfigParser.ConfigParser()
@@ -65,29 +103,41 @@ class Queuer(object):
 
         self.min_item_id = self.get_min_item_id()
         self.max_item_id = None
+        self.api = None
 
-        consumer_token = config.get('twitter', 'consumer_token')
-        consumer_secret = config.get('twitter', 'consumer_secret')
-        access_token = config.get('twitter', 'access_token')
-        access_token_secret = config.get('twitter', 'access_token_secret')
+        if tweepy and config.has_section('twitter'):
+            consumer_token = config.get('twitter', 'consumer_token')
+            consumer_secret = config.get('twitter', 'consumer_secret')
+            access_token = config.get('twitter', 'access_token')
+            access_token_secret = config.get('twitter',
+                'access_token_secret')
 
-        _logger.debug('Set authentication tokens')
+            _logger.debug('Set authentication tokens')
 
-        auth = tweepy.OAuthHandler(consumer_token, consumer_secret)
-        auth.set_access_token(access_token, access_token_secret)
+            auth = tweepy.OAuthHandler(consumer_token, consumer_secret)
+            auth.set_access_token(access_token, access_token_secret)
 
-        self.api = tweepy.API(auth)
+            self.api = tweepy.API(auth)
+
+        self.prober = FrontierProber(args.base_url, width=args.probe_width,
+            concurrency=args.probe_concurrency)
 
         if self.check_fail_sentinel_file():
             raise Exception('Failure sentinel file exists!')
 
-        self.search_for_ids()
+        try:
+            if self.api:
+                try:
+                    self.search_for_ids()
+                except Exception:
+                    _logger.exception('Twitter search failed')
+
+            self.probe_for_max_id()
+        finally:
+            self.prober.close()
 
         if self.max_item_id:
-            if self.check_valid_id():
-                self.process_max_item_id()
-            else:
-                _logger.info('Received possible malicious ID. Quiting.')
+            self.process_max_item_id()
 
     def get_min_item_id(self):
         with open(self.args.min_id_path, 'r') as f:
@@ -124,20 +174,28 @@ class Queuer(object):
         self.max_item_id = id_ints[-1]
 
     def check_valid_id(self):
-        id_name = base62_encode(self.max_item_id, ALPHABET_PUUSH)
-        try:
-            _logger.debug('Check if %s is valid', id_name)
-            conn = httplib.HTTPConnection("puu.sh")
-            conn.request("HEAD", '/' + id_name)
-            res = conn.getresponse()
+        _logger.debug('Check if %s is valid',
+            base62_encode(self.max_item_id, ALPHABET_PUUSH))
+
+        return self.prober.exists(self.max_item_id)
+
+    def probe_for_max_id(self):
+        start = self.min_item_id - 1
 
-            _logger.debug('Got %d %s', res.status, res.reason)
+        # The twitter ID is only a hint; it may be bogus
+        if self.max_item_id and self.max_item_id > start:
+            if self.check_valid_id():
+                start = self.max_item_id
+            else:
+                _logger.info('Received possible malicious ID. Ignoring it.')
 
-            if res.status == 200:
-                return True
+        _logger.debug('Probe from %s',
+            base62_encode(start, ALPHABET_PUUSH))
 
-        except Exception:
-            _logger.exception('Error checking valid url {}'.format(id_name))
+        self.max_item_id = self.prober.find_max(start)
+
+        _logger.info('Found max ID %s',
+            base62_encode(self.max_item_id, ALPHABET_PUUSH))
 
     def process_max_item_id(self):
         if self.max_item_id <= self.min_item_id:
@@ -146,41 +204,71 @@ class Queuer(object):
 
         _logger.info('Adding %d to %d', self.min_item_id, self.max_item_id)
 
-        with tempfile.NamedTemporaryFile() as item_list_file:
-            _logger.debug('Generating item list')
+        self.save_fail_sentinel_file()
+        self.save_new_min_id()
+
+        _logger.debug('Queuing item list')
+
+        item_count = self.enqueue_items(self.generate_items())
+
+        _logger.debug('Queued %d items', item_count)
+
+        self.remove_fail_sentinel_file()
 
-            proc = subprocess.Popen(['/usr/bin/env', 'python',
-                'item_name_gen.py',
-                '--range', '13',
-                str(self.min_item_id), str(self.max_item_id)],
-                stdout=item_list_file)
+    def generate_items(self):
+        return generate_item_names([(self.min_item_id, self.max_item_id)],
+            functools.partial(split_interval, size=ITEM_SIZE),
+            ALPHABET_PUUSH, ':')
+
+    def enqueue_items(self, item_names):
+        '''Add the item names to the tracker's todo set.
+
+        Batches are generated in a thread while the previous batch is sent
+        in a pipeline. Returns the number of items added.
+        '''
+        r = redis.StrictRedis(host=self.args.redis_host,
+            port=self.args.redis_port, db=self.args.redis_db)
+        key = self.args.todo_key or '%s:todo' % self.tracker_id
+        batches = Queue.Queue(maxsize=4)
+
+        def generate():
+            try:
+                while True:
+                    batch = list(itertools.islice(item_names,
+                        ENQUEUE_BATCH_SIZE))
+
+                    if not batch:
+                        break
+
+                    batches.put(batch)
+            except Exception as error:
+                batches.put(error)
+            else:
+                batches.put(None)
 
-            proc.communicate()
+        thread = threading.Thread(target=generate)
+        thread.daemon = True
+        thread.start()
 
-            _logger.debug('item_name_gen returned %d', proc.returncode)
+        item_count = 0
 
-            if proc.returncode != 0:
-                raise Exception('item_name_gen failed. return code {}'.format(
-                    proc.returncode))
+        while True:
+            batch = batches.get()
 
-            self.save_fail_sentinel_file()
-            self.save_new_min_id()
+            if batch is None:
+                break
+            elif isinstance(batch, Exception):
+                raise batch
 
-            _logger.debug('Queuing item list')
+            pipe = r.pipeline(transaction=False)
 
-            # TODO: make these values configurable
-            with open(item_list_file.name, 'rb') as f:
-                proc = subprocess.Popen(['/home/tracker/.rvm/bin/ruby',
-                    'enqueue.rb', self.tracker_id],
-                    stdin=f,
-                )
-                proc.communicate()
+            for item_name in batch:
+                pipe.sadd(key, item_name)
 
-            if proc.returncode != 0:
-                raise Exception('enqueue failed. return code {}'.format(
-                    proc.returncode))
+            pipe.execute()
+            item_count += len(batch)
 
-            self.remove_fail_sentinel_file()
+        return item_count
 
     def save_new_min_id(self):
         old_path = '%s-old' % self.args.min_id_path
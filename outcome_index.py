@@ -0,0 +1,356 @@
+'''A columnar index of the per-ID results in the tracker log
+
+The index is a directory with one file per column and a ``meta.json``.
+Each column is a flat array of fixed size values, one per ID result,
+sorted by ID and then time. Columns are memory-mapped when queried, so
+only the rows that a query touches are read.
+
+Running totals of the bytes and of each exit status are stored too, so
+counts and byte totals over an ID range need only two binary searches.
+'''
+import array
+import bisect
+import calendar
+import datetime
+import json
+import math
+import mmap
+import os
+import sys
+
+import base62
+import tracker_log
+
+
+INDEX_VERSION = 1
+
+# Exit statuses that get their own running total; the rest are counted
+# together as other
+STATUS_CLASSES = (0, 100, 101, 102)
+OTHER_STATUS = 'other'
+
+NO_STATUS = -1
+
+
+def _typecode(code_letters, itemsize):
+    for code in code_letters:
+        try:
+            if array.array(code).itemsize == itemsize:
+                return code
+        except ValueError:
+            pass
+
+    raise ValueError('No array type of {0} bytes'.format(itemsize))
+
+
+U64 = _typecode('LQ', 8)
+U32 = _typecode('IL', 4)
+
+COLUMN_TYPES = {
+    'id': U64,
+    'status': 'h',
+    'time': 'd',
+    'bytes': 'd',
+    'downloader': U32,
+    'entry': U32,
+    'cum_bytes': 'd',
+    'entry_start': U64,
+    'entry_end': U64,
+    'entry_legacy': 'B',
+}
+
+for _status_class in STATUS_CLASSES + (OTHER_STATUS,):
+    COLUMN_TYPES['cum_status_{0}'.format(_status_class)] = U32
+
+
+def parse_time(value):
+    '''Return the epoch seconds of a log timestamp, or NaN'''
+    if isinstance(value, (int, long, float)):
+        return float(value)
+
+    if isinstance(value, basestring):
+        for time_format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S',
+        '%Y-%m-%d'):
+            try:
+                date = datetime.datetime.strptime(value[:19], time_format)
+            except ValueError:
+                continue
+
+            return float(calendar.timegm(date.timetuple()))
+
+    return float('nan')
+
+
+def format_time(value):
+    if math.isnan(value):
+        return '-'
+
+    return datetime.datetime.utcfromtimestamp(value).strftime(
+        '%Y-%m-%dT%H:%M:%SZ')
+
+
+def status_class(status):
+    if status in STATUS_CLASSES:
+        return status
+    else:
+        return OTHER_STATUS
+
+
+def build_index(log_files, index_dir):
+    '''Read exported tracker logs and write the index directory'''
+    columns = dict((name, array.array(code))
+        for name, code in COLUMN_TYPES.items()
+        if not name.startswith('cum_'))
+    downloaders = {}
+
+    for path in log_files:
+        with tracker_log.open_log(path) as f:
+            for doc in tracker_log.iter_log_entries(f):
+                _add_entry(doc, columns, downloaders)
+
+    row_count = len(columns['id'])
+    ids = columns['id']
+    times = columns['time']
+    order = sorted(xrange(row_count), key=lambda i: (ids[i], times[i]))
+
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+
+    for name in ('id', 'status', 'time', 'bytes', 'downloader', 'entry'):
+        column = columns[name]
+        _write_column(index_dir, name,
+            array.array(column.typecode, (column[i] for i in order)))
+
+    _write_running_totals(index_dir, columns, order)
+
+    for name in ('entry_start', 'entry_end', 'entry_legacy'):
+        _write_column(index_dir, name, columns[name])
+
+    meta = {
+        'version': INDEX_VERSION,
+        'byteorder': sys.byteorder,
+        'rows': row_count,
+        'entries': len(columns['entry_start']),
+        'downloaders': [name for name, dummy in
+            sorted(downloaders.items(), key=lambda pair: pair[1])],
+    }
+
+    with open(os.path.join(index_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def _add_entry(doc, columns, downloaders):
+    statuses = tracker_log.exit_statuses(doc)
+
+    if not statuses:
+        return
+
+    item_name = doc.get('item')
+
+    if item_name:
+        start_num, end_num, alphabet = base62.parse_item_name(item_name)
+    else:
+        start_num = end_num = 0
+        alphabet = base62.ALPHABET_PUUSH
+
+    downloader = doc.get('by') or doc.get('downloader') or '-'
+    downloader_index = downloaders.setdefault(downloader, len(downloaders))
+    entry_index = len(columns['entry_start'])
+    entry_time = parse_time(doc.get('at'))
+    downloaded_count = sum(1 for status in statuses.values() if status == 0)
+
+    if downloaded_count:
+        byte_share = tracker_log.byte_count(doc) / float(downloaded_count)
+    else:
+        byte_share = 0.0
+
+    columns['entry_start'].append(start_num)
+    columns['entry_end'].append(end_num)
+    columns['entry_legacy'].append(alphabet == base62.ALPHABET)
+
+    for id_name, status in statuses.items():
+        columns['id'].append(base62.base62_decode(id_name,
+            base62.ALPHABET_PUUSH))
+        columns['status'].append(NO_STATUS if status is None else status)
+        columns['time'].append(entry_time)
+        columns['bytes'].append(byte_share if status == 0 else 0.0)
+        columns['downloader'].append(downloader_index)
+        columns['entry'].append(entry_index)
+
+
+def _write_running_totals(index_dir, columns, order):
+    '''Write the totals of the rows before each row, plus the grand total'''
+    cum_bytes = array.array(COLUMN_TYPES['cum_bytes'], [0.0])
+    cum_statuses = dict(
+        (status, array.array(U32, [0]))
+        for status in STATUS_CLASSES + (OTHER_STATUS,)
+    )
+    total_bytes = 0.0
+    totals = dict((status, 0) for status in cum_statuses)
+
+    for i in order:
+        total_bytes += columns['bytes'][i]
+        cum_bytes.append(total_bytes)
+        totals[status_class(columns['status'][i])] += 1
+
+        for status, column in cum_statuses.iteritems():
+            column.append(totals[status])
+
+    _write_column(index_dir, 'cum_bytes', cum_bytes)
+
+    for status, column in cum_statuses.iteritems():
+        _write_column(index_dir, 'cum_status_{0}'.format(status), column)
+
+
+def _write_column(index_dir, name, values):
+    with open(os.path.join(index_dir, name + '.col'), 'wb') as f:
+        values.tofile(f)
+
+
+class Column(object):
+    '''A read only, memory-mapped column'''
+    def __init__(self, path, typecode):
+        self.typecode = typecode
+        self.itemsize = array.array(typecode).itemsize
+        self.length = os.path.getsize(path) // self.itemsize
+
+        if self.length:
+            with open(path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = None
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.length:
+            raise IndexError(index)
+
+        return self.slice(index, index + 1)[0]
+
+    def slice(self, start, end):
+        values = array.array(self.typecode)
+
+        if start < end:
+            values.fromstring(
+                self.map[start * self.itemsize:end * self.itemsize])
+
+        return values
+
+    def close(self):
+        if self.map:
+            self.map.close()
+
+
+class OutcomeIndex(object):
+    '''Answers queries from an index directory'''
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        if self.meta['version'] != INDEX_VERSION:
+            raise ValueError('Unsupported index version')
+
+        if self.meta['byteorder'] != sys.byteorder:
+            raise ValueError('The index was built on a machine with a '
+                'different byte order')
+
+        self.downloaders = self.meta['downloaders']
+        self.columns = dict(
+            (name, Column(os.path.join(index_dir, name + '.col'), code))
+            for name, code in COLUMN_TYPES.items()
+        )
+
+    def close(self):
+        for column in self.columns.values():
+            column.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def row_range(self, start_id, end_id):
+        '''Return the rows ``[lo, hi)`` of the IDs from `start_id` to
+        `end_id`'''
+        ids = self.columns['id']
+        return (bisect.bisect_left(ids, start_id),
+            bisect.bisect_right(ids, end_id))
+
+    def summary(self, start_id, end_id):
+        '''Return the row counts by status and the bytes of an ID range'''
+        lo, hi = self.row_range(start_id, end_id)
+        counts = {}
+
+        for status in STATUS_CLASSES + (OTHER_STATUS,):
+            column = self.columns['cum_status_{0}'.format(status)]
+            counts[status] = column[hi] - column[lo]
+
+        cum_bytes = self.columns['cum_bytes']
+
+        return {
+            'rows': hi - lo,
+            'statuses': counts,
+            'bytes': cum_bytes[hi] - cum_bytes[lo],
+        }
+
+    def iter_rows(self, start_id, end_id, statuses=None, since=None,
+    until=None, block_size=65536):
+        '''Yield a dict for each result of the IDs in a range.
+
+        Rows are read a block at a time; the filters are applied to the
+        status and time columns before the other columns are read.
+        '''
+        lo, hi = self.row_range(start_id, end_id)
+        columns = self.columns
+
+        for block_lo in xrange(lo, hi, block_size):
+            block_hi = min(hi, block_lo + block_size)
+            block_statuses = columns['status'].slice(block_lo, block_hi)
+            block_times = columns['time'].slice(block_lo, block_hi)
+            matches = [
+                i for i in xrange(block_hi - block_lo)
+                if (statuses is None or block_statuses[i] in statuses)
+                and (since is None or block_times[i] >= since)
+                and (until is None or block_times[i] < until)
+            ]
+
+            if not matches:
+                continue
+
+            block_ids = columns['id'].slice(block_lo, block_hi)
+            block_bytes = columns['bytes'].slice(block_lo, block_hi)
+            block_downloaders = columns['downloader'].slice(block_lo,
+                block_hi)
+            block_entries = columns['entry'].slice(block_lo, block_hi)
+
+            for i in matches:
+                status = block_statuses[i]
+
+                yield {
+                    'id': block_ids[i],
+                    'status': None if status == NO_STATUS else status,
+                    'time': block_times[i],
+                    'bytes': block_bytes[i],
+                    'downloader': self.downloaders[block_downloaders[i]],
+                    'item': self.item_name(block_entries[i]),
+                }
+
+    def item_name(self, entry):
+        start_num = self.columns['entry_start'][entry]
+        end_num = self.columns['entry_end'][entry]
+
+        if self.columns['entry_legacy'][entry]:
+            alphabet = base62.ALPHABET
+            separator = ','
+        else:
+            alphabet = base62.ALPHABET_PUUSH
+            separator = ':'
+
+        if start_num == end_num:
+            return base62.base62_encode(start_num, alphabet)
+        else:
+            return '{0}{1}{2}'.format(base62.base62_encode(start_num, alphabet),
+                separator, base62.base62_encode(end_num, alphabet))
@@ -4,38 +4,61 @@ from seesaw.externalprocess import WgetDownload
 from seesaw.item import ItemInterpolation, ItemValue
 from seesaw.pipeline import Pipeline
 from seesaw.project import Project
-from seesaw.task import SimpleTask, LimitConcurrent, ConditionalTask, Task
-from seesaw.tracker import (TrackerRequest, PrepareStatsForTracker,
-    UploadWithTracker, SendDoneToTracker, GetItemFromTracker, RsyncUpload,
-    CurlUpload)
+from seesaw.task import SimpleTask, ConditionalTask, Task
+from seesaw.tracker import PrepareStatsForTracker
 from seesaw.util import find_executable
-from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+import collections
 import datetime
 import fcntl
 import functools
+import itertools
 import json
 import os
 import pty
-import random
 import seesaw
 import seesaw.externalprocess
 import shutil
 import subprocess
+import sys
+import tempfile
 import time
 import urllib2
+import urlparse
 import re
 
 # check the seesaw version before importing any other components
 if StrictVersion(seesaw.__version__) < StrictVersion("0.0.15"):
     raise Exception("This pipeline needs seesaw version 0.0.15 or higher.")
 
+# run-pipeline executes this file from the project directory without adding
+# it to the path
+sys.path.insert(0, os.getcwd())
+
+from base62 import base62_decode, encode_range, parse_item_name
+from child_watcher import ChildWatcher
+from warc_util import (iter_gzip_members, parse_record_header, split_warc,
+    WARCWriter)
+
+try:
+    import pycurl
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+    # The simple client is used instead but it does not keep connections
+    # alive
+    CurlAsyncHTTPClient = None
+
 
 # # Begin AsyncPopen fix
 
 class AsyncPopenFixed(seesaw.externalprocess.AsyncPopen):
     """
-    Start the wait_callback after setting self.pipe, to prevent an infinite spew of
+    Start watching for the exit after setting self.pipe, to prevent an infinite spew of
     "AttributeError: 'AsyncPopen' object has no attribute 'pipe'"
+
+    The exit of the process is delivered by the ChildWatcher instead of
+    polling for it every 250 ms.
     """
     def run(self):
         self.ioloop = IOLoop.instance()
@@ -57,10 +80,38 @@ class AsyncPopenFixed(seesaw.externalprocess.AsyncPopen):
         self.pipe = subprocess.Popen(*self.args, **self.kwargs)
 
         self.stdin = self.pipe.stdin
+        self.listening = True
+        self.ended = False
 
         # check for process exit
-        self.wait_callback = PeriodicCallback(self._wait_for_end, 250)
-        self.wait_callback.start()
+        ChildWatcher.instance().watch(self.pipe, self._wait_for_end)
+
+    def _handle_subprocess_stdout(self, fd, events):
+        if not self.master.closed and (events & IOLoop._EPOLLIN) != 0:
+            data = self.master.read()
+            self.on_output(data)
+
+        if events & IOLoop._EPOLLHUP:
+            # the output is closed; the exit comes from the ChildWatcher
+            self.ioloop.remove_handler(self.master_fd)
+            self.listening = False
+
+        self._wait_for_end()
+
+    def _wait_for_end(self, *args):
+        if self.ended:
+            return
+
+        self.pipe.poll()
+
+        if self.pipe.returncode is not None:
+            self.ended = True
+            self.master.close()
+
+            if self.listening:
+                self.ioloop.remove_handler(self.master_fd)
+
+            self.on_end(self.pipe.returncode)
 
 seesaw.externalprocess.AsyncPopen = AsyncPopenFixed
 
@@ -109,6 +160,19 @@ EXIT_STATUS_PERMISSION_DENIED = 100
 EXIT_STATUS_NOT_FOUND = 101
 EXIT_STATUS_OTHER_ERROR = 102
 
+# Which download task to use:
+# 'wget' runs one wget-lua per puush ID.
+# 'wget-batch' runs one wget-lua per item over a kept-alive connection.
+# 'native' fetches on the IOLoop and writes the WARCs without wget-lua.
+DOWNLOAD_ENGINE = os.environ.get('PUUSH_DOWNLOAD_ENGINE', 'wget')
+
+# Set to 1 to check every ID with a short request first and only download
+# the IDs that exist
+PRECLASSIFY = os.environ.get('PUUSH_PRECLASSIFY') == '1'
+
+# this must match from the lua script
+PERMISSION_DENIED_MESSAGE = "You do not have access to view that puush."
+
 
 ###########################################################################
 # This section defines project-specific tasks.
@@ -118,53 +182,139 @@ EXIT_STATUS_OTHER_ERROR = 102
 # each item.
 
 
-# Be careful! Some implementations have the ordering of upper and lower case
-# differently
-ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
-ALPHABET_PUUSH = '0123456789abcdefghijklmnopqrstuvwxyz' \
-    'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-assert ALPHABET != ALPHABET_PUUSH
-assert len(ALPHABET) == 62
-assert len(ALPHABET_PUUSH) == 62
+class ItemPrefetcher(object):
+    '''Keeps a backlog of items claimed from the tracker.
 
+    Items are handed out from the backlog right away and the backlog is
+    refilled in the background up to `size` items. It is saved to
+    `backlog_path` whenever it changes so claimed items survive a shutdown
+    or crash and are handed out first on the next start.
+    '''
+    def __init__(self, tracker_url, downloader, version, size, backlog_path):
+        self.http_client = AsyncHTTPClient()
+        self.tracker_url = tracker_url
+        self.downloader = downloader
+        self.version = version
+        self.size = size
+        self.backlog_path = backlog_path
+        self.retry_delay = 30
+        self.requesting = False
+        self.waiters = collections.deque()
+
+        if os.path.exists(backlog_path):
+            with open(backlog_path, 'r') as f:
+                self.backlog = json.load(f)
+        else:
+            self.backlog = []
 
-# http://stackoverflow.com/a/1119769/1524507
-def base62_encode(num, alphabet=ALPHABET):
-    """Encode a number in Base X
+    def get_item(self, item, callback):
+        '''Call ``callback(data)`` with the tracker data of an item'''
+        self.waiters.append((item, callback))
+        self._dispatch()
+        self._fill()
 
-    `num`: The number to encode
-    `alphabet`: The alphabet to use for encoding
-    """
-    if (num == 0):
-        return alphabet[0]
-    arr = []
-    base = len(alphabet)
-    while num:
-        rem = num % base
-        num = num // base
-        arr.append(alphabet[rem])
-    arr.reverse()
-    return ''.join(arr)
-
-
-def base62_decode(string, alphabet=ALPHABET):
-    """Decode a Base X encoded string into the number
-
-    Arguments:
-    - `string`: The encoded string
-    - `alphabet`: The alphabet to use for encoding
-    """
-    base = len(alphabet)
-    strlen = len(string)
-    num = 0
+    def save(self):
+        temp_path = '%s-new' % self.backlog_path
+
+        with open(temp_path, 'w') as f:
+            json.dump(self.backlog, f)
+
+        os.rename(temp_path, self.backlog_path)
+
+    def _dispatch(self):
+        changed = False
+
+        while self.waiters and self.backlog:
+            item, callback = self.waiters.popleft()
+
+            if getattr(item, 'canceled', False):
+                continue
+
+            changed = True
+            callback(self.backlog.pop(0))
+
+        if changed:
+            self.save()
+
+    def _fill(self):
+        if self.requesting:
+            return
+
+        wanted = int(realize(self.size)) + len(self.waiters)
+
+        if len(self.backlog) >= wanted:
+            return
+
+        self.requesting = True
+
+        data = {"downloader": realize(self.downloader), "api_version": "2"}
+        if self.version:
+            data["version"] = realize(self.version)
+
+        self.http_client.fetch(HTTPRequest(
+            "%s/request" % self.tracker_url,
+            method="POST",
+            headers={"Content-Type": "application/json"},
+            user_agent=("ArchiveTeam Warrior/%s" % seesaw.__version__),
+            body=json.dumps(data)
+          ), self._handle_response)
+
+    def _log_output(self, data):
+        for item, callback in self.waiters:
+            item.log_output(data)
+
+    def _handle_response(self, response):
+        self.requesting = False
+
+        if response.code == 200:
+            data = json.loads(response.body)
+
+            if "item_name" in data:
+                self.backlog.append(data)
+                self.save()
+                self._dispatch()
+                self._fill()
+                return
+
+            message = "Tracker responded with empty response. "
+        elif response.code in (420, 429):
+            message = "Tracker rate limiting is active. "
+        elif response.code == 404:
+            message = "No item received. "
+        elif response.code == 455:
+            message = "Project code is out of date and needs to be upgraded. "
+        elif response.code == 599:
+            message = "No HTTP response received from tracker. "
+        else:
+            message = "Tracker returned status code %d. " % response.code
+
+        self._log_output("%sRetrying after %d seconds...\n" % (message,
+            self.retry_delay))
+        IOLoop.instance().add_timeout(
+            datetime.timedelta(seconds=self.retry_delay), self._fill)
+
+
+class PrefetchItemFromTracker(Task):
+    '''Like GetItemFromTracker but takes the item from an ItemPrefetcher'''
+    def __init__(self, prefetcher):
+        Task.__init__(self, "PrefetchItemFromTracker")
+        self.prefetcher = prefetcher
+
+    def enqueue(self, item):
+        self.start_item(item)
+        item.log_output("Starting %s for %s\n" % (self, item.description()))
+        item.may_be_canceled = True
+        self.prefetcher.get_item(item,
+            functools.partial(self.on_item_data, item))
 
-    idx = 0
-    for char in string:
-        power = (strlen - (idx + 1))
-        num += alphabet.index(char) * (base ** power)
-        idx += 1
+    def on_item_data(self, item, data):
+        item.may_be_canceled = False
 
-    return num
+        for (k, v) in data.iteritems():
+            item[k] = v
+
+        item.log_output("Received item '%s' from tracker\n" % item["item_name"])
+        self.complete_item(item)
 
 
 class ExtraItemParams(SimpleTask):
@@ -172,28 +322,13 @@ class ExtraItemParams(SimpleTask):
         SimpleTask.__init__(self, 'ExtraItemParams')
 
     def process(self, item):
-        item_name = item["item_name"]
-
-        if ',' in item_name:
-            start_name, end_name = item_name.split(',', 1)
-            alphabet = ALPHABET
-        elif ':' in item_name:
-            start_name, end_name = item_name.split(':', 1)
-            alphabet = ALPHABET_PUUSH
-        else:
-            start_name = item_name
-            end_name = item_name
-            alphabet = ALPHABET_PUUSH
-
-        start_num = base62_decode(start_name, alphabet)
-        end_num = base62_decode(end_name, alphabet)
+        start_num, end_num, alphabet = parse_item_name(item["item_name"])
 
         item['sub_items'] = {}
 
         assert start_num <= end_num
 
-        for i in xrange(start_num, end_num + 1):
-            sub_item_name = base62_encode(i, alphabet)
+        for sub_item_name in encode_range(start_num, end_num, alphabet):
             item['sub_items'][sub_item_name] = {
                 'wget_exit_status': None,
                 'warc_file_base': None,
@@ -243,6 +378,11 @@ class PrepareDirectories(SimpleTask):
 
             item['sub_items'][sub_item_name]['warc_file_base'] = warc_file_base
 
+            # already classified by PreClassify, so it is not downloaded
+            if item['sub_items'][sub_item_name]['wget_exit_status'] \
+            is not None:
+                continue
+
             d = dict(
                 item_dir=item['item_dir'],
                 warc_file_base=warc_file_base
@@ -254,14 +394,27 @@ class URLsToDownload(object):
     def realize(self, item):
         l = []
         for sub_item_name in item['sub_items'].keys():
+            # skip the sub items that PreClassify found not to exist
+            if item['sub_items'][sub_item_name]['wget_exit_status'] \
+            is not None:
+                continue
+
             l.append('http://puu.sh/%s' % sub_item_name)
 
         return l
 
 
 class WgetDownloadMany(Task):
-    '''Takes in urls, runs wget and generates multiple warcs'''
-    def __init__(self, args, urls, retry_delay=30, max_tries=1, accept_on_exit_code=[0], retry_on_exit_code=None, env=None, stdin_data_function=None):
+    '''Takes in urls, runs wget and generates multiple warcs
+
+    Up to `concurrency` wget processes are run at the same time for an
+    item. The item is finished once the last of them has ended.
+
+    A URL that fails is put in a retry queue and tried again after the
+    retry delay, once the URLs not yet tried are started, so it does not
+    hold up the rest of the item. Tries are counted per URL.
+    '''
+    def __init__(self, args, urls, retry_delay=30, max_tries=1, accept_on_exit_code=[0], retry_on_exit_code=None, env=None, stdin_data_function=None, concurrency=1):
         Task.__init__(self, "WgetDownloadMany")
         self.args = args
         self.max_tries = max_tries
@@ -271,46 +424,105 @@ class WgetDownloadMany(Task):
         self.stdin_data_function = stdin_data_function
         self.unrealized_urls = urls
         self.retry_delay = retry_delay
+        self.concurrency = concurrency
 
     def enqueue(self, item):
         self.start_item(item)
         item.log_output("Starting %s for %s\n" % (self, item.description()))
-        item["tries"] = 1
         item['WgetDownloadMany.urls'] = realize(self.unrealized_urls, item)
         item['WgetDownloadMany.urls_index'] = 0
-        item['WgetDownloadMany.current_url'] = None
+        item['WgetDownloadMany.tries'] = {}
+        item['WgetDownloadMany.retry_queue'] = []
+        item['WgetDownloadMany.retry_timeout'] = None
+        item['WgetDownloadMany.active'] = 0
+        item['WgetDownloadMany.failed'] = False
         self.process(item)
 
     def process(self, item):
-        self.set_next_url(item)
-        self.process_one(item)
+        concurrency = int(realize(self.concurrency, item))
+
+        while not item['WgetDownloadMany.failed'] \
+        and item['WgetDownloadMany.active'] < concurrency:
+            url = self.next_url(item)
+
+            if url is None:
+                break
 
-    def set_next_url(self, item):
+            item['WgetDownloadMany.active'] += 1
+            self.process_one(item, url)
+
+        if item['WgetDownloadMany.failed']:
+            self.cancel_retry_timeout(item)
+        elif item['WgetDownloadMany.retry_queue'] \
+        and item['WgetDownloadMany.active'] < concurrency:
+            self.schedule_retry_timeout(item)
+
+        if item['WgetDownloadMany.active'] == 0:
+            if item['WgetDownloadMany.failed']:
+                item.log_output("Failed %s for %s\n" % (self, item.description()))
+                self.fail_item(item)
+            elif not item['WgetDownloadMany.retry_queue']:
+                item.log_output("Finished %s for %s\n" % (self, item.description()))
+                self.complete_item(item)
+
+    def next_url(self, item):
         urls_index = item['WgetDownloadMany.urls_index']
         urls = item['WgetDownloadMany.urls']
 
         if urls_index < len(urls):
-            item['WgetDownloadMany.current_url'] = urls[urls_index]
             item['WgetDownloadMany.urls_index'] += 1
-            return True
-        else:
-            return False
+            return urls[urls_index]
+
+        retry_queue = item['WgetDownloadMany.retry_queue']
+        now = time.time()
+
+        for index, (url, retry_time) in enumerate(retry_queue):
+            if retry_time <= now:
+                del retry_queue[index]
+                return url
+
+    def schedule_retry_timeout(self, item):
+        '''Call process once the next URL in the retry queue is due'''
+        if item['WgetDownloadMany.retry_timeout'] is not None:
+            return
+
+        retry_time = min(retry_time for dummy, retry_time
+            in item['WgetDownloadMany.retry_queue'])
+        item['WgetDownloadMany.retry_timeout'] = IOLoop.instance().add_timeout(
+            datetime.timedelta(seconds=max(0, retry_time - time.time())),
+            functools.partial(self.on_retry_timeout, item))
+
+    def cancel_retry_timeout(self, item):
+        if item['WgetDownloadMany.retry_timeout'] is not None:
+            IOLoop.instance().remove_timeout(
+                item['WgetDownloadMany.retry_timeout'])
+            item['WgetDownloadMany.retry_timeout'] = None
+
+    def on_retry_timeout(self, item):
+        item['WgetDownloadMany.retry_timeout'] = None
+        self.process(item)
 
-    def process_one(self, item):
-        with self.task_cwd():
-            url = item['WgetDownloadMany.current_url']
+    def finish_url(self, item):
+        item['WgetDownloadMany.active'] -= 1
+        self.process(item)
 
-            item.log_output("Start downloading URL %s" % url)
+    def process_one(self, item, url):
+        item.log_output("Start downloading URL %s" % url)
 
+        self.run_process(item, [url], realize(self.env, item),
+            functools.partial(self.on_subprocess_end, item, url))
+
+    def run_process(self, item, urls, env, on_end):
+        with self.task_cwd():
             p = seesaw.externalprocess.AsyncPopen(
-              args=realize(self.args, item) + [url],
-              env=realize(self.env, item),
+              args=realize(self.args, item) + urls,
+              env=env,
               stdin=subprocess.PIPE,
               close_fds=True
             )
 
             p.on_output += functools.partial(self.on_subprocess_stdout, p, item)
-            p.on_end += functools.partial(self.on_subprocess_end, item)
+            p.on_end += on_end
 
             p.run()
 
@@ -326,84 +538,666 @@ class WgetDownloadMany(Task):
     def on_subprocess_stdout(self, pipe, item, data):
         item.log_output(data, full_line=False)
 
-    def on_subprocess_end(self, item, returncode):
+    def on_subprocess_end(self, item, url, returncode):
         if returncode in self.accept_on_exit_code:
-            self.handle_process_result(returncode, item)
+            self.handle_process_result(returncode, item, url)
         else:
-            self.handle_process_error(returncode, item)
+            self.handle_process_error(returncode, item, url)
 
-    def handle_process_result(self, exit_code, item):
-        if self.set_next_url(item):
-            self.process_one(item)
-        else:
-            item.log_output("Finished %s for %s\n" % (self, item.description()))
-            self.complete_item(item)
+    def handle_process_result(self, exit_code, item, url):
+        self.finish_url(item)
 
-    def handle_process_error(self, exit_code, item):
-        item["tries"] += 1
+    def handle_process_error(self, exit_code, item, url):
+        tries = item['WgetDownloadMany.tries']
+        tries[url] = tries.get(url, 1) + 1
 
         item.log_output("Process %s returned exit code %d for %s\n" % (self, exit_code, item.description()))
         item.log_error(self, exit_code)
 
-        if (self.max_tries == None or item["tries"] < self.max_tries) and (self.retry_on_exit_code == None or exit_code in self.retry_on_exit_code):
-            item.log_output("Retrying %s for %s after %d seconds...\n" % (self, item.description(), self.retry_delay))
-            IOLoop.instance().add_timeout(datetime.timedelta(seconds=self.retry_delay),
-                functools.partial(self.process_one, item))
-
+        if (self.max_tries == None or tries[url] < self.max_tries) and (self.retry_on_exit_code == None or exit_code in self.retry_on_exit_code):
+            item.log_output("Retrying %s after %d seconds...\n" % (url, self.retry_delay))
+            item['WgetDownloadMany.retry_queue'].append(
+                (url, time.time() + self.retry_delay))
         else:
-            item.log_output("Failed %s for %s\n" % (self, item.description()))
-            self.fail_item(item)
+            item['WgetDownloadMany.failed'] = True
+
+        self.finish_url(item)
+
+
+class RateController(object):
+    '''A token bucket shared by every download of the process.
+
+    The rate is adjusted with additive increase, multiplicative decrease:
+    every good response raises it by `increase` requests per second and
+    every other error, or response slower than `slow_response_time`, cuts it
+    by `decrease_factor`. When only the time of the whole download is known,
+    the time to transfer its bytes at `min_bytes_per_second` is not counted
+    as slowness.
+    '''
+    def __init__(self, rate=4.0, min_rate=1.0 / 300, max_rate=20.0,
+    burst=4.0, increase=0.1, decrease_factor=0.5, slow_response_time=30.0,
+    min_bytes_per_second=50000.0):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.slow_response_time = slow_response_time
+        self.min_bytes_per_second = min_bytes_per_second
+        self.tokens = burst
+        self.last_refill = time.time()
+        self.waiters = collections.deque()
+        self.timeout = None
+
+    def acquire(self, callback, count=1):
+        '''Call the callback once a request may be made.
+
+        A `count` above 1 reserves tokens for that many requests; the
+        requests that follow wait until the debt is paid off.
+        '''
+        self.waiters.append((callback, count))
+        self._dispatch()
+
+    def report(self, exit_code, response_time, num_bytes=0):
+        '''Adjust the rate from the outcome of a request.
+
+        `response_time` is the time until the response started, or the
+        time of the whole download of `num_bytes` bytes. It is None when
+        it is not known.
+
+        Returns True if the rate was lowered.
+        '''
+        if response_time is None:
+            is_slow = False
+        else:
+            is_slow = response_time - num_bytes / self.min_bytes_per_second \
+                > self.slow_response_time
+
+        if exit_code not in (0, EXIT_STATUS_PERMISSION_DENIED,
+        EXIT_STATUS_NOT_FOUND) or is_slow:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self.tokens = min(self.tokens, 0)
+            return True
+        else:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+            return False
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+            self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def _dispatch(self):
+        self._refill()
+
+        while self.waiters and self.tokens >= 1:
+            callback, count = self.waiters.popleft()
+            self.tokens -= count
+            IOLoop.instance().add_callback(callback)
+
+        if self.waiters and not self.timeout:
+            delay_seconds = (1 - self.tokens) / self.rate
+            self.timeout = IOLoop.instance().add_timeout(
+                datetime.timedelta(seconds=delay_seconds), self._on_timeout)
+
+    def _on_timeout(self):
+        self.timeout = None
+        self._dispatch()
+
+
+rate_controller = RateController()
 
 
 class SpecializedWgetDownloadMany(WgetDownloadMany):
-    SUCCESS_DELAY = 0.2  # seconds
-    MAX_ERROR_DELAY = 60 * 5  # seconds
-    MIN_ERROR_DELAY = 10.0  # seconds
-    EXP_RATE = 1.5
-    current_error_delay = MIN_ERROR_DELAY  # seconds
+    '''Records the exit status of each sub item.
 
-    def process_one(self, item):
-        sub_item_name = item['WgetDownloadMany.current_url'].rsplit('/', 1)[-1]
+    Downloads are paced by the process-wide rate controller rather than by
+    delays of their own.
+    '''
+    def process_one(self, item, url):
+        rate_controller.acquire(
+            functools.partial(self.start_one, item, url))
 
+    def start_one(self, item, url):
+        sub_item_name = url.rsplit('/', 1)[-1]
+        item['sub_items'][sub_item_name]['start_time'] = time.time()
+        self.start_download(item, url)
+
+    def start_download(self, item, url):
+        sub_item_name = url.rsplit('/', 1)[-1]
+
+        # used by the wget arguments, which are realized right away
         item['current_warc_file_base'] = item['sub_items'][sub_item_name
             ]['warc_file_base']
 
-        WgetDownloadMany.process_one(self, item)
+        WgetDownloadMany.process_one(self, item, url)
 
-    def save_exit_code(self, exit_code, item):
-        sub_item_name = item['WgetDownloadMany.current_url'].rsplit('/', 1)[-1]
-        item['sub_items'][sub_item_name]['wget_exit_status'] = exit_code
+    def save_exit_code(self, exit_code, item, url):
+        sub_item_name = url.rsplit('/', 1)[-1]
+        sub_item = item['sub_items'][sub_item_name]
+        sub_item['wget_exit_status'] = exit_code
 
-    def handle_process_result(self, exit_code, item):
-        self.save_exit_code(exit_code, item)
-        delay_seconds = random.uniform(self.SUCCESS_DELAY * 0.5,
-                self.SUCCESS_DELAY * 2.0)
-        self.current_error_delay = self.MIN_ERROR_DELAY
+        if sub_item.get('response_time') is not None:
+            # the time to the response headers, from NativeDownloadMany
+            response_time = sub_item['response_time']
+            num_bytes = 0
+        else:
+            # wget only tells when the download has ended
+            response_time = time.time() - sub_item['start_time']
+            warc_path = "%s/%s.warc.gz" % (item['item_dir'],
+                sub_item['warc_file_base'])
 
-        IOLoop.instance().add_timeout(
-            datetime.timedelta(seconds=delay_seconds),
-            functools.partial(WgetDownloadMany.handle_process_result,
-                self, exit_code, item))
+            if os.path.exists(warc_path):
+                num_bytes = os.path.getsize(warc_path)
+            else:
+                num_bytes = 0
 
-    def handle_process_error(self, exit_code, item):
-        self.save_exit_code(exit_code, item)
+        if rate_controller.report(exit_code, response_time, num_bytes):
+            item.log_output('Request rate lowered to %.2f per second.'
+                % rate_controller.rate)
+
+    def handle_process_result(self, exit_code, item, url):
+        self.save_exit_code(exit_code, item, url)
+        WgetDownloadMany.handle_process_result(self, exit_code, item, url)
+
+    def handle_process_error(self, exit_code, item, url):
+        self.save_exit_code(exit_code, item, url)
 
         if exit_code == EXIT_STATUS_OTHER_ERROR:
-            self.current_error_delay *= self.EXP_RATE
-            self.current_error_delay = min(self.current_error_delay,
-                self.MAX_ERROR_DELAY)
-
-            delay_seconds = self.current_error_delay
-            item.log_output('Unexpected response from server. '
-                'Waiting for %d seconds before continuing...' % delay_seconds)
-            self.retry_delay = 0  # we'll use our own delay
-            IOLoop.instance().add_timeout(
-                datetime.timedelta(seconds=delay_seconds),
-                functools.partial(WgetDownloadMany.handle_process_error,
-                    self, exit_code, item))
+            # the rate controller delays the retry
+            self.retry_delay = 0
         else:
             self.retry_delay = 30
-            WgetDownloadMany.handle_process_error(self, exit_code, item)
+
+        WgetDownloadMany.handle_process_error(self, exit_code, item, url)
+
+
+class SpecializedWgetDownloadBatch(SpecializedWgetDownloadMany):
+    '''Runs one wget-lua over all pending URLs of an item.
+
+    puush.lua appends the result of each URL to a status file and only
+    exits at a response other than 200 or 404, so wget does not retry it
+    behind the rate controller's back. The combined WARC is split into the
+    usual per sub item WARCs afterwards. URLs that failed or were never
+    reached are retried in another batch.
+
+    With a concurrency above 1, the pending URLs are divided between that
+    many wget-lua processes.
+    '''
+    def enqueue(self, item):
+        self.start_item(item)
+        item.log_output("Starting %s for %s\n" % (self, item.description()))
+        item['WgetDownloadMany.urls'] = realize(self.unrealized_urls, item)
+        item['WgetDownloadMany.tries'] = {}
+        item['WgetDownloadMany.active'] = 0
+        item['WgetDownloadBatch.batch_index'] = 0
+        item['WgetDownloadBatch.num_failed'] = 0
+        self.process(item)
+
+    def pending_urls(self, item):
+        urls = []
+
+        for url in item['WgetDownloadMany.urls']:
+            sub_item_name = url.rsplit('/', 1)[-1]
+            exit_status = item['sub_items'][sub_item_name]['wget_exit_status']
+
+            if exit_status is None or exit_status == EXIT_STATUS_OTHER_ERROR:
+                urls.append(url)
+
+        return urls
+
+    def process(self, item):
+        urls = self.pending_urls(item)
+        concurrency = int(realize(self.concurrency, item))
+        batch_size = max(1, -(-len(urls) // concurrency))
+        item['WgetDownloadBatch.num_failed'] = 0
+
+        if not urls:
+            item.log_output("Finished %s for %s\n" % (self, item.description()))
+            self.complete_item(item)
+            return
+
+        for index in xrange(0, len(urls), batch_size):
+            item['WgetDownloadMany.active'] += 1
+            self.process_batch(item, urls[index:index + batch_size])
+
+    def process_batch(self, item, urls):
+        rate_controller.acquire(
+            functools.partial(self.start_batch, item, urls), len(urls))
+
+    def start_batch(self, item, urls):
+        batch_name = 'batch-%d' % item['WgetDownloadBatch.batch_index']
+        item['WgetDownloadBatch.batch_index'] += 1
+
+        # used by the wget arguments, which are realized right away
+        item['current_warc_file_base'] = batch_name
+
+        env = dict(realize(self.env, item) or os.environ)
+        env['PUUSH_STATUS_FILE'] = '%s/%s.status' % (item['item_dir'],
+            batch_name)
+
+        item.log_output('Start downloading %d URLs' % len(urls))
+
+        # space the requests out as the rate controller would
+        wait_args = ['--wait', '%.3f' % (1.0 / rate_controller.rate)]
+
+        self.run_process(item, wait_args + urls, env,
+            functools.partial(self.on_batch_end, item, batch_name, urls))
+
+    def read_statuses(self, item, batch_name):
+        path = '%s/%s.status' % (item['item_dir'], batch_name)
+        statuses = {}
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    url, status = line.split()
+                    # wget may report a URL more than once if it retried it
+                    statuses[url] = int(status)
+
+        return statuses
+
+    def on_batch_end(self, item, batch_name, urls, returncode):
+        statuses = self.read_statuses(item, batch_name)
+        dest_paths = {}
+        num_failed = 0
+        rate_lowered = False
+
+        for url in urls:
+            sub_item_name = url.rsplit('/', 1)[-1]
+            sub_item = item['sub_items'][sub_item_name]
+            exit_code = statuses.get(url, EXIT_STATUS_OTHER_ERROR)
+            sub_item['wget_exit_status'] = exit_code
+
+            # the time of each URL of the batch is not known; the URLs
+            # after the one that stopped wget were never requested
+            if url in statuses and rate_controller.report(exit_code, None):
+                rate_lowered = True
+
+            if exit_code == 0:
+                dest_paths[url] = '%s/%s.warc.gz' % (item['item_dir'],
+                    sub_item['warc_file_base'])
+            else:
+                dest_paths[url] = None
+
+                if exit_code not in self.accept_on_exit_code:
+                    num_failed += 1
+
+        batch_warc_path = '%s/%s.warc.gz' % (item['item_dir'], batch_name)
+
+        if os.path.exists(batch_warc_path):
+            split_warc(batch_warc_path, dest_paths)
+            os.remove(batch_warc_path)
+
+        if num_failed:
+            item.log_output('%d of %d URLs failed (wget exit code %d)' % (
+                num_failed, len(urls), returncode))
+
+        if rate_lowered:
+            item.log_output('Request rate lowered to %.2f per second.'
+                % rate_controller.rate)
+
+        item['WgetDownloadMany.active'] -= 1
+        item['WgetDownloadBatch.num_failed'] += num_failed
+
+        if item['WgetDownloadMany.active'] == 0:
+            if item['WgetDownloadBatch.num_failed']:
+                self.handle_batch_error(item)
+            else:
+                item.log_output("Finished %s for %s\n" % (self, item.description()))
+                self.complete_item(item)
+
+    def handle_batch_error(self, item):
+        tries = item['WgetDownloadMany.tries']
+        item.log_error(self, EXIT_STATUS_OTHER_ERROR)
+
+        for url in self.pending_urls(item):
+            tries[url] = tries.get(url, 1) + 1
+
+        if self.max_tries is not None and max(tries.values()) >= self.max_tries:
+            item.log_output("Failed %s for %s\n" % (self, item.description()))
+            self.fail_item(item)
+            return
+
+        # the rate controller delays the retry
+        item.log_output('Unexpected response from server. Retrying.')
+        self.process(item)
+
+
+def classify_response(status_code, body_head):
+    '''Return the exit status puush.lua would give for the response.
+
+    `body_head` is the first 100 bytes of the body.
+    '''
+    if status_code == 200:
+        if body_head == PERMISSION_DENIED_MESSAGE:
+            return EXIT_STATUS_PERMISSION_DENIED
+        else:
+            return 0
+    elif status_code == 404:
+        return EXIT_STATUS_NOT_FOUND
+    else:
+        return EXIT_STATUS_OTHER_ERROR
+
+
+class BodyHead(object):
+    '''Keeps the status and the first `SIZE` bytes of a response.
+
+    The download is stopped once they have arrived, in case the server
+    ignores the range and sends the whole file.
+    '''
+    SIZE = 100
+
+    def __init__(self):
+        self.status_code = None
+        self.data = ''
+
+    def on_header_line(self, line):
+        if line.startswith('HTTP/'):
+            self.status_code = int(line.split()[1])
+
+    def on_body_data(self, data):
+        self.data += data[:self.SIZE - len(self.data)]
+
+    def prepare_curl(self, curl):
+        # the curl client only runs the streaming callback later on the
+        # IOLoop, so the transfer is stopped from curl's own write function
+        def write_function(data):
+            self.on_body_data(data)
+
+            if len(self.data) >= self.SIZE:
+                # a short count makes curl stop the transfer
+                return 0
+
+        curl.setopt(pycurl.WRITEFUNCTION, write_function)
+
+
+class PreClassify(Task):
+    '''Records the exit status of the IDs that do not need a download.
+
+    The first 100 bytes of every URL are requested with a ranged GET over
+    the kept alive connections of the HTTP client, paced by the rate
+    controller. Not found and permission denied responses are saved as the
+    exit status of the sub item, so PrepareDirectories and the download
+    task skip it. The other IDs are left to the download task.
+    '''
+    def __init__(self, urls, user_agent, concurrency=1):
+        Task.__init__(self, "PreClassify")
+        self.unrealized_urls = urls
+        self.user_agent = user_agent
+        self.concurrency = concurrency
+
+    def enqueue(self, item):
+        self.start_item(item)
+        item['PreClassify.urls'] = list(realize(self.unrealized_urls, item))
+        item['PreClassify.active'] = 0
+        item['PreClassify.num_skipped'] = 0
+        self.process(item)
+
+    def process(self, item):
+        concurrency = int(realize(self.concurrency, item))
+        urls = item['PreClassify.urls']
+
+        while urls and item['PreClassify.active'] < concurrency:
+            item['PreClassify.active'] += 1
+            rate_controller.acquire(
+                functools.partial(self.fetch, item, urls.pop(0)))
+
+        if item['PreClassify.active'] == 0:
+            item.log_output('%d of %d IDs do not need a download.' % (
+                item['PreClassify.num_skipped'], len(item['sub_items'])))
+            self.complete_item(item)
+
+    def fetch(self, item, url):
+        body_head = BodyHead()
+        request = HTTPRequest(url,
+            headers={'User-Agent': self.user_agent, 'Accept': '*/*',
+                'Range': 'bytes=0-%d' % (BodyHead.SIZE - 1)},
+            follow_redirects=False,
+            use_gzip=False,
+            validate_cert=False,
+            connect_timeout=60,
+            request_timeout=60,
+            header_callback=body_head.on_header_line,
+            streaming_callback=body_head.on_body_data,
+            prepare_curl_callback=body_head.prepare_curl,
+        )
+
+        get_body_head_http_client().fetch(request,
+            functools.partial(self.on_response, item, url, time.time(),
+                body_head))
+
+    def on_response(self, item, url, start_time, body_head, response):
+        if response.code == 599 and body_head.status_code:
+            # the download was stopped after the status line
+            status_code = body_head.status_code
+        else:
+            status_code = response.code
+
+        if status_code == 599:
+            exit_code = EXIT_STATUS_OTHER_ERROR
+        elif status_code == 206:
+            exit_code = classify_response(200, body_head.data)
+        else:
+            exit_code = classify_response(status_code, body_head.data)
+
+        if rate_controller.report(exit_code, time.time() - start_time):
+            item.log_output('Request rate lowered to %.2f per second.'
+                % rate_controller.rate)
+
+        if exit_code in (EXIT_STATUS_PERMISSION_DENIED,
+        EXIT_STATUS_NOT_FOUND):
+            sub_item_name = url.rsplit('/', 1)[-1]
+            item['sub_items'][sub_item_name]['wget_exit_status'] = exit_code
+            item['PreClassify.num_skipped'] += 1
+
+        item['PreClassify.active'] -= 1
+        self.process(item)
+
+
+def preclassify_enabled(item):
+    return PRECLASSIFY
+
+
+_http_client = None
+_body_head_http_client = None
+
+
+def get_http_client():
+    '''Return the HTTP client shared by the downloads'''
+    global _http_client
+
+    if not _http_client:
+        if CurlAsyncHTTPClient:
+            _http_client = CurlAsyncHTTPClient(IOLoop.instance(),
+                force_instance=True)
+        else:
+            _http_client = AsyncHTTPClient(IOLoop.instance(),
+                force_instance=True)
+
+    return _http_client
+
+
+def get_body_head_http_client():
+    '''Return the HTTP client of PreClassify.
+
+    The simple client fails the responses with a body larger than
+    `BodyHead.SIZE` instead of reading them.
+    '''
+    global _body_head_http_client
+
+    if CurlAsyncHTTPClient:
+        return get_http_client()
+
+    if not _body_head_http_client:
+        _body_head_http_client = AsyncHTTPClient(IOLoop.instance(),
+            force_instance=True, max_body_size=BodyHead.SIZE)
+
+    return _body_head_http_client
+
+
+class PuushFetch(object):
+    '''Downloads a URL into its own WARC file.
+
+    The callback is called with the exit status puush.lua would have
+    given, the HTTPResponse and the seconds until the response headers
+    arrived, or None if they never did.
+    '''
+    SPOOL_SIZE = 1048576  # bytes
+
+    def __init__(self, url, warc_path, user_agent, warc_headers, callback):
+        self.url = url
+        self.warc_path = warc_path
+        self.user_agent = user_agent
+        self.warc_headers = warc_headers
+        self.callback = callback
+        self.header_lines = []
+        self.body_head = ''
+        self.start_time = None
+        self.response_time = None
+
+    def start(self, http_client):
+        self.start_time = time.time()
+        self.warc_file = open(self.warc_path, 'wb')
+        self.warc_writer = WARCWriter(self.warc_file)
+        self.warcinfo_id = self.warc_writer.write_warcinfo(
+            os.path.basename(self.warc_path),
+            [
+                ('software', 'puush-grab/%s' % VERSION),
+                ('format', 'WARC File Format 1.0'),
+                ('conformsTo', 'http://bibnum.bnf.fr/WARC/'
+                    'WARC_ISO_28500_version1_latestdraft.pdf'),
+            ] + self.warc_headers
+        )
+        self.payload_file = tempfile.SpooledTemporaryFile(self.SPOOL_SIZE)
+
+        request = HTTPRequest(self.url,
+            headers={'User-Agent': self.user_agent, 'Accept': '*/*'},
+            follow_redirects=False,
+            use_gzip=False,
+            validate_cert=False,
+            connect_timeout=60,
+            request_timeout=3600,
+            header_callback=self._on_header_line,
+            streaming_callback=self._on_body_data,
+        )
+
+        http_client.fetch(request, self._on_response)
+
+    def request_block(self):
+        url_info = urlparse.urlsplit(self.url)
+        path = url_info.path or '/'
+
+        if url_info.query:
+            path += '?' + url_info.query
+
+        return (
+            'GET %s HTTP/1.1\r\n'
+            'User-Agent: %s\r\n'
+            'Accept: */*\r\n'
+            'Host: %s\r\n'
+            'Connection: Keep-Alive\r\n'
+            '\r\n'
+        ) % (path, self.user_agent, url_info.netloc)
+
+    def _on_header_line(self, line):
+        if self.response_time is None:
+            self.response_time = time.time() - self.start_time
+
+        if line.startswith('HTTP/'):
+            # a new response, such as after a 100 Continue
+            self.header_lines = []
+
+        self.header_lines.append(line)
+
+    def response_header(self, payload_length):
+        '''Return the header of the response as it is stored.
+
+        The HTTP client hands over the payload with the transfer coding
+        removed, so a chunked response is stored with a Content-Length
+        instead of its Transfer-Encoding.
+        '''
+        field_names = [line.split(':', 1)[0].strip().lower()
+            for line in self.header_lines[1:]]
+
+        if 'transfer-encoding' not in field_names:
+            return ''.join(self.header_lines)
+
+        lines = [self.header_lines[0]]
+
+        for line, field_name in zip(self.header_lines[1:], field_names):
+            if field_name not in ('transfer-encoding', 'content-length') \
+            and line.strip():
+                lines.append(line)
+
+        lines.append('Content-Length: %d\r\n' % payload_length)
+        lines.append('\r\n')
+        return ''.join(lines)
+
+    def _on_body_data(self, data):
+        if len(self.body_head) < 100:
+            self.body_head += data[:100 - len(self.body_head)]
+
+        self.payload_file.write(data)
+
+    def _on_response(self, response):
+        try:
+            if response.code == 599:
+                exit_code = EXIT_STATUS_OTHER_ERROR
+            else:
+                exit_code = classify_response(response.code, self.body_head)
+                self.warc_writer.write_exchange(self.url, self.warcinfo_id,
+                    self.request_block(),
+                    self.response_header(self.payload_file.tell()),
+                    self.payload_file)
+        finally:
+            self.payload_file.close()
+            self.warc_file.close()
+
+        self.callback(exit_code, response, self.response_time)
+
+
+class NativeDownloadMany(SpecializedWgetDownloadMany):
+    '''Downloads the URLs on the IOLoop and writes the WARCs itself.
+
+    A drop-in replacement for SpecializedWgetDownloadMany that does the
+    classification of puush.lua in Python instead of running wget-lua for
+    every URL.
+    '''
+    def __init__(self, urls, user_agent, warc_headers, max_tries=1,
+    accept_on_exit_code=[0], concurrency=1):
+        SpecializedWgetDownloadMany.__init__(self, None, urls,
+            max_tries=max_tries, accept_on_exit_code=accept_on_exit_code,
+            concurrency=concurrency)
+        self.name = "NativeDownloadMany"
+        self.user_agent = user_agent
+        self.warc_headers = warc_headers
+
+    def start_download(self, item, url):
+        sub_item_name = url.rsplit('/', 1)[-1]
+        warc_path = "%s/%s.warc.gz" % (item['item_dir'],
+            item['sub_items'][sub_item_name]['warc_file_base'])
+
+        item.log_output("Start downloading URL %s" % url)
+
+        fetch = PuushFetch(url, warc_path, self.user_agent,
+            self.warc_headers, functools.partial(self.on_fetch_end, item, url))
+        fetch.start(get_http_client())
+
+    def on_fetch_end(self, item, url, exit_code, response, response_time):
+        sub_item_name = url.rsplit('/', 1)[-1]
+        item['sub_items'][sub_item_name]['response_time'] = response_time
+
+        if response.code == 599:
+            item.log_output("  Request failed for %s: %s" % (url, response.error))
+        else:
+            item.log_output("  Server returned status %d for %s" % (
+                response.code, url))
+
+        self.on_subprocess_end(item, url, exit_code)
 
 
 class MoveFiles(SimpleTask):
@@ -438,6 +1232,71 @@ class MoveFiles(SimpleTask):
                 "%(data_dir)s/%(warc_file_base)s.warc.gz" % d)
 
 
+class ConsolidateWarcs(SimpleTask):
+    """
+      After MoveFiles, this task joins the warc files of the sub items into
+      a single warc file for the item.
+
+      The gzip members are copied without recompressing them. A sidecar
+      index lists the offset, length and type of every record by sub item
+      name, one record per line. It is uploaded next to the warc file.
+      """
+    def __init__(self, warc_prefix):
+        SimpleTask.__init__(self, "ConsolidateWarcs")
+        self.warc_prefix = warc_prefix
+
+    def process(self, item):
+        alphabet = parse_item_name(item['item_name'])[2]
+        sub_item_names = sorted(
+            (sub_item_name for sub_item_name, sub_item
+                in item['sub_items'].iteritems()
+                if sub_item['wget_exit_status'] == 0),
+            key=lambda sub_item_name: base62_decode(sub_item_name, alphabet)
+        )
+
+        item['index_files'] = []
+
+        if not sub_item_names:
+            return
+
+        d = dict(
+            data_dir=item['data_dir'],
+            warc_file_base="%s-%s_%s-%s" % (
+                self.warc_prefix,
+                sub_item_names[0],
+                sub_item_names[-1],
+                time.strftime("%Y%m%d-%H%M%S")
+            ),
+        )
+        warc_path = "%(data_dir)s/%(warc_file_base)s.warc.gz" % d
+        index_path = "%(data_dir)s/%(warc_file_base)s.idx" % d
+
+        with open(warc_path, 'wb') as warc_file:
+            with open(index_path, 'w') as index_file:
+                for sub_item_name in sub_item_names:
+                    self.append_warc(item, sub_item_name, warc_file,
+                        index_file)
+
+        item['files_to_upload'] = [warc_path]
+        item['index_files'] = [index_path]
+
+    def append_warc(self, item, sub_item_name, warc_file, index_file):
+        path = "%s/%s.warc.gz" % (item['data_dir'],
+            item['sub_items'][sub_item_name]['warc_file_base'])
+        base_offset = warc_file.tell()
+
+        with open(path, 'rb') as part_file:
+            for offset, length, head in iter_gzip_members(part_file):
+                record_type = parse_record_header(head).get('warc-type', '-')
+                index_file.write("%s %d %d %s\n" % (sub_item_name,
+                    base_offset + offset, length, record_type))
+
+            part_file.seek(0)
+            shutil.copyfileobj(part_file, warc_file)
+
+        os.remove(path)
+
+
 class PrepareStatsForTracker2(SimpleTask):
     '''Similar to PrepareStatsForTracker but calls realize on files earlier'''
     def __init__(self, defaults=None, file_groups=None, id_function=None):
@@ -479,6 +1338,11 @@ def files_to_upload(item):
     return item['files_to_upload']
 
 
+class IndexFilesToUpload(object):
+    def realize(self, item):
+        return item.get('index_files', [])
+
+
 def prepare_stats_id_function(item):
     d = {'wget_exit_statuses': {}}
 
@@ -489,67 +1353,413 @@ def prepare_stats_id_function(item):
     return json.dumps(d)
 
 
-class UploadWithTracker2(TrackerRequest):
-    '''Similar to UploadWithTracker but calls realize on files earlier'''
-    def __init__(self, tracker_url, downloader, files, version=None, rsync_target_source_path="./", rsync_bwlimit="0", rsync_extra_args=[], curl_connect_timeout="60", curl_speed_limit="1", curl_speed_time="900"):
-        TrackerRequest.__init__(self, "Upload2", tracker_url, "upload")
+class UploadBatch(object):
+    def __init__(self):
+        self.items = []
+        self.item_files = []
+        self.item_extra_files = []
+        self.num_bytes = 0
+
+    def add(self, item, files, extra_files):
+        self.items.append(item)
+        self.item_files.append(files)
+        self.item_extra_files.append(extra_files)
+        self.num_bytes += sum(os.path.getsize(f) for f in files)
+
+    def remove_canceled(self):
+        '''Drop the items that were canceled while waiting'''
+        entries = [entry for entry
+            in zip(self.items, self.item_files, self.item_extra_files)
+            if not getattr(entry[0], 'canceled', False)]
+        self.items = [entry[0] for entry in entries]
+        self.item_files = [entry[1] for entry in entries]
+        self.item_extra_files = [entry[2] for entry in entries]
+
+    @property
+    def files(self):
+        return list(itertools.chain.from_iterable(self.item_files))
+
+    @property
+    def extra_files(self):
+        return list(itertools.chain.from_iterable(self.item_extra_files))
+
+
+class BatchedUploadWithTracker(Task):
+    '''Uploads the files of several items in one rsync or curl session.
+
+    Items wait until their files add up to `max_batch_bytes` or the first
+    of them has waited `max_batch_age` seconds. One tracker upload request
+    is made for the batch and each of its items is completed once the
+    upload has succeeded. At most `concurrency` batches upload at once.
+    '''
+    def __init__(self, tracker_url, downloader, files, version=None, concurrency=1, max_batch_bytes=100 * 1024 * 1024, max_batch_age=30, rsync_bwlimit="0", rsync_extra_args=[], rsync_extra_files=None, curl_connect_timeout="60", curl_speed_limit="1", curl_speed_time="900"):
+        Task.__init__(self, "BatchedUploadWithTracker")
+        self.http_client = AsyncHTTPClient()
+        self.tracker_url = tracker_url
+        self.retry_delay = 30
 
         self.downloader = downloader
         self.version = version
-
         self.files = files
-        self.rsync_target_source_path = rsync_target_source_path
+        self.concurrency = concurrency
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_age = max_batch_age
         self.rsync_bwlimit = rsync_bwlimit
         self.rsync_extra_args = rsync_extra_args
+        self.rsync_extra_files = rsync_extra_files
         self.curl_connect_timeout = curl_connect_timeout
         self.curl_speed_limit = curl_speed_limit
         self.curl_speed_time = curl_speed_time
 
-    def data(self, item):
+        self.current_batch = None
+        self.batch_timeout = None
+        self.waiting_batches = []
+        self.active_uploads = 0
+
+    def enqueue(self, item):
+        self.start_item(item)
+        item.log_output("Starting %s for %s\n" % (self, item.description()))
+
+        if not self.current_batch:
+            self.current_batch = UploadBatch()
+            self.batch_timeout = IOLoop.instance().add_timeout(
+                datetime.timedelta(seconds=self.max_batch_age), self.flush)
+
+        batch = self.current_batch
+        batch.add(item, realize(self.files, item),
+            realize(self.rsync_extra_files, item) or [])
+
+        item.log_output("Waiting to upload together with %d other items.\n"
+            % (len(batch.items) - 1))
+
+        if batch.num_bytes >= self.max_batch_bytes:
+            self.flush()
+
+    def flush(self):
+        if self.batch_timeout:
+            IOLoop.instance().remove_timeout(self.batch_timeout)
+            self.batch_timeout = None
+
+        if self.current_batch:
+            self.waiting_batches.append(self.current_batch)
+            self.current_batch = None
+
+        self.start_uploads()
+
+    def start_uploads(self):
+        while self.waiting_batches \
+        and self.active_uploads < int(realize(self.concurrency)):
+            self.active_uploads += 1
+            self.send_request(self.waiting_batches.pop(0))
+
+    def log_output(self, batch, data, full_line=True):
+        for item in batch.items:
+            item.log_output(data, full_line=full_line)
+
+    def skip_canceled(self, batch):
+        '''Drop the canceled items of a batch; return False if none are
+        left'''
+        batch.remove_canceled()
+
+        if batch.items:
+            return True
+
+        self.active_uploads -= 1
+        self.start_uploads()
+        return False
+
+    def send_request(self, batch):
+        if not self.skip_canceled(batch):
+            return
+
+        item = batch.items[0]
         data = {"downloader": realize(self.downloader, item),
                 "item_name": item["item_name"]}
         if self.version:
             data["version"] = realize(self.version, item)
-        return data
 
-    def process_body(self, body, item):
-        data = json.loads(body)
-        if "upload_target" in data:
-            files = realize(self.files, item)
-            inner_task = None
+        self.http_client.fetch(HTTPRequest(
+            "%s/upload" % self.tracker_url,
+            method="POST",
+            headers={"Content-Type": "application/json"},
+            user_agent=("ArchiveTeam Warrior/%s" % seesaw.__version__),
+            body=json.dumps(data)
+          ), functools.partial(self.handle_response, batch))
+
+    def handle_response(self, batch, response):
+        if response.code != 200:
+            self.schedule_retry(batch,
+                "Tracker returned status code %d. " % response.code)
+            return
+
+        data = json.loads(response.body)
+
+        if "upload_target" not in data:
+            self.schedule_retry(batch,
+                "Tracker did not provide an upload target. ")
+            return
+
+        upload_target = data["upload_target"]
+
+        if not self.skip_canceled(batch):
+            return
+
+        if re.match(r"^rsync://", upload_target):
+            self.log_output(batch, "Uploading %d items with Rsync to %s"
+                % (len(batch.items), upload_target))
+            args = [
+                "rsync",
+                "-avz",
+                "--compress-level=9",
+                "--timeout=300",
+                "--contimeout=300",
+                "--progress",
+                "--bwlimit", self.rsync_bwlimit
+            ] + self.rsync_extra_args + [
+                # the files come from several item directories
+                "--files-from=-",
+                "--no-relative",
+                "/",
+                upload_target
+            ]
+            stdin_data = "".join("%s\n" % os.path.relpath(f, "/")
+                for f in batch.files + batch.extra_files)
+
+            self.run_upload(batch, args, stdin_data,
+                functools.partial(self.on_upload_end, batch))
+
+        elif re.match(r"^https?://", upload_target):
+            self.log_output(batch, "Uploading %d items with Curl to %s"
+                % (len(batch.items), upload_target))
+            self.curl_upload(batch, upload_target, 0)
 
-            if re.match(r"^rsync://", data["upload_target"]):
-                item.log_output("Uploading with Rsync to %s" % data["upload_target"])
-                inner_task = RsyncUpload(data["upload_target"], files, target_source_path=self.rsync_target_source_path, bwlimit=self.rsync_bwlimit, extra_args=self.rsync_extra_args, max_tries=1)
+        else:
+            self.log_output(batch, "Received invalid upload type.")
+            self.fail_batch(batch)
+
+    def curl_upload(self, batch, upload_target, index):
+        '''Upload the files of a batch one after the other, as curl uploads
+        a single file to a target'''
+        files = batch.files
+
+        if index == len(files):
+            self.on_upload_end(batch, 0)
+            return
+
+        args = [
+            "curl",
+            "--fail",
+            "--output", "/dev/null",
+            "--connect-timeout", str(self.curl_connect_timeout),
+            "--speed-limit", str(self.curl_speed_limit),
+            "--speed-time", str(self.curl_speed_time),
+            "--header", "X-Curl-Limits: inf,%s,%s" % (
+                self.curl_speed_limit, self.curl_speed_time),
+            "--write-out", "Upload server: %{url_effective}\\n",
+            "--location",
+            "--upload-file", files[index],
+            upload_target
+        ]
+
+        self.run_upload(batch, args, "",
+            functools.partial(self.on_curl_upload_end, batch, upload_target,
+                index))
+
+    def on_curl_upload_end(self, batch, upload_target, index, returncode):
+        if returncode == 0:
+            self.curl_upload(batch, upload_target, index + 1)
+        else:
+            self.on_upload_end(batch, returncode)
 
-            elif re.match(r"^https?://", data["upload_target"]):
-                item.log_output("Uploading with Curl to %s" % data["upload_target"])
+    def run_upload(self, batch, args, stdin_data, on_end):
+        p = seesaw.externalprocess.AsyncPopen(
+            args=args,
+            stdin=subprocess.PIPE,
+            close_fds=True
+        )
 
-                if len(files) != 1:
-                    item.log_output("Curl expects to upload a single file.")
-                    self.fail_item(item)
-                    return
+        p.on_output += functools.partial(self.log_output, batch,
+            full_line=False)
+        p.on_end += on_end
 
-                inner_task = CurlUpload(data["upload_target"], files[0], self.curl_connect_timeout, self.curl_speed_limit, self.curl_speed_time, max_tries=1)
+        p.run()
 
-            else:
-                item.log_output("Received invalid upload type.")
-                self.fail_item(item)
-                return
+        p.stdin.write(stdin_data)
+        p.stdin.close()
 
-            inner_task.on_complete_item += self._inner_task_complete_item
-            inner_task.on_fail_item += self._inner_task_fail_item
-            inner_task.enqueue(item)
+    def on_upload_end(self, batch, returncode):
+        if returncode == 0:
+            self.active_uploads -= 1
 
+            for item in batch.items:
+                self.complete_item(item)
+
+            self.start_uploads()
         else:
-            item.log_output("Tracker did not provide an upload target.")
-            self.schedule_retry(item)
+            self.schedule_retry(batch,
+                "Upload returned exit code %d. " % returncode)
 
-    def _inner_task_complete_item(self, task, item):
-        self.complete_item(item)
+    def fail_batch(self, batch):
+        self.active_uploads -= 1
 
-    def _inner_task_fail_item(self, task, item):
-        self.schedule_retry(item)
+        for item in batch.items:
+            self.fail_item(item)
+
+        self.start_uploads()
+
+    def schedule_retry(self, batch, message=""):
+        self.log_output(batch, "%sRetrying after %d seconds...\n"
+            % (message, self.retry_delay))
+        IOLoop.instance().add_timeout(
+            datetime.timedelta(seconds=self.retry_delay),
+            functools.partial(self.send_request, batch))
+
+
+class TrackerReporter(object):
+    '''Sends done reports to the tracker in the background.
+
+    Each report is first written to its own file in `outbox_dir` and is
+    only removed once the tracker has confirmed it, so reports left over
+    by a restart are sent again. Reports are sent in batches of up to
+    `batch_size` requests at a time.
+
+    Reports that the tracker has rejected are sent after the others. A
+    report rejected `max_rejections` times is moved to the ``failed``
+    directory of the outbox. Failures to reach the tracker are not
+    counted as rejections.
+    '''
+    def __init__(self, tracker_url, outbox_dir, batch_size=10,
+    batch_delay=1.0, max_rejections=5):
+        self.http_client = AsyncHTTPClient()
+        self.tracker_url = tracker_url
+        self.outbox_dir = outbox_dir
+        self.failed_dir = os.path.join(outbox_dir, "failed")
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.max_rejections = max_rejections
+        self.retry_delay = 30
+        self.counter = 0
+        self.rejections = {}
+        self.sending = False
+        self.timeout = None
+
+        if not os.path.isdir(outbox_dir):
+            os.makedirs(outbox_dir)
+
+        if os.listdir(outbox_dir):
+            self.schedule_send(self.batch_delay)
+
+    def add(self, stats):
+        self.counter += 1
+        filename = "%d-%06d.json" % (time.time() * 1000, self.counter)
+        path = os.path.join(self.outbox_dir, filename)
+
+        with open(path + "-new", "w") as f:
+            json.dump(stats, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(path + "-new", path)
+
+        # make the rename itself survive a crash
+        dir_fd = os.open(self.outbox_dir, os.O_RDONLY)
+
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+        self.schedule_send(self.batch_delay)
+
+    def schedule_send(self, delay_seconds):
+        if not self.sending and not self.timeout:
+            self.timeout = IOLoop.instance().add_timeout(
+                datetime.timedelta(seconds=delay_seconds), self.send_batch)
+
+    def send_batch(self):
+        self.timeout = None
+        filenames = sorted((filename for filename
+            in os.listdir(self.outbox_dir) if filename.endswith(".json")),
+            key=lambda filename: (self.rejections.get(filename, 0),
+                filename))
+        filenames = filenames[:self.batch_size]
+
+        if not filenames:
+            return
+
+        self.sending = True
+        pending = [len(filenames)]
+        failed = [False]
+
+        for filename in filenames:
+            path = os.path.join(self.outbox_dir, filename)
+
+            with open(path, "r") as f:
+                body = f.read()
+
+            self.http_client.fetch(HTTPRequest(
+                "%s/done" % self.tracker_url,
+                method="POST",
+                headers={"Content-Type": "application/json"},
+                user_agent=("ArchiveTeam Warrior/%s" % seesaw.__version__),
+                body=body
+              ), functools.partial(self.handle_response, path, pending,
+                failed))
+
+    def handle_response(self, path, pending, failed, response):
+        filename = os.path.basename(path)
+
+        if response.code == 200 and response.body.strip() == "OK":
+            os.remove(path)
+            self.rejections.pop(filename, None)
+        else:
+            failed[0] = True
+
+            if response.code != 599 and response.code < 500 \
+            and response.code not in (420, 429):
+                self.reject(path, response)
+
+        pending[0] -= 1
+
+        if not pending[0]:
+            self.sending = False
+
+            if failed[0]:
+                self.schedule_send(self.retry_delay)
+            else:
+                self.schedule_send(0)
+
+    def reject(self, path, response):
+        filename = os.path.basename(path)
+        self.rejections[filename] = self.rejections.get(filename, 0) + 1
+
+        if self.rejections[filename] < self.max_rejections:
+            return
+
+        del self.rejections[filename]
+
+        if not os.path.isdir(self.failed_dir):
+            os.makedirs(self.failed_dir)
+
+        os.rename(path, os.path.join(self.failed_dir, filename))
+        sys.stderr.write("The tracker rejected the report %s %d times "
+            "(status %d: %r). It is moved to %s.\n" % (filename,
+            self.max_rejections, response.code, (response.body or "")[:100],
+            self.failed_dir))
+
+
+class QueueDoneForTracker(SimpleTask):
+    '''Hands the stats to a TrackerReporter instead of waiting for the
+    tracker like SendDoneToTracker'''
+    def __init__(self, reporter, stats):
+        SimpleTask.__init__(self, "QueueDoneForTracker")
+        self.reporter = reporter
+        self.stats = stats
+
+    def process(self, item):
+        self.reporter.add(realize(self.stats, item))
+        item.log_output("Queued item '%s' to be reported to the tracker.\n"
+            % item["item_name"])
 
 
 
@@ -568,17 +1778,44 @@ project = Project(
     # , utc_deadline = datetime.datetime(2013,08,01, 00,00,1)
 )
 
-pipeline = Pipeline(
-    GetItemFromTracker("http://%s/%s" % (TRACKER_HOST, TRACKER_ID), downloader, VERSION),
-    ExtraItemParams(),
-    PrepareDirectories(warc_prefix="puush"),
-    SpecializedWgetDownloadMany([ WGET_LUA,
+download_concurrency = NumberConfigValue(min=1, max=8, default="1",
+    name="puush:download_threads",
+    title="Download threads",
+    description="The number of puush IDs of an item to download at once.")
+
+accept_on_exit_code = [
+    0,
+    EXIT_STATUS_PERMISSION_DENIED,
+    EXIT_STATUS_NOT_FOUND
+]  # see the lua script, also MoveFiles
+
+if DOWNLOAD_ENGINE == 'native':
+    download_task = NativeDownloadMany(
+        URLsToDownload(),
+        user_agent=USER_AGENT,
+        warc_headers=[
+            ("operator", "Archive Team"),
+            ("puush-dld-script-version", VERSION),
+        ],
+        max_tries=20,
+        accept_on_exit_code=accept_on_exit_code,
+        concurrency=download_concurrency,
+    )
+else:
+    if DOWNLOAD_ENGINE == 'wget-batch':
+        DownloadTask = SpecializedWgetDownloadBatch
+    elif DOWNLOAD_ENGINE == 'wget':
+        DownloadTask = SpecializedWgetDownloadMany
+    else:
+        raise Exception("Unknown download engine %s." % DOWNLOAD_ENGINE)
+
+    download_task = DownloadTask([ WGET_LUA,
           "-U", USER_AGENT,
           "-nv",
-          "-o", ItemInterpolation("%(item_dir)s/wget.log"),
+          "-o", ItemInterpolation("%(item_dir)s/%(current_warc_file_base)s.log"),
           "--lua-script", "puush.lua",
           "--no-check-certificate",
-          "--output-document", ItemInterpolation("%(item_dir)s/wget.tmp"),
+          "--output-document", ItemInterpolation("%(item_dir)s/%(current_warc_file_base)s.tmp"),
           "--truncate-output",
           "-e", "robots=off",
           "--rotate-dns",
@@ -591,13 +1828,42 @@ pipeline = Pipeline(
         ],
         URLsToDownload(),
         max_tries=20,
-        accept_on_exit_code=[
-            0,
-            EXIT_STATUS_PERMISSION_DENIED,
-            EXIT_STATUS_NOT_FOUND
-        ],  # see the lua script, also MoveFiles
+        accept_on_exit_code=accept_on_exit_code,
+        concurrency=download_concurrency,
+    )
+
+item_prefetcher = ItemPrefetcher(
+    "http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
+    downloader,
+    VERSION,
+    size=NumberConfigValue(min=0, max=10, default="2",
+        name="puush:prefetch_items",
+        title="Prefetched items",
+        description="The number of items to claim from the tracker ahead "
+            "of time."),
+    backlog_path=os.path.join(os.getcwd(), "prefetched_items.json"),
+)
+
+tracker_reporter = TrackerReporter(
+    "http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
+    outbox_dir=os.path.join(os.getcwd(), "tracker_outbox"),
+)
+
+pipeline = Pipeline(
+    PrefetchItemFromTracker(item_prefetcher),
+    ExtraItemParams(),
+    ConditionalTask(
+        preclassify_enabled,
+        PreClassify(
+            URLsToDownload(),
+            user_agent=USER_AGENT,
+            concurrency=download_concurrency,
+        )
     ),
+    PrepareDirectories(warc_prefix="puush"),
+    download_task,
     MoveFiles(),
+    ConsolidateWarcs(warc_prefix="puush"),
     PrepareStatsForTracker2(
         defaults={ "downloader": downloader, "version": VERSION },
         file_groups={
@@ -606,29 +1872,27 @@ pipeline = Pipeline(
         id_function=prepare_stats_id_function,
     ),
     CleanUpItemDir(),
-    LimitConcurrent(
-        NumberConfigValue(min=1, max=4, default="1",
-            name="shared:rsync_threads",
-            title="Rsync threads",
-            description="The maximum number of concurrent uploads."),
-        ConditionalTask(
-            files_to_upload,
-            UploadWithTracker2(
-                "http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
-                downloader=downloader,
-                version=VERSION,
-                files=FilesToUpload(),
-                rsync_target_source_path=ItemInterpolation("%(data_dir)s/"),
-                rsync_extra_args=[
-                "--recursive",
-                "--partial",
-                "--partial-dir", ".rsync-tmp"
-                ]
-            )
+    ConditionalTask(
+        files_to_upload,
+        BatchedUploadWithTracker(
+            "http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
+            downloader=downloader,
+            version=VERSION,
+            files=FilesToUpload(),
+            concurrency=NumberConfigValue(min=1, max=4, default="1",
+                name="shared:rsync_threads",
+                title="Rsync threads",
+                description="The maximum number of concurrent uploads."),
+            rsync_extra_files=IndexFilesToUpload(),
+            rsync_extra_args=[
+            "--recursive",
+            "--partial",
+            "--partial-dir", ".rsync-tmp"
+            ]
         )
     ),
-    SendDoneToTracker(
-        tracker_url="http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
+    QueueDoneForTracker(
+        tracker_reporter,
         stats=ItemValue("stats")
     )
 )
@@ -3,6 +3,11 @@ EXIT_STATUS_NOT_FOUND = 101
 EXIT_STATUS_OTHER_ERROR = 102
 custom_exit_status = nil
 
+-- When set, many URLs are fetched by one wget run. The result of each URL
+-- is appended to this file and wget only stops at an unexpected response,
+-- leaving the retries of the URLs to the pipeline's rate controller.
+status_file = os.getenv("PUUSH_STATUS_FILE")
+
 
 read_file = function(file)
   if file then
@@ -15,6 +20,12 @@ read_file = function(file)
   end
 end
 
+write_status = function(url, status)
+  local f = io.open(status_file, "a")
+  f:write(url.." "..status.."\n")
+  f:close()
+end
+
 wget.callbacks.before_exit = function(exit_status, exit_status_string)
   if custom_exit_status then
     return custom_exit_status
@@ -25,22 +36,38 @@ end
 
 wget.callbacks.httploop_result = function(url, err, http_stat)
   local code = http_stat.statcode
+  local status = 0
   io.stdout:write("  Server returned status "..code.."\n")
   io.stdout:flush()
 
   if code == 200 then
     local html = read_file(http_stat["local_file"])
     if html == "You do not have access to view that puush." then
-      custom_exit_status = EXIT_STATUS_PERMISSION_DENIED
-      return wget.actions.EXIT
+      status = EXIT_STATUS_PERMISSION_DENIED
     end
-    return wget.actions.NORMAL
+  elseif code == 404 then
+    status = EXIT_STATUS_NOT_FOUND
   else
-    if code == 404 then
-      custom_exit_status = EXIT_STATUS_NOT_FOUND
+    status = EXIT_STATUS_OTHER_ERROR
+  end
+
+  if status_file then
+    write_status(url["url"], status)
+
+    if status == 0 then
+      return wget.actions.NORMAL
+    elseif status == EXIT_STATUS_OTHER_ERROR then
+      -- wget would retry the URL by itself
+      return wget.actions.EXIT
     else
-      custom_exit_status = EXIT_STATUS_OTHER_ERROR
+      return wget.actions.NOTHING
     end
+  end
+
+  if status == 0 then
+    return wget.actions.NORMAL
+  else
+    custom_exit_status = status
     return wget.actions.EXIT
   end
 end
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+'''Keeps the wget logs of the decentralized grabber in a few large files
+
+Each report is compressed as its own gzip member and appended to the
+current segment file, ``reports-NNNNNN.gz``. A new segment is started once
+the current one is larger than the segment size. ``index.txt`` has one
+line per report::
+
+    ITEM_NAME TIMESTAMP SEGMENT OFFSET LENGTH
+
+A segment is also a valid gzip file, so ``zcat`` shows all of its reports.
+'''
+from __future__ import print_function
+
+import argparse
+import glob
+import io
+import gzip
+import os
+import re
+import sys
+import threading
+import zlib
+
+
+SEGMENT_PATTERN = re.compile(r'reports-(\d+)\.gz$')
+
+
+class ReportStore(object):
+    def __init__(self, report_dir, segment_size=64 * 1024 * 1024):
+        self.report_dir = report_dir
+        self.segment_size = segment_size
+        self.index_path = os.path.join(report_dir, 'index.txt')
+        self._lock = threading.Lock()
+
+        segment_numbers = [
+            int(SEGMENT_PATTERN.search(path).group(1))
+            for path in glob.glob(os.path.join(report_dir, 'reports-*.gz'))
+            if SEGMENT_PATTERN.search(path)
+        ]
+        self.segment_number = max(segment_numbers) if segment_numbers else 0
+
+    def segment_path(self, segment_number):
+        return os.path.join(self.report_dir,
+            'reports-{0:06d}.gz'.format(segment_number))
+
+    def add(self, item_name, timestamp, data):
+        '''Append a report'''
+        buffer = io.BytesIO()
+
+        with gzip.GzipFile(fileobj=buffer, mode='wb') as gzip_file:
+            gzip_file.write(data)
+
+        member = buffer.getvalue()
+
+        with self._lock:
+            if not os.path.exists(self.report_dir):
+                os.makedirs(self.report_dir)
+
+            path = self.segment_path(self.segment_number)
+
+            if os.path.exists(path) \
+            and os.path.getsize(path) >= self.segment_size:
+                self.segment_number += 1
+                path = self.segment_path(self.segment_number)
+
+            with open(path, 'ab') as segment_file:
+                offset = segment_file.tell()
+                segment_file.write(member)
+
+            # The report is in the segment before it is in the index, so a
+            # crash can at worst leave a report that is not indexed
+            with open(self.index_path, 'a') as index_file:
+                index_file.write('{0} {1} {2} {3} {4}\n'.format(item_name,
+                    int(timestamp), self.segment_number, offset,
+                    len(member)))
+
+    def iter_index(self):
+        '''Yield ``(item_name, timestamp, segment, offset, length)``'''
+        if not os.path.exists(self.index_path):
+            return
+
+        with open(self.index_path, 'r') as index_file:
+            for line in index_file:
+                fields = line.split()
+
+                if len(fields) != 5:
+                    continue
+
+                item_name, timestamp, segment, offset, length = fields
+                yield (item_name, int(timestamp), int(segment), int(offset),
+                    int(length))
+
+    def read(self, segment, offset, length):
+        with open(self.segment_path(segment), 'rb') as segment_file:
+            segment_file.seek(offset)
+            member = segment_file.read(length)
+
+        return zlib.decompress(member, 16 + zlib.MAX_WBITS)
+
+    def get(self, item_name):
+        '''Return the reports of an item, oldest first'''
+        return [self.read(segment, offset, length)
+            for entry_item_name, dummy, segment, offset, length
+            in self.iter_index() if entry_item_name == item_name]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--report-dir', default='report',
+        help='Path of the report directory')
+    sub_parsers = arg_parser.add_subparsers(title='Command',
+        dest='command')
+
+    get_arg_parser = sub_parsers.add_parser('get',
+        help='Print the reports of an item')
+    get_arg_parser.add_argument('item_name', help='Item name')
+    get_arg_parser.set_defaults(func=get_command)
+
+    dump_arg_parser = sub_parsers.add_parser('dump',
+        help='Print every report with a header line')
+    dump_arg_parser.set_defaults(func=dump_command)
+
+    import_arg_parser = sub_parsers.add_parser('import',
+        help='Move the separate wget-TIME-ID.log report files into the store')
+    import_arg_parser.set_defaults(func=import_command)
+
+    args = arg_parser.parse_args()
+    args.func(args)
+
+
+def get_command(args):
+    store = ReportStore(args.report_dir)
+
+    for report in store.get(args.item_name):
+        sys.stdout.write(report)
+
+
+def dump_command(args):
+    store = ReportStore(args.report_dir)
+
+    for item_name, timestamp, segment, offset, length in store.iter_index():
+        sys.stdout.write('=== {0} {1}\n'.format(item_name, timestamp))
+        sys.stdout.write(store.read(segment, offset, length))
+
+
+def import_command(args):
+    store = ReportStore(args.report_dir)
+    paths = glob.glob(os.path.join(args.report_dir, 'wget-*-*.log'))
+
+    for path in sorted(paths):
+        timestamp, item_name = os.path.basename(path)[5:-4].split('-', 1)
+
+        with open(path, 'rb') as f:
+            store.add(item_name, int(timestamp), f.read())
+
+        os.remove(path)
+
+    print('Imported {0} reports'.format(len(paths)))
+
+
+if __name__ == '__main__':
+    main()
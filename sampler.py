@@ -0,0 +1,126 @@
+'''Visits every number of a range once, in a pseudo-random order'''
+import hashlib
+import json
+import os
+import random
+import struct
+
+
+class PermutationSampler(object):
+    '''Walks a keyed pseudo-random permutation of ``[0, size)``.
+
+    A full period linear congruential generator steps through every number
+    below the next power of two. Each of its states is scrambled by an
+    invertible mix and numbers outside the range are skipped, so every
+    number comes up exactly once. Only the generator state is kept, and it
+    can be saved to a checkpoint file to resume after a restart.
+
+    With `node_count` above 1, the steps are dealt out in turn to the
+    nodes, so samplers with the same seed and different `node_index`
+    cover disjoint parts of the range.
+
+    If `seed` is None, the seed of the checkpoint is used, or a random one
+    when there is no checkpoint yet.
+    '''
+    def __init__(self, size, seed=None, node_index=0, node_count=1,
+    checkpoint_path=None):
+        if not 0 <= node_index < node_count:
+            raise ValueError('Node index should be below the node count')
+
+        if seed is None:
+            if checkpoint_path and os.path.exists(checkpoint_path):
+                with open(checkpoint_path, 'r') as f:
+                    seed = json.load(f)['seed']
+            else:
+                seed = random.getrandbits(63)
+
+        self.size = size
+        self.seed = str(seed)
+        self.node_index = node_index
+        self.node_count = node_count
+        self.checkpoint_path = checkpoint_path
+        self.bits = max(2, (size - 1).bit_length())
+        self.mask = (1 << self.bits) - 1
+
+        key = struct.unpack('<8Q', hashlib.sha512(self.seed).digest())
+        multiplier, increment, offset = key[:3]
+        mix_multipliers = key[3:]
+
+        # Hull-Dobell: c odd and a - 1 divisible by 4 gives a full period
+        self.multiplier = int(multiplier & self.mask) & ~3 | 1
+        self.increment = int(increment & self.mask) | 1
+        self.offset = int(offset & self.mask)
+        # Odd multipliers are invertible modulo a power of two
+        self.mix_multipliers = [int(value & self.mask) | 1
+            for value in mix_multipliers]
+        self.mix_shift = self.bits // 2 + 1
+
+        self.state = 0
+        self.steps = 0
+
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            self._load_checkpoint()
+
+    def _load_checkpoint(self):
+        with open(self.checkpoint_path, 'r') as f:
+            doc = json.load(f)
+
+        for name in ('size', 'seed', 'node_index', 'node_count'):
+            if doc[name] != getattr(self, name):
+                raise ValueError('The checkpoint was made with a different '
+                    '{0}: {1}'.format(name, doc[name]))
+
+        self.state = doc['state']
+        self.steps = doc['steps']
+
+    def save_checkpoint(self):
+        doc = {
+            'size': self.size,
+            'seed': self.seed,
+            'node_index': self.node_index,
+            'node_count': self.node_count,
+            'state': self.state,
+            'steps': self.steps,
+        }
+        new_path = '%s-new' % self.checkpoint_path
+
+        with open(new_path, 'w') as f:
+            json.dump(doc, f)
+
+        os.rename(new_path, self.checkpoint_path)
+
+    def _mix(self, value):
+        value = (value + self.offset) & self.mask
+
+        for mix_multiplier in self.mix_multipliers:
+            value ^= value >> self.mix_shift
+            value = (value * mix_multiplier) & self.mask
+
+        return value
+
+    def _step(self):
+        value = self._mix(self.state)
+        self.state = (self.state * self.multiplier + self.increment) \
+            & self.mask
+        self.steps += 1
+        return value
+
+    def next(self):
+        '''Return the next number, raising StopIteration when all were
+        given out'''
+        period = self.mask + 1
+
+        while self.steps < period:
+            is_own_step = self.steps % self.node_count == self.node_index
+            value = self._step()
+
+            if is_own_step and value < self.size:
+                if self.checkpoint_path:
+                    self.save_checkpoint()
+
+                return value
+
+        raise StopIteration()
+
+    def __iter__(self):
+        return self
@@ -0,0 +1,57 @@
+import unittest
+
+from base62 import (ALPHABET, ALPHABET_PUUSH, base62_decode, base62_encode,
+    encode_range, format_range, parse_item_name)
+
+
+NUMBERS = [0, 1, 61, 62, 63, 3843, 3844, 3845, 238327, 238328, 14776335,
+    14776336, 916132831, 916132832, 2 ** 40 + 12345]
+
+
+class TestBase62(unittest.TestCase):
+    def test_round_trip(self):
+        for alphabet in (ALPHABET, ALPHABET_PUUSH):
+            for num in NUMBERS:
+                string = base62_encode(num, alphabet)
+                self.assertEqual(base62_decode(string, alphabet), num)
+
+    def test_alphabets(self):
+        self.assertEqual(base62_encode(10, ALPHABET), 'A')
+        self.assertEqual(base62_encode(10, ALPHABET_PUUSH), 'a')
+        self.assertEqual(base62_encode(62, ALPHABET_PUUSH), '10')
+        self.assertEqual(base62_decode('Zz', ALPHABET_PUUSH),
+            61 * 62 + 35)
+
+    def test_encode_range(self):
+        for alphabet in (ALPHABET, ALPHABET_PUUSH):
+            for start, end in ((0, 100), (3800, 7700), (238300, 238400),
+            (5, 5), (6, 5)):
+                self.assertEqual(list(encode_range(start, end, alphabet)),
+                    [base62_encode(num, alphabet)
+                        for num in range(start, end + 1)])
+
+    def test_format_range(self):
+        self.assertEqual(format_range(62, 62), '10')
+        self.assertEqual(format_range(10, 71), 'a:19')
+
+    def test_parse_item_name(self):
+        self.assertEqual(parse_item_name('a:19'), (10, 71, ALPHABET_PUUSH))
+        self.assertEqual(parse_item_name('A,19'), (10, 71, ALPHABET))
+        self.assertEqual(parse_item_name('Zz'),
+            (61 * 62 + 35, 61 * 62 + 35, ALPHABET_PUUSH))
+
+    def test_parse_item_name_round_trip(self):
+        for start, end in ((0, 0), (10, 71), (3843, 3844),
+        (238327, 916132832)):
+            item_name = format_range(start, end)
+            self.assertEqual(parse_item_name(item_name),
+                (start, end, ALPHABET_PUUSH))
+
+            item_name = '{0},{1}'.format(base62_encode(start, ALPHABET),
+                base62_encode(end, ALPHABET))
+            self.assertEqual(parse_item_name(item_name),
+                (start, end, ALPHABET))
+
+
+if __name__ == '__main__':
+    unittest.main()
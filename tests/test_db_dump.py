@@ -0,0 +1,154 @@
+import StringIO
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import warnings
+
+with warnings.catch_warnings():
+    # redis is replaced by FakeRedis
+    warnings.simplefilter('ignore')
+    import db_dump
+
+
+LOG_ENTRIES = [
+    {'id': json.dumps({'wget_exit_statuses': {'a': 0, 'b': 101}}),
+        'ip': '10.0.0.1', 'by': 'alice', 'item': 'a:b',
+        'bytes': {'data': 300}, 'at': '2013-09-01T10:00:00'},
+    {'id': json.dumps({'wget_exit_statuses': {'c': 100, 'd': 0}}),
+        'ip': '10.0.0.2', 'by': 'bob', 'item': 'c:d',
+        'bytes': {'data': 500}, 'at': '2013-09-02T10:00:00'},
+    {'id': json.dumps({'wget_exit_statuses': {'f': 0}}),
+        'ip': '10.0.0.1', 'by': 'alice', 'item': 'f',
+        'bytes': {'data': 100}, 'at': '2013-09-03T10:00:00'},
+]
+
+
+class FakeRedis(object):
+    def __init__(self, sets=None, lists=None):
+        self.sets = sets or {}
+        self.lists = lists or {}
+
+    def sscan(self, key, cursor, count=10):
+        # Like SSCAN, returns the member at the end of a page again
+        members = self.sets.get(key, [])
+        cursor = int(cursor)
+        page = members[cursor:cursor + count + 1]
+        next_cursor = cursor + count
+
+        if next_cursor >= len(members):
+            next_cursor = 0
+
+        return next_cursor, page
+
+    def lrange(self, key, start, end):
+        return self.lists.get(key, [])[start:end + 1]
+
+
+class TestDBDump(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.temp_dir, 'log.txt')
+        lines = [json.dumps(doc) for doc in LOG_ENTRIES]
+
+        with open(self.log_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        self.redis = FakeRedis(
+            sets={'puush:done': ['a:b', 'c:d', 'f', 'X,Y', 'g:g']},
+            lists={'puush:log': lines},
+        )
+        self.get_redis_connection = db_dump.get_redis_connection
+        db_dump.get_redis_connection = lambda args: self.redis
+
+    def tearDown(self):
+        db_dump.get_redis_connection = self.get_redis_connection
+        shutil.rmtree(self.temp_dir)
+
+    def run_command(self, *args):
+        '''Run db_dump.py with the arguments and return its output'''
+        argv = sys.argv
+        stdout = sys.stdout
+        sys.argv = ['db_dump.py'] + list(args)
+        sys.stdout = StringIO.StringIO()
+
+        try:
+            db_dump.main()
+            return sys.stdout.getvalue()
+        finally:
+            sys.argv = argv
+            sys.stdout = stdout
+
+    def test_archived_log(self):
+        output = self.run_command('archivedlog', '--scrub-username',
+            self.log_path)
+        docs = [json.loads(line) for line in output.splitlines()]
+
+        self.assertEqual(len(docs), len(LOG_ENTRIES))
+        self.assertEqual(set(doc['ip'] for doc in docs), set(['<scrubbed>']))
+        self.assertEqual(set(doc['by'] for doc in docs), set(['<scrubbed>']))
+        self.assertEqual(docs[1]['id'],
+            {'wget_exit_statuses': {'c': 100, 'd': 0}})
+
+    def test_archived_log_gzip_jobs(self):
+        output_path = os.path.join(self.temp_dir, 'scrubbed.txt.gz')
+        self.run_command('archivedlog', '--jobs', '2', '--output',
+            output_path, self.log_path)
+
+        with gzip.open(output_path, 'rb') as f:
+            self.assertEqual(f.read(),
+                self.run_command('archivedlog', self.log_path))
+
+    def test_log(self):
+        output = self.run_command('log', 'puush')
+
+        self.assertEqual(output,
+            self.run_command('archivedlog', self.log_path))
+
+    def test_done(self):
+        output = self.run_command('done', '--batch-size', '2', 'puush')
+
+        # Repeated members are printed again
+        self.assertEqual(set(output.split()),
+            set(['a', 'b', 'c', 'd', 'f', 'X', 'Y', 'g']))
+
+    def test_done_ranges(self):
+        output = self.run_command('done', '--ranges', '--batch-size', '2',
+            'puush')
+
+        # The IDs of the legacy item are numbered with the Puush alphabet
+        self.assertEqual(output.split(), ['a:d', 'f:g', 'X:Y'])
+
+    def test_gaps(self):
+        output = self.run_command('gaps', '--range', '2', 'puush', '9', 'z')
+
+        self.assertEqual(output.split(),
+            ['9', 'e', 'h:i', 'j:k', 'l:m', 'n:o', 'p:q', 'r:s', 't:u',
+                'v:w', 'x:y', 'z'])
+
+    def test_index_and_query(self):
+        index_dir = os.path.join(self.temp_dir, 'index')
+        self.run_command('index', index_dir, self.log_path)
+
+        summary = json.loads(self.run_command('query', '--summary',
+            index_dir))
+        self.assertEqual(summary['rows'], 5)
+        self.assertEqual(summary['bytes'], 900)
+
+        output = self.run_command('query', '--status', '0', '--ranges',
+            index_dir)
+        self.assertEqual(output.split(), ['a', 'd', 'f'])
+
+        rows = [line.split('\t') for line in self.run_command('query',
+            '--start', 'c', '--end', 'd', index_dir).splitlines()]
+        self.assertEqual(rows, [
+            ['c', '100', '0', 'bob', '2013-09-02T10:00:00Z', 'c:d'],
+            ['d', '0', '500', 'bob', '2013-09-02T10:00:00Z', 'c:d'],
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
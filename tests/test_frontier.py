@@ -0,0 +1,110 @@
+import BaseHTTPServer
+import SocketServer
+import threading
+import unittest
+
+from base62 import ALPHABET_PUUSH, base62_decode
+from frontier import FrontierProber, ProbeError
+
+
+# The newest ID in use
+FRONTIER = 3000
+
+# IDs below the frontier that were deleted or never given out
+HOLES = set(range(100, FRONTIER, 7)) | set(range(2000, 2004))
+
+# IDs that are private
+PRIVATE = set(range(50, FRONTIER, 11))
+
+
+class PuushHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_HEAD(self):
+        num = base62_decode(self.path.lstrip('/'), ALPHABET_PUUSH)
+        failures = self.server.failures.get(num)
+
+        if failures:
+            self.server.failures[num] = failures[1:]
+
+            if failures[0] is None:
+                # Drop the connection without a response
+                self.close_connection = 1
+                return
+
+            status = failures[0]
+        elif num > FRONTIER or num in HOLES:
+            status = 404
+        elif num in PRIVATE:
+            status = 403
+        else:
+            status = 200
+
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PuushServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestFrontierProber(unittest.TestCase):
+    def setUp(self):
+        self.server = PuushServer(('127.0.0.1', 0), PuushHandler)
+        self.server.failures = {}
+        thread = threading.Thread(target=self.server.serve_forever,
+            args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        self.prober = FrontierProber(
+            'http://127.0.0.1:%d' % self.server.server_address[1], width=5,
+            concurrency=4, timeout=5, retry_delay=0)
+
+    def tearDown(self):
+        self.prober.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_find_max(self):
+        for start in (0, 60, 2500, FRONTIER):
+            self.assertEqual(self.prober.find_max(start), FRONTIER)
+
+    def test_get_status(self):
+        self.assertEqual(self.prober.get_status(1), 200)
+        self.assertEqual(self.prober.get_status(50), 403)
+        self.assertEqual(self.prober.get_status(100), 404)
+        self.assertTrue(self.prober.exists(50))
+        self.assertFalse(self.prober.exists(FRONTIER + 1))
+
+    def test_transient_failures(self):
+        # The first window probed from 1500 fails at first; taking the
+        # failures as missing IDs would end the search there
+        self.server.failures.update({
+            1564: [503, 429],
+            1565: [None, 500],
+            1566: [420],
+            1567: [None, None],
+            1568: [502],
+            FRONTIER: [503, 503, 503],
+        })
+
+        self.assertEqual(self.prober.find_max(1500), FRONTIER)
+
+    def test_probe_error(self):
+        self.server.failures[FRONTIER] = [503] * 5
+
+        self.assertRaises(ProbeError, self.prober.get_status, FRONTIER)
+
+        self.server.failures[FRONTIER] = [None] * 5
+
+        self.assertRaises(ProbeError, self.prober.exists, FRONTIER)
+        self.assertEqual(self.prober.get_status(FRONTIER), 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+
+from base62 import ALPHABET, ALPHABET_PUUSH, base62_decode
+from item_name_gen import read_exclusions, read_id_name_exclusions
+
+
+class TestExclusions(unittest.TestCase):
+    def test_read_exclusions(self):
+        lines = iter(['1\n', '2:5\n', '6\n', '10:12\n', '3\n', '8\n'])
+
+        self.assertEqual(read_exclusions(lines, int),
+            [(1, 6), (8, 8), (10, 12)])
+
+    def test_read_id_name_exclusions(self):
+        lines = iter(['a\n', 'b:d\n', 'f:g\n', '9\n', 'h\n', '10\n'])
+
+        self.assertEqual(read_id_name_exclusions(lines, ALPHABET_PUUSH),
+            [(9, 13), (15, 17), (62, 62)])
+
+    def test_read_id_name_exclusions_legacy(self):
+        # z:B is a run in Puush alphabet order, but not in the legacy
+        # numbering
+        lines = iter(['z:B\n'])
+        nums = [base62_decode(id_name, ALPHABET)
+            for id_name in ('z', 'A', 'B')]
+
+        self.assertEqual(read_id_name_exclusions(lines, ALPHABET),
+            [(nums[1], nums[2]), (nums[0], nums[0])])
+
+
+if __name__ == '__main__':
+    unittest.main()
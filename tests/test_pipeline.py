@@ -0,0 +1,520 @@
+import StringIO
+import base64
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import zlib
+
+from tornado import gen
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+from tornado.web import Application, RequestHandler
+
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PIPELINE_PATH = os.path.join(PROJECT_DIR, 'pipeline.py')
+
+pipeline = {}
+temp_dir = None
+
+
+def setUpModule():
+    '''Load pipeline.py like run-pipeline does, from a directory with a
+    stand-in Wget+Lua'''
+    global temp_dir
+    temp_dir = tempfile.mkdtemp()
+    wget_lua_path = os.path.join(temp_dir, 'wget-lua')
+
+    with open(wget_lua_path, 'w') as f:
+        f.write('#!/bin/sh\necho "GNU Wget 1.14.lua.20130523-9a5c"\n')
+
+    os.chmod(wget_lua_path, 0o755)
+    sys.path.insert(0, PROJECT_DIR)
+    cwd = os.getcwd()
+    os.chdir(temp_dir)
+
+    try:
+        pipeline.update(downloader='tester', __name__='pipeline')
+        execfile(PIPELINE_PATH, pipeline)
+    finally:
+        os.chdir(cwd)
+
+
+def tearDownModule():
+    shutil.rmtree(temp_dir)
+
+
+class FakeItem(dict):
+    def __init__(self, item_name):
+        dict.__init__(self, item_name=item_name)
+        self.output = []
+
+    def set_task_status(self, task, status):
+        pass
+
+    def log_output(self, data, full_line=True):
+        self.output.append(data)
+
+    def log_error(self, task, error):
+        pass
+
+    def description(self):
+        return 'Item %s' % self['item_name']
+
+
+class TestRetryQueue(unittest.TestCase):
+    def make_task(self, exit_codes, **kwargs):
+        '''Return a download task whose processes end with the exit codes
+        listed for their URL, then with 0'''
+        class ScriptedDownload(pipeline['WgetDownloadMany']):
+            def process_one(task, item, url):
+                self.started.append(url)
+                codes = exit_codes.get(url)
+                exit_code = codes.pop(0) if codes else 0
+                IOLoop.instance().add_callback(task.on_subprocess_end, item,
+                    url, exit_code)
+
+        self.started = []
+        self.result = None
+        task = ScriptedDownload([], ['a', 'b', 'c'], **kwargs)
+        task.on_complete_item += self.on_finish
+        task.on_fail_item += self.on_finish
+        return task
+
+    def on_finish(self, task, item):
+        self.result = item['WgetDownloadMany.failed'] and 'failed' \
+            or 'completed'
+        IOLoop.instance().stop()
+
+    def run_task(self, task):
+        io_loop = IOLoop.instance()
+        timeout = io_loop.call_later(10, io_loop.stop)
+        item = FakeItem('a:c')
+        task.enqueue(item)
+
+        if self.result is None:
+            io_loop.start()
+
+        io_loop.remove_timeout(timeout)
+        return item
+
+    def test_retry_after_untried_urls(self):
+        task = self.make_task({'a': [1, 1]}, retry_delay=0, max_tries=4)
+        self.run_task(task)
+
+        self.assertEqual(self.result, 'completed')
+        self.assertEqual(self.started, ['a', 'b', 'c', 'a', 'a'])
+
+    def test_retry_does_not_block_other_urls(self):
+        task = self.make_task({'a': [1]}, retry_delay=0.2, max_tries=3,
+            concurrency=2)
+        start_time = time.time()
+        self.run_task(task)
+
+        self.assertEqual(self.result, 'completed')
+        self.assertGreaterEqual(time.time() - start_time, 0.2)
+        self.assertEqual(self.started, ['a', 'b', 'c', 'a'])
+
+    def test_max_tries(self):
+        task = self.make_task({'b': [1, 1, 1]}, retry_delay=0, max_tries=3)
+        item = self.run_task(task)
+
+        self.assertEqual(self.result, 'failed')
+        self.assertEqual(self.started, ['a', 'b', 'c', 'b'])
+        self.assertEqual(item['WgetDownloadMany.tries'], {'b': 3})
+        self.assertEqual(item['WgetDownloadMany.retry_queue'], [])
+
+    def test_no_retry_on_exit_code(self):
+        task = self.make_task({'a': [4]}, retry_delay=0, max_tries=3,
+            retry_on_exit_code=[1])
+        self.run_task(task)
+
+        self.assertEqual(self.result, 'failed')
+        self.assertEqual(self.started, ['a'])
+
+
+class PuushHandler(RequestHandler):
+    '''Answers like puu.sh for the IDs of the tests'''
+    responses = {
+        'a': (200, 'The file of a'),
+        'b': (200, 'You do not have access to view that puush.'),
+        'c': (404, 'Not found'),
+        'd': (403, 'That puush could not be found.'),
+        'e': (500, 'Internal server error'),
+    }
+
+    def get(self, name):
+        self.application.requests.append(name)
+        failures = self.application.failures
+
+        if failures.get(name):
+            failures[name] -= 1
+            self.set_status(500)
+            return
+
+        status_code, body = self.responses[name]
+        self.set_status(status_code)
+        self.write(body)
+
+
+class ChunkedHandler(RequestHandler):
+    @gen.coroutine
+    def get(self):
+        self.write('chunk1')
+        yield self.flush()
+        self.write('chunk2')
+
+
+def read_records(warc_path):
+    '''Return the ``(header fields, block)`` of each record of a WARC'''
+    with open(warc_path, 'rb') as f:
+        data = f.read()
+
+    records = []
+
+    while data:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        record = decompressor.decompress(data)
+        data = decompressor.unused_data
+        header, block = record.split('\r\n\r\n', 1)
+        fields = dict(line.split(': ', 1)
+            for line in header.split('\r\n')[1:])
+        assert block.endswith('\r\n\r\n')
+        records.append((fields, block[:-4]))
+
+    return records
+
+
+def sha1_digest(data):
+    return 'sha1:%s' % base64.b32encode(hashlib.sha1(data).digest())
+
+
+class TestNativeDownload(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.application = Application([
+            (r'/chunked', ChunkedHandler),
+            (r'/(\w+)', PuushHandler),
+        ],
+            log_function=lambda handler: None)
+        self.application.requests = []
+        self.application.failures = {}
+        sock, port = bind_unused_port()
+        self.server = HTTPServer(self.application)
+        self.server.add_sockets([sock])
+        self.base_url = 'http://127.0.0.1:%d/' % port
+
+        # the requests are not paced
+        self.rate_controller = pipeline['rate_controller']
+        pipeline['rate_controller'] = pipeline['RateController'](rate=1000,
+            max_rate=1000, burst=1000)
+
+    def tearDown(self):
+        pipeline['rate_controller'] = self.rate_controller
+        self.server.stop()
+        shutil.rmtree(self.temp_dir)
+
+    def run_io_loop(self):
+        io_loop = IOLoop.instance()
+        timeout = io_loop.call_later(10, io_loop.stop)
+        io_loop.start()
+        io_loop.remove_timeout(timeout)
+
+    def fetch(self, url):
+        '''Return the exit status, the response and the WARC records of a
+        PuushFetch'''
+        results = []
+        warc_path = os.path.join(self.temp_dir, 'fetch.warc.gz')
+
+        def callback(exit_code, response, response_time):
+            results.append((exit_code, response))
+            IOLoop.instance().stop()
+
+        fetch = pipeline['PuushFetch'](url, warc_path, 'ArchiveTeam',
+            [('operator', 'Archive Team')], callback)
+        fetch.start(pipeline['get_http_client']())
+        self.run_io_loop()
+        exit_code, response = results[0]
+        return exit_code, response, read_records(warc_path)
+
+    def test_exit_statuses(self):
+        for name, exit_code in (('a', 0), ('b', 100), ('c', 101),
+        ('d', 102), ('e', 102)):
+            self.assertEqual(self.fetch(self.base_url + name)[0], exit_code)
+
+    def test_connection_failure(self):
+        sock, port = bind_unused_port()
+        sock.close()
+        exit_code, response, records = self.fetch(
+            'http://127.0.0.1:%d/a' % port)
+
+        self.assertEqual(exit_code, 102)
+        self.assertEqual(response.code, 599)
+        self.assertEqual([fields['WARC-Type'] for fields, block in records],
+            ['warcinfo'])
+
+    def test_records(self):
+        url = self.base_url + 'a'
+        exit_code, response, records = self.fetch(url)
+
+        self.assertEqual([fields['WARC-Type'] for fields, block in records],
+            ['warcinfo', 'request', 'response'])
+        warcinfo_fields, warcinfo_block = records[0]
+        self.assertIn('operator: Archive Team\r\n', warcinfo_block)
+
+        request_fields, request_block = records[1]
+        response_fields, response_block = records[2]
+
+        for fields, block in records:
+            self.assertEqual(int(fields['Content-Length']), len(block))
+
+        self.assertTrue(request_block.startswith('GET /a HTTP/1.1\r\n'))
+        self.assertEqual(request_fields['WARC-Target-URI'], url)
+        self.assertEqual(request_fields['WARC-Concurrent-To'],
+            response_fields['WARC-Record-ID'])
+        self.assertEqual(request_fields['WARC-Block-Digest'],
+            sha1_digest(request_block))
+
+        http_header, payload = response_block.split('\r\n\r\n', 1)
+        self.assertTrue(http_header.startswith('HTTP/1.1 200 OK\r\n'))
+        self.assertIn('Content-Length: 13', http_header.split('\r\n'))
+        self.assertEqual(payload, 'The file of a')
+        self.assertEqual(response_fields['WARC-Target-URI'], url)
+        self.assertEqual(response_fields['WARC-Warcinfo-ID'],
+            warcinfo_fields['WARC-Record-ID'])
+        self.assertEqual(response_fields['WARC-Block-Digest'],
+            sha1_digest(response_block))
+        self.assertEqual(response_fields['WARC-Payload-Digest'],
+            sha1_digest(payload))
+
+    def test_chunked_response(self):
+        exit_code, response, records = self.fetch(self.base_url + 'chunked')
+        fields, block = records[2]
+        http_header, payload = block.split('\r\n\r\n', 1)
+        header_lines = http_header.split('\r\n')
+
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(payload, 'chunk1chunk2')
+        self.assertFalse([line for line in header_lines
+            if line.lower().startswith('transfer-encoding')])
+        self.assertEqual([line for line in header_lines
+            if line.lower().startswith('content-length')],
+            ['Content-Length: 12'])
+        self.assertEqual(int(fields['Content-Length']), len(block))
+        self.assertEqual(fields['WARC-Block-Digest'], sha1_digest(block))
+        self.assertEqual(fields['WARC-Payload-Digest'],
+            sha1_digest(payload))
+
+    def test_download_many(self):
+        item = FakeItem('a:e')
+        item['data_dir'] = self.temp_dir
+        pipeline['ExtraItemParams']().process(item)
+        pipeline['PrepareDirectories']('puush').process(item)
+        self.application.failures['a'] = 1
+        task = pipeline['NativeDownloadMany'](
+            [self.base_url + name for name in 'abcde'], 'ArchiveTeam', [],
+            max_tries=3, accept_on_exit_code=[0, 100, 101], concurrency=2)
+        results = []
+
+        def on_finish(task, item):
+            results.append(item['WgetDownloadMany.failed'])
+            IOLoop.instance().stop()
+
+        task.on_complete_item += on_finish
+        task.on_fail_item += on_finish
+        task.enqueue(item)
+        self.run_io_loop()
+
+        # e fails on every try, a only on the first one
+        self.assertEqual(results, [True])
+        self.assertEqual(sorted(self.application.requests),
+            ['a', 'a', 'b', 'c', 'd', 'd', 'e', 'e'])
+        self.assertEqual(dict((name, sub_item['wget_exit_status'])
+            for name, sub_item in item['sub_items'].items()),
+            {'a': 0, 'b': 100, 'c': 101, 'd': 102, 'e': 102})
+
+        warc_path = '%s/%s.warc.gz' % (item['item_dir'],
+            item['sub_items']['a']['warc_file_base'])
+        fields, block = read_records(warc_path)[2]
+        self.assertTrue(block.endswith('\r\n\r\nThe file of a'))
+
+
+class TestDownloadBatch(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.reports = []
+        reports = self.reports
+
+        class RecordingRateController(pipeline['RateController']):
+            def report(self, exit_code, response_time, num_bytes=0):
+                reports.append(exit_code)
+                return pipeline['RateController'].report(self, exit_code,
+                    response_time, num_bytes)
+
+        self.rate_controller = pipeline['rate_controller']
+        pipeline['rate_controller'] = RecordingRateController(rate=1000,
+            max_rate=1000, burst=1000)
+
+    def tearDown(self):
+        pipeline['rate_controller'] = self.rate_controller
+        shutil.rmtree(self.temp_dir)
+
+    def make_task(self, statuses):
+        '''Return a batch download task whose processes report the statuses
+        listed for their URLs, then 0, and stop like puush.lua at a 102'''
+        class ScriptedBatch(pipeline['SpecializedWgetDownloadBatch']):
+            def run_process(task, item, urls, env, on_end):
+                self.batches.append(urls[2:])
+
+                with open(env['PUUSH_STATUS_FILE'], 'w') as f:
+                    for url in urls[2:]:
+                        codes = statuses.get(url)
+                        status = codes.pop(0) if codes else 0
+                        f.write('%s %d\n' % (url, status))
+
+                        if status == 102:
+                            break
+
+                IOLoop.instance().add_callback(on_end, 0)
+
+        self.batches = []
+        return ScriptedBatch([], list('abcde'), max_tries=3,
+            accept_on_exit_code=[0, 100, 101])
+
+    def run_task(self, task):
+        item = FakeItem('a:e')
+        item['data_dir'] = self.temp_dir
+        pipeline['ExtraItemParams']().process(item)
+        pipeline['PrepareDirectories']('puush').process(item)
+        results = []
+
+        def on_finish(task, item):
+            results.append(item.get('WgetDownloadMany.failed', False))
+            IOLoop.instance().stop()
+
+        task.on_complete_item += on_finish
+        task.on_fail_item += on_finish
+        io_loop = IOLoop.instance()
+        timeout = io_loop.call_later(10, io_loop.stop)
+        task.enqueue(item)
+        io_loop.start()
+        io_loop.remove_timeout(timeout)
+
+        return results, item
+
+    def test_stopped_batch(self):
+        task = self.make_task({'b': [102], 'c': [101]})
+        results, item = self.run_task(task)
+
+        self.assertEqual(results, [False])
+        self.assertEqual(self.batches, [list('abcde'), list('bcde')])
+        # the URLs after b were not requested by the first batch
+        self.assertEqual(self.reports, [0, 102, 0, 101, 0, 0])
+        self.assertEqual(dict((name, sub_item['wget_exit_status'])
+            for name, sub_item in item['sub_items'].items()),
+            {'a': 0, 'b': 0, 'c': 101, 'd': 0, 'e': 0})
+
+
+class TrackerDoneHandler(RequestHandler):
+    def post(self):
+        report = json.loads(self.request.body)
+        self.application.reports.append(report['item'])
+
+        if report['item'] in self.application.unavailable:
+            self.set_status(503)
+        elif report['item'].startswith('bad'):
+            self.set_status(400)
+            self.write('Invalid item')
+        else:
+            self.write('OK')
+
+
+class TestTrackerReporter(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.outbox_dir = os.path.join(self.temp_dir, 'outbox')
+        self.application = Application([(r'/done', TrackerDoneHandler)],
+            log_function=lambda handler: None)
+        self.application.reports = []
+        self.application.unavailable = set()
+        sock, port = bind_unused_port()
+        self.server = HTTPServer(self.application)
+        self.server.add_sockets([sock])
+        self.reporter = pipeline['TrackerReporter'](
+            'http://127.0.0.1:%d' % port, self.outbox_dir, batch_size=2,
+            batch_delay=0, max_rejections=3)
+        self.reporter.retry_delay = 0.05
+
+    def tearDown(self):
+        if self.reporter.timeout:
+            IOLoop.instance().remove_timeout(self.reporter.timeout)
+
+        self.server.stop()
+        shutil.rmtree(self.temp_dir)
+
+    def outbox(self):
+        return sorted(filename for filename in os.listdir(self.outbox_dir)
+            if filename.endswith('.json'))
+
+    def run_until_sent(self, max_reports=100):
+        '''Run the IOLoop until the outbox is empty or the tracker has
+        received `max_reports` reports'''
+        io_loop = IOLoop.instance()
+        deadline = time.time() + 10
+
+        def check():
+            if not self.outbox() \
+            or len(self.application.reports) >= max_reports \
+            or time.time() > deadline:
+                io_loop.stop()
+            else:
+                io_loop.call_later(0.01, check)
+
+        check()
+        io_loop.start()
+
+    def test_rejected_reports(self):
+        for item_name in ('bad1', 'bad2', 'a', 'b', 'c'):
+            self.reporter.add({'item': item_name})
+
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+
+        try:
+            self.run_until_sent()
+            messages = sys.stderr.getvalue().splitlines()
+        finally:
+            sys.stderr = stderr
+
+        self.assertEqual(self.outbox(), [])
+        self.assertEqual(len(os.listdir(self.reporter.failed_dir)), 2)
+        self.assertEqual(len(messages), 2)
+        self.assertIn("rejected the report", messages[0])
+        reports = self.application.reports
+        self.assertEqual(sorted(reports),
+            ['a', 'b', 'bad1', 'bad1', 'bad1', 'bad2', 'bad2', 'bad2', 'c'])
+        # the good reports are not held up by the rejected ones
+        self.assertEqual(reports[:4], ['bad1', 'bad2', 'a', 'b'])
+
+    def test_unavailable_tracker(self):
+        self.application.unavailable.add('a')
+        self.reporter.add({'item': 'a'})
+        self.run_until_sent(max_reports=5)
+
+        self.assertEqual(len(self.outbox()), 1)
+        self.assertFalse(os.path.exists(self.reporter.failed_dir))
+
+        self.application.unavailable.clear()
+        self.run_until_sent()
+
+        self.assertEqual(self.outbox(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from warc_util import iter_gzip_members, parse_record_header, split_warc
+
+
+def make_record(record_type, target_uri=None):
+    lines = ['WARC/1.0', 'WARC-Type: ' + record_type]
+
+    if target_uri:
+        lines.append('WARC-Target-URI: ' + target_uri)
+
+    return '\r\n'.join(lines) + '\r\n\r\nblock\r\n\r\n'
+
+
+def compress(data):
+    buffer = io.BytesIO()
+
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as gzip_file:
+        gzip_file.write(data)
+
+    return buffer.getvalue()
+
+
+def read_records(path):
+    with gzip.open(path, 'rb') as f:
+        data = f.read()
+
+    return [(fields.get('warc-type'), fields.get('warc-target-uri'))
+        for fields in (parse_record_header('WARC/1.0' + record)
+            for record in data.split('WARC/1.0')[1:])]
+
+
+class TestSplitWarc(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.records = [
+            ('warcinfo', None),
+            ('request', 'http://puu.sh/a'),
+            ('response', 'http://puu.sh/a'),
+            ('request', 'http://puu.sh/b'),
+            ('response', 'http://puu.sh/b'),
+            # a redirect of b
+            ('request', 'http://puush.me/b.png'),
+            ('response', 'http://puush.me/b.png'),
+            ('request', 'http://puu.sh/c'),
+            ('response', 'http://puu.sh/c'),
+            ('resource', 'metadata://gnu.org/software/wget/warc/wget.log'),
+        ]
+        self.source_path = os.path.join(self.temp_dir, 'source.warc.gz')
+
+        with open(self.source_path, 'wb') as f:
+            for record_type, target_uri in self.records:
+                f.write(compress(make_record(record_type, target_uri)))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_iter_gzip_members(self):
+        with open(self.source_path, 'rb') as f:
+            members = list(iter_gzip_members(f))
+
+        self.assertEqual(len(members), len(self.records))
+        self.assertEqual(members[0][0], 0)
+
+        for (offset, length, head), (next_offset, dummy, dummy) \
+        in zip(members, members[1:]):
+            self.assertEqual(offset + length, next_offset)
+
+        self.assertEqual(
+            parse_record_header(members[3][2])['warc-target-uri'],
+            'http://puu.sh/b')
+
+    def test_split(self):
+        dest_paths = {
+            'http://puu.sh/a': os.path.join(self.temp_dir, 'a.warc.gz'),
+            'http://puu.sh/b': os.path.join(self.temp_dir, 'b.warc.gz'),
+            'http://puu.sh/c': None,
+            'http://puu.sh/d': os.path.join(self.temp_dir, 'd.warc.gz'),
+        }
+
+        urls = split_warc(self.source_path, dest_paths)
+
+        self.assertEqual(sorted(urls),
+            ['http://puu.sh/a', 'http://puu.sh/b', 'http://puu.sh/c'])
+        header = [self.records[0]]
+        trailer = [self.records[-1]]
+        self.assertEqual(read_records(dest_paths['http://puu.sh/a']),
+            header + self.records[1:3] + trailer)
+        self.assertEqual(read_records(dest_paths['http://puu.sh/b']),
+            header + self.records[3:7] + trailer)
+        self.assertEqual(sorted(os.listdir(self.temp_dir)),
+            ['a.warc.gz', 'b.warc.gz', 'source.warc.gz'])
+
+
+if __name__ == '__main__':
+    unittest.main()
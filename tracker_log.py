@@ -0,0 +1,48 @@
+'''Reads tracker log entries as exported by ``db_dump.py log``'''
+import gzip
+import json
+
+
+def open_log(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    else:
+        return open(path, 'rt')
+
+
+def iter_log_entries(fileobj):
+    '''Yield the JSON document of each line'''
+    for line in fileobj:
+        line = line.strip()
+
+        if line:
+            yield json.loads(line)
+
+
+def exit_statuses(doc):
+    '''Return the ``{id name: wget exit status}`` of a log entry'''
+    id_doc = doc.get('id')
+
+    # Entries straight from redis have the id document still encoded
+    if isinstance(id_doc, basestring):
+        try:
+            id_doc = json.loads(id_doc)
+        except ValueError:
+            return {}
+
+    if isinstance(id_doc, dict):
+        return id_doc.get('wget_exit_statuses') or {}
+    else:
+        return {}
+
+
+def byte_count(doc):
+    '''Return the number of bytes uploaded for a log entry'''
+    value = doc.get('bytes')
+
+    if isinstance(value, dict):
+        return sum(value.values())
+    elif isinstance(value, (int, long, float)):
+        return value
+    else:
+        return 0
@@ -0,0 +1,253 @@
+'''Helpers for working with gzip compressed WARC files'''
+import base64
+import datetime
+import gzip
+import hashlib
+import uuid
+import zlib
+
+
+def iter_gzip_members(fileobj, header_size=4096):
+    '''Yield ``(offset, length, head)`` for each gzip member in the file.
+
+    `head` is the start of the decompressed member and is long enough to
+    contain the WARC record header. The members are decompressed only to
+    find their boundaries; the compressed bytes are left untouched.
+    '''
+    fileobj.seek(0, 2)
+    file_size = fileobj.tell()
+    offset = 0
+
+    while offset < file_size:
+        fileobj.seek(offset)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        head = ''
+        consumed = 0
+        end = file_size
+
+        while True:
+            chunk = fileobj.read(65536)
+
+            if not chunk:
+                break
+
+            data = decompressor.decompress(chunk)
+
+            if len(head) < header_size:
+                head += data[:header_size - len(head)]
+
+            if decompressor.unused_data:
+                end = offset + consumed + len(chunk) \
+                    - len(decompressor.unused_data)
+                break
+
+            consumed += len(chunk)
+
+        yield offset, end - offset, head
+        offset = end
+
+
+def parse_record_header(head):
+    '''Return the WARC header fields of a record as a dict'''
+    fields = {}
+    header_text = head.split('\r\n\r\n', 1)[0]
+
+    for line in header_text.split('\r\n')[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            fields[name.strip().lower()] = value.strip()
+
+    return fields
+
+
+def copy_range(source, dest, offset, length):
+    source.seek(offset)
+
+    while length > 0:
+        data = source.read(min(length, 65536))
+
+        if not data:
+            break
+
+        dest.write(data)
+        length -= len(data)
+
+
+def split_warc(source_path, dest_paths):
+    '''Split a WARC written by one wget run over many URLs.
+
+    `dest_paths` maps each URL of the run to the WARC path that should
+    receive its records, or to None to drop them. Records are assigned to
+    the URL of the most recent record whose target URI is in `dest_paths`,
+    so redirects stay with the URL that caused them. The warcinfo record
+    and the trailing wget metadata records are copied into every output
+    file.
+
+    Returns the list of URLs that had records.
+    '''
+    header_members = []
+    trailer_members = []
+    url_members = {}
+    current_url = None
+
+    with open(source_path, 'rb') as source:
+        for offset, length, head in iter_gzip_members(source):
+            fields = parse_record_header(head)
+            target_uri = fields.get('warc-target-uri')
+
+            if target_uri in dest_paths:
+                current_url = target_uri
+
+            if target_uri and target_uri.startswith('metadata://'):
+                trailer_members.append((offset, length))
+            elif current_url is None:
+                header_members.append((offset, length))
+            else:
+                url_members.setdefault(current_url, []).append(
+                    (offset, length))
+
+        for url, members in url_members.iteritems():
+            if not dest_paths[url]:
+                continue
+
+            with open(dest_paths[url], 'wb') as dest:
+                for offset, length in header_members + members \
+                + trailer_members:
+                    copy_range(source, dest, offset, length)
+
+    return list(url_members.keys())
+
+
+def new_record_id():
+    return '<urn:uuid:%s>' % uuid.uuid4()
+
+
+def block_digest(fileobj, offset=0, prefix=''):
+    '''Return the WARC digest of `prefix` followed by the file contents
+    from `offset` onwards'''
+    digest = hashlib.sha1(prefix)
+    fileobj.seek(offset)
+
+    while True:
+        data = fileobj.read(65536)
+
+        if not data:
+            break
+
+        digest.update(data)
+
+    return format_digest(digest)
+
+
+def format_digest(digest):
+    return 'sha1:%s' % base64.b32encode(digest.digest())
+
+
+class WARCWriter(object):
+    '''Writes WARC records, each as its own gzip member'''
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write_record(self, record_type, fields, block, content_type):
+        '''Write a record.
+
+        `fields` is a list of extra ``(name, value)`` WARC header fields.
+        `block` is a string, a file object positioned at the start of the
+        record block, or a list of those that make up the block together.
+        '''
+        if isinstance(block, list):
+            parts = block
+        else:
+            parts = [block]
+
+        block_length = 0
+
+        for part in parts:
+            if isinstance(part, basestring):
+                block_length += len(part)
+            else:
+                start = part.tell()
+                part.seek(0, 2)
+                block_length += part.tell() - start
+                part.seek(start)
+
+        header_fields = [
+            ('WARC-Type', record_type),
+            ('WARC-Date', datetime.datetime.utcnow().strftime(
+                '%Y-%m-%dT%H:%M:%SZ')),
+        ]
+        header_fields.extend(fields)
+        header_fields.extend([
+            ('Content-Type', content_type),
+            ('Content-Length', str(block_length)),
+        ])
+
+        gzip_file = gzip.GzipFile(fileobj=self.fileobj, mode='wb')
+        gzip_file.write('WARC/1.0\r\n')
+
+        for name, value in header_fields:
+            gzip_file.write('%s: %s\r\n' % (name, value))
+
+        gzip_file.write('\r\n')
+
+        for part in parts:
+            if isinstance(part, basestring):
+                gzip_file.write(part)
+            else:
+                while True:
+                    data = part.read(65536)
+
+                    if not data:
+                        break
+
+                    gzip_file.write(data)
+
+        gzip_file.write('\r\n\r\n')
+        gzip_file.close()
+
+    def write_warcinfo(self, filename, info_fields):
+        block = ''.join('%s: %s\r\n' % (name, value)
+            for name, value in info_fields)
+        record_id = new_record_id()
+
+        self.write_record('warcinfo',
+            [('WARC-Record-ID', record_id), ('WARC-Filename', filename)],
+            block, 'application/warc-fields')
+
+        return record_id
+
+    def write_exchange(self, url, warcinfo_id, request_block,
+    response_header, payload_file):
+        '''Write a request and response record pair.
+
+        The response record holds `response_header`, the HTTP status line
+        and header fields, followed by the payload in `payload_file`.
+        '''
+        request_id = new_record_id()
+        response_id = new_record_id()
+
+        response_fields = [
+            ('WARC-Record-ID', response_id),
+            ('WARC-Warcinfo-ID', warcinfo_id),
+            ('WARC-Target-URI', url),
+            ('WARC-Block-Digest', block_digest(payload_file,
+                prefix=response_header)),
+            ('WARC-Payload-Digest', block_digest(payload_file)),
+        ]
+        request_fields = [
+            ('WARC-Record-ID', request_id),
+            ('WARC-Warcinfo-ID', warcinfo_id),
+            ('WARC-Target-URI', url),
+            ('WARC-Concurrent-To', response_id),
+            ('WARC-Block-Digest', format_digest(
+                hashlib.sha1(request_block))),
+        ]
+
+        self.write_record('request', request_fields, request_block,
+            'application/http;msgtype=request')
+
+        payload_file.seek(0)
+        self.write_record('response', response_fields,
+            [response_header, payload_file],
+            'application/http;msgtype=response')
+